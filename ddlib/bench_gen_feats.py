@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+#
+# Micro-benchmark of the ngram and window features of gen_feats on test.json.
+#
+# The features are generated for every relation of test.json both by ddlib
+# and by the original implementations below, which join the words of every
+# feature from scratch. The script checks that both produce exactly the same
+# feature strings, and reports the time taken by each.
+#
+#   python bench_gen_feats.py [test.json] [repetitions]
+#
+
+import sys
+import json
+import time
+
+import ddlib
+from ddlib.gen_feats import _get_ngram_features, _get_window_features, \
+    _SentenceContext
+
+
+def reference_ngram_features(sentence, span, window=3):
+    for i in range(span.begin_word_id, span.begin_word_id + span.length):
+        for j in range(1, window + 1):
+            if i+j <= span.begin_word_id + span.length:
+                yield "NGRAM_" + str(j) + "_[" + " ".join(
+                    map(lambda x: str(x.lemma), sentence[i:i+j])) + "]"
+
+
+def reference_window_features(
+        sentence, span, window=3, combinations=True, isolated=True):
+    span_end_idx = span.begin_word_id + span.length - 1
+    left_lemmas = []
+    left_ners = []
+    right_lemmas = []
+    right_ners = []
+    try:
+        for i in range(1, window + 1):
+            lemma = str(sentence[span.begin_word_id - i].lemma)
+            try:
+                float(lemma)
+                lemma = "_NUMBER"
+            except ValueError:
+                pass
+            left_lemmas.append(lemma)
+            left_ners.append(str(sentence[span.begin_word_id - i].ner))
+    except IndexError:
+        pass
+    left_lemmas.reverse()
+    left_ners.reverse()
+    try:
+        for i in range(1, window + 1):
+            lemma = str(sentence[span_end_idx + i].lemma)
+            try:
+                float(lemma)
+                lemma = "_NUMBER"
+            except ValueError:
+                pass
+            right_lemmas.append(lemma)
+            right_ners.append(str(sentence[span_end_idx + i].ner))
+    except IndexError:
+        pass
+    if isolated:
+        for i in range(len(left_lemmas)):
+            yield "W_LEFT_" + str(i+1) + "_[" + " ".join(left_lemmas[-i-1:]) + \
+                "]"
+            yield "W_LEFT_NER_" + str(i+1) + "_[" + " ".join(left_ners[-i-1:]) +\
+                "]"
+        for i in range(len(right_lemmas)):
+            yield "W_RIGHT_" + str(i+1) + "_[" + " ".join(right_lemmas[:i+1]) +\
+                "]"
+            yield "W_RIGHT_NER_" + str(i+1) + "_[" + \
+                " ".join(right_ners[:i+1]) + "]"
+    if combinations:
+        for i in range(len(left_lemmas)):
+            curr_left_lemmas = " ".join(left_lemmas[-i-1:])
+            curr_left_ners = " ".join(left_ners[-i-1:])
+            for j in range(len(right_lemmas)):
+                curr_right_lemmas = " ".join(right_lemmas[:j+1])
+                curr_right_ners = " ".join(right_ners[:j+1])
+                yield "W_LEMMA_L_" + str(i+1) + "_R_" + str(j+1) + "_[" + \
+                    curr_left_lemmas + "]_[" + curr_right_lemmas + "]"
+                yield "W_NER_L_" + str(i+1) + "_R_" + str(j+1) + "_[" + \
+                    curr_left_ners + "]_[" + curr_right_ners + "]"
+
+
+def load(filename):
+    """Return the (sentence, span1, span2) of every row of test.json."""
+    relations = []
+    with open(filename) as f:
+        for line in f:
+            obj = json.loads(line)
+            # Kept unicode, as json_extractor UDFs get them.
+            words = obj["words"]
+            lemmas = obj["lemma"]
+            ners = ["PERSON" if w[:1].isupper() else "O" for w in words]
+            sentence = ddlib.Sentence(words=words, lemmas=lemmas, ners=ners)
+            span1 = ddlib.Span(obj["p1.start_position"], obj["p1.length"])
+            span2 = ddlib.Span(obj["p2.start_position"], obj["p2.length"])
+            relations.append((sentence, span1, span2))
+    return relations
+
+
+def spans(span1, span2):
+    """Return the spans between and around two mentions, as in
+    get_generic_features_relation."""
+    order = sorted([
+        span1.begin_word_id, span1.begin_word_id + span1.length,
+        span2.begin_word_id, span2.begin_word_id + span2.length])
+    return (ddlib.Span(order[1], order[2] - order[1]),
+            ddlib.Span(order[0], order[3] - order[0]))
+
+
+def reference(relations):
+    features = []
+    for sentence, span1, span2 in relations:
+        betw_span, covering_span = spans(span1, span2)
+        features.extend(reference_ngram_features(sentence, betw_span))
+        features.extend(reference_window_features(
+            sentence, covering_span, isolated=False))
+        features.extend(reference_window_features(sentence, span1))
+        features.extend(reference_window_features(sentence, span2))
+    return features
+
+
+def current(relations):
+    features = []
+    for sentence, span1, span2 in relations:
+        context = _SentenceContext(sentence)
+        betw_span, covering_span = spans(span1, span2)
+        features.extend(_get_ngram_features(
+            sentence, betw_span, context=context))
+        features.extend(_get_window_features(
+            sentence, covering_span, isolated=False, context=context))
+        features.extend(_get_window_features(
+            sentence, span1, context=context))
+        features.extend(_get_window_features(
+            sentence, span2, context=context))
+    return features
+
+
+def main():
+    filename = sys.argv[1] if len(sys.argv) > 1 else "test.json"
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    relations = load(filename)
+    results = {}
+    for name, generate in (("reference", reference), ("ddlib", current)):
+        best = None
+        for _ in range(repetitions):
+            start = time.time()
+            results[name] = generate(relations)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print "%-10s %8.3fs for %d features" % (name, best, len(results[name]))
+    if results["reference"] != results["ddlib"]:
+        print "the features differ"
+        sys.exit(1)
+    print "identical features"
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,3 @@
 from dd import *
 from gen_feats import *
+from parallel import run_parallel
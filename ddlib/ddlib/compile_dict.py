@@ -0,0 +1,224 @@
+#! /usr/bin/env python
+#
+# Compiled dictionaries for the generic features.
+#
+# load_dictionary reads a text file into a frozenset in every UDF process. For
+# large dictionaries, compile them once instead:
+#
+#   python -m ddlib.compile_dict [--func module.function] dict.txt dict.ddict
+#
+# and load the compiled file with load_dictionary as usual. It is mapped in
+# memory read-only, so all the processes reading it share the same copy in the
+# page cache, and loading it takes no time.
+#
+# The file is a hash table. All integers are unsigned little-endian:
+#
+#   magic "DDLIBDC1", version (4 bytes), length of the name of func (4 bytes),
+#   number of entries (8 bytes), number of buckets (8 bytes), maximum number of
+#   words in an entry (8 bytes), name of func (padded to 8 bytes)
+#   for each bucket, the index of its first entry (8 bytes), plus the number of
+#       entries
+#   for each entry, the offset of its string (8 bytes), plus the total length
+#       of the strings
+#   the strings, encoded in UTF-8
+#
+# The entries are sorted by bucket, i.e., by the CRC-32 of their string modulo
+# the number of buckets.
+#
+
+import sys
+import mmap
+import struct
+import zlib
+import argparse
+import collections
+
+MAGIC = "DDLIBDC1"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sIIQQQ")
+_OFFSET = struct.Struct("<Q")
+_OFFSETS = struct.Struct("<QQ")
+
+
+def compile_dictionary(filename, output, func=None, func_name=None):
+    """Compile a dictionary file for load_dictionary.
+
+    Args:
+        filename: full path to the dictionary, one entry per line
+        output: full path to the compiled dictionary to write
+        func: (optional) A function to be applied to each row of the file, as
+            in load_dictionary. It must return a string.
+        func_name: (optional) the name recorded for func in the compiled
+            dictionary, "module.function" by default. load_dictionary refuses
+            to load the compiled dictionary with a different func. It must be
+            given if func cannot be imported by its name (e.g. a lambda, a
+            nested function or a functools.partial).
+    Returns: the number of entries in the compiled dictionary.
+    """
+    entries = set()
+    with open(filename, 'rt') as dict_file:
+        for line in dict_file:
+            entry = line.strip()
+            if func is not None:
+                entry = func(entry)
+            if isinstance(entry, unicode):
+                entry = entry.encode("utf-8")
+            elif not isinstance(entry, str):
+                raise ValueError("Entries of a compiled dictionary must be " +
+                                 "strings, got %r" % (entry,))
+            entries.add(entry)
+    if func is not None and func_name is None:
+        func_name = _func_name(func)
+        if func_name is None:
+            raise ValueError("%r cannot be imported by its name: give " % func +
+                             "func_name, the function to import instead")
+    func_name = func_name or ""
+    n_buckets = max(len(entries), 1)
+    entries = sorted(entries, key=lambda e: (_bucket(e, n_buckets), e))
+    max_words = max([e.count(" ") + 1 for e in entries]) if entries else 0
+    with open(output, 'wb') as out:
+        out.write(_HEADER.pack(MAGIC, VERSION, len(func_name), len(entries),
+                               n_buckets, max_words))
+        out.write(func_name + "\0" * (-len(func_name) % 8))
+        bucket_starts = [0] * (n_buckets + 1)
+        for entry in entries:
+            bucket_starts[_bucket(entry, n_buckets) + 1] += 1
+        for bucket in xrange(n_buckets):
+            bucket_starts[bucket + 1] += bucket_starts[bucket]
+        out.write(struct.pack("<%dQ" % len(bucket_starts), *bucket_starts))
+        offset = 0
+        for entry in entries:
+            out.write(_OFFSET.pack(offset))
+            offset += len(entry)
+        out.write(_OFFSET.pack(offset))
+        for entry in entries:
+            out.write(entry)
+    return len(entries)
+
+
+def is_compiled_dictionary(filename):
+    """Return whether a file is a compiled dictionary."""
+    with open(filename, 'rb') as dict_file:
+        return dict_file.read(len(MAGIC)) == MAGIC
+
+
+class CompiledDictionary(collections.Set):
+    """A read-only set of strings backed by a memory-mapped compiled
+    dictionary.
+
+    Unicode strings are looked up by their UTF-8 encoding, and iterating
+    yields the entries as UTF-8 encoded strings.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as dict_file:
+            self._map = mmap.mmap(dict_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        magic, version, func_len, self._n_entries, self._n_buckets, \
+            self.max_words = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a compiled dictionary" % filename)
+        start = _HEADER.size
+        self.filename = filename
+        self.func_name = self._map[start:start + func_len]
+        self._buckets = start + func_len + (-func_len % 8)
+        self._offsets = self._buckets + 8 * (self._n_buckets + 1)
+        self._strings = self._offsets + 8 * (self._n_entries + 1)
+
+    def __len__(self):
+        return self._n_entries
+
+    def __contains__(self, phrase):
+        if isinstance(phrase, unicode):
+            phrase = phrase.encode("utf-8")
+        elif not isinstance(phrase, str):
+            return False
+        first, last = _OFFSETS.unpack_from(
+            self._map, self._buckets + 8 * _bucket(phrase, self._n_buckets))
+        for i in xrange(first, last):
+            begin, end = _OFFSETS.unpack_from(self._map, self._offsets + 8 * i)
+            if end - begin == len(phrase) and self._map[
+                    self._strings + begin:self._strings + end] == phrase:
+                return True
+        return False
+
+    def __iter__(self):
+        for i in xrange(self._n_entries):
+            begin, end = _OFFSETS.unpack_from(self._map, self._offsets + 8 * i)
+            yield self._map[self._strings + begin:self._strings + end]
+
+    def __repr__(self):
+        return "CompiledDictionary(%r)" % self.filename
+
+    def check_func(self, func):
+        """Raise ValueError if the dictionary was not compiled with func, or
+        if func cannot be imported by its name, which is then unknown."""
+        name = _func_name(func)
+        if name is None:
+            raise ValueError("%s was compiled with func '%s', and %r cannot " % (
+                self.filename, self.func_name, func) + "be imported to check it")
+        if self.func_name != name:
+            raise ValueError("%s was compiled with func '%s', not '%s'" % (
+                self.filename, self.func_name, name))
+
+    def close(self):
+        self._map.close()
+
+
+def _bucket(entry, n_buckets):
+    return (zlib.crc32(entry) & 0xffffffff) % n_buckets
+
+
+def _func_name(func):
+    """Return the name func is imported by ("module.function", or
+    "module.Class.method"), or None if importing that name does not give func
+    back, as for lambdas, nested functions and partials."""
+    # Methods of classes, including those of builtin types (e.g. str.lower)
+    owner = getattr(func, "__objclass__", None) or getattr(func, "im_class",
+                                                           None)
+    try:
+        if owner is not None:
+            name = "%s.%s.%s" % (owner.__module__, owner.__name__,
+                                 func.__name__)
+        else:
+            name = "%s.%s" % (func.__module__, func.__name__)
+        if _import_func(name) == func:
+            return name
+    except (AttributeError, ImportError, TypeError, ValueError):
+        pass
+    return None
+
+
+def _import_func(name):
+    """Import a function from its name, e.g. "string.lower" or
+    "__builtin__.str.lower"."""
+    parts = name.split(".")
+    for i in range(len(parts) - 1, 0, -1):
+        try:
+            obj = __import__(".".join(parts[:i]), fromlist=[parts[i]])
+        except ImportError:
+            continue
+        for part in parts[i:]:
+            obj = getattr(obj, part)
+        return obj
+    raise ImportError("No module in '%s'" % name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compile a dictionary for ddlib.load_dictionary")
+    parser.add_argument("input", help="the dictionary, one entry per line")
+    parser.add_argument("output", help="the compiled dictionary to write")
+    parser.add_argument("--func", metavar="MODULE.FUNCTION",
+                        help="a function to be applied to each row, as the " +
+                        "func argument of load_dictionary")
+    args = parser.parse_args(argv)
+    func = _import_func(args.func) if args.func else None
+    n_entries = compile_dictionary(args.input, args.output, func, args.func)
+    sys.stderr.write("Compiled %d entries into %s\n" % (n_entries,
+                                                        args.output))
+
+
+if __name__ == "__main__":
+    main()
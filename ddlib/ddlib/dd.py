@@ -1,67 +1,657 @@
+import os
 import sys
+import re
+import time
+import atexit
+import weakref
+import itertools
+import multiprocessing.util
 import collections
+from array import array
+
+from pgarray import decode_column
 
 Word = collections.namedtuple('Word', ['begin_char_offset', 'end_char_offset', 'word', 'lemma', 'pos', 'ner', 'dep_par', 'dep_label'])
 Span = collections.namedtuple('Span', ['begin_word_id', 'length'])
 Sequence = collections.namedtuple('Sequence', ['is_inversed', 'elements'])
 DepEdge = collections.namedtuple('DepEdge', ['word1', 'word2', 'label', 'is_bottom_up'])
 
-def unpack_words(input_dict, character_offset_begin=None, character_offset_end=None, lemma=None,
-        pos=None, ner = None, words = None, dep_graph = None, dep_graph_parser = lambda x: x.split('\t')):
-        """Return a list of Word objects representing a sentence
+class Sentence(object):
+        """A sentence stored as parallel columns instead of a list of Word objects.
+
+        Integer columns (character offsets, dependency parents) are kept in
+        compact arrays and tag columns (POS, NER, dependency labels) share a
+        single copy of each distinct string across all sentences (see
+        Vocabulary), optionally storing them as integer codes. Indexing a
+        Sentence returns a Word namedtuple built on demand, and slicing returns
+        a list of them, so it can be used wherever a list of Word objects is
+        expected.
+        """
+
+        __slots__ = ('begin_char_offsets', 'end_char_offsets', 'words', 'lemmas',
+                'poses', 'ners', 'dep_pars', 'dep_labels', '_dep_index',
+                '_lemma_strings', '_normalized_lemmas', '_ner_strings')
+
+        def __init__(self, begin_char_offsets=(), end_char_offsets=(), words=(),
+                lemmas=(), poses=(), ners=(), dep_pars=(), dep_labels=(),
+                encode_tags=False):
+                """Build a Sentence from its columns.
+
+                The length of the sentence is the length of the longest of the
+                first six columns; shorter columns are padded with None, and words
+                without a dependency parent get dep_par -1 and dep_label "ROOT".
+
+                Tags are interned in tag_vocabulary. With encode_tags, the tag
+                columns are stored as TagColumns of integer codes instead of
+                tuples of strings.
+                """
+                n = max(len(begin_char_offsets), len(end_char_offsets), len(words),
+                        len(lemmas), len(poses), len(ners))
+                self.begin_char_offsets = _int_column(begin_char_offsets, n)
+                self.end_char_offsets = _int_column(end_char_offsets, n)
+                self.words = _padded(words, n, None)
+                self.lemmas = _padded(lemmas, n, None)
+                self.poses = _intern_tags(_padded(poses, n, None), encode_tags)
+                self.ners = _intern_tags(_padded(ners, n, None), encode_tags)
+                self.dep_pars = array('i', _padded(dep_pars, n, -1)[:n])
+                self.dep_labels = _intern_tags(_padded(dep_labels, n, "ROOT")[:n], encode_tags)
+                self._dep_index = None
+                self._lemma_strings = None
+                self._normalized_lemmas = None
+                self._ner_strings = None
+
+        def __len__(self):
+                return len(self.words)
+
+        def __getitem__(self, index):
+                if isinstance(index, slice):
+                        return [self._word(i) for i in xrange(*index.indices(len(self.words)))]
+                if index < 0:
+                        index += len(self.words)
+                if index < 0 or index >= len(self.words):
+                        raise IndexError('Sentence index out of range')
+                return self._word(index)
+
+        def __iter__(self):
+                for i in xrange(len(self.words)):
+                        yield self._word(i)
+
+        def __repr__(self):
+                return 'Sentence(%r)' % (self.words,)
+
+        @property
+        def dep_index(self):
+                """The DepIndex of the sentence, built the first time it is needed."""
+                if self._dep_index is None:
+                        self._dep_index = DepIndex(self.dep_pars)
+                return self._dep_index
+
+        @property
+        def lemma_strings(self):
+                """The lemmas of the sentence converted with to_strings, computed the
+                first time they are needed."""
+                if self._lemma_strings is None:
+                        self._lemma_strings = to_strings(self.lemmas)
+                return self._lemma_strings
+
+        @property
+        def normalized_lemmas(self):
+                """The lemma_strings of the sentence, with the numbers replaced by
+                _NUMBER (see normalize_lemma), computed the first time they are
+                needed."""
+                if self._normalized_lemmas is None:
+                        self._normalized_lemmas = map(normalize_lemma, self.lemma_strings)
+                return self._normalized_lemmas
+
+        @property
+        def ner_strings(self):
+                """The NER tags of the sentence converted with to_strings, computed
+                the first time they are needed."""
+                if self._ner_strings is None:
+                        self._ner_strings = to_strings(self.ners)
+                return self._ner_strings
+
+        def _word(self, i):
+                return _new_tuple(Word, (self.begin_char_offsets[i], self.end_char_offsets[i],
+                        self.words[i], self.lemmas[i], self.poses[i], self.ners[i],
+                        self.dep_pars[i], self.dep_labels[i]))
+
+
+# Skips the argument handling of Word.__new__ when building views.
+_new_tuple = tuple.__new__
+
+def to_strings(values):
+        """Return a list of the values converted with str(), except for unicode
+        strings, which are encoded in UTF-8: str() fails on those that are not
+        ASCII."""
+        try:
+                return map(str, values)
+        except UnicodeEncodeError:
+                return [v.encode('utf-8') if isinstance(v, unicode) else str(v) for v in values]
+
+# float() only accepts strings containing a digit, inf or nan.
+_MAYBE_NUMBER = re.compile(r'[0-9]|inf|nan', re.I)
+
+def normalize_lemma(lemma):
+        """Return "_NUMBER" if the string lemma is a number, the lemma otherwise."""
+        if _MAYBE_NUMBER.search(lemma) is None:
+                return lemma
+        try:
+                float(lemma)
+                return "_NUMBER"
+        except ValueError:
+                return lemma
+
+class Vocabulary(object):
+        """A process-wide table of tag strings (POS, NER, dependency labels).
+
+        Each distinct tag gets a small integer code, and strings[code] is the
+        single shared copy of the tag. Code 0 is None. u'NN' == 'NN', so str and
+        unicode tags get different codes, to make sure a Word sees a tag of the
+        type it was given.
         """
 
-        array_character_offset_begin = input_dict[character_offset_begin] if character_offset_begin != None else ()
-        array_character_offset_end = input_dict[character_offset_end] if character_offset_end != None else ()
-        array_lemma = input_dict[lemma] if lemma != None else ()
-        array_pos = input_dict[pos] if pos != None else ()
-        array_ner = input_dict[ner] if ner != None else ()
-        array_words = input_dict[words] if words != None else ()
-        dep_graph = input_dict[dep_graph] if dep_graph != None else ()
+        def __init__(self):
+                self.strings = [None]
+                self._codes = {type(None): {None: 0}}
+                # The same tables mapping each tag to its shared copy, which
+                # makes interning a column a single map() call.
+                self._shared = {type(None): {None: None}}
+
+        def __len__(self):
+                return len(self.strings)
+
+        def __contains__(self, tag):
+                return tag in self._codes.get(tag.__class__, ())
+
+        def code(self, tag):
+                """Return the code of a tag, adding it to the vocabulary if needed."""
+                table = self._codes.setdefault(tag.__class__, {})
+                code = table.get(tag)
+                if code is None:
+                        code = table[tag] = len(self.strings)
+                        self.strings.append(tag)
+                        self._shared.setdefault(tag.__class__, {})[tag] = tag
+                return code
+
+        def encode(self, values):
+                """Return the codes of a column of tags as an array."""
+                values = tuple(values)
+                if not values:
+                        return array(self._typecode())
+                # A column is assumed to hold a single type; anything else goes
+                # through the slow path.
+                table = self._codes.get(values[0].__class__, {})
+                try:
+                        codes = map(table.__getitem__, values)
+                except KeyError:
+                        try:
+                                tables = self._codes
+                                codes = [tables[v.__class__][v] for v in values]
+                        except KeyError:
+                                codes = map(self.code, values)
+                return array(self._typecode(), codes)
+
+        def decode(self, codes):
+                """Return the tags of a sequence of codes as a tuple."""
+                return tuple(map(self.strings.__getitem__, codes))
+
+        def intern(self, values):
+                """Return a column of tags as a tuple of the shared copies."""
+                values = tuple(values)
+                if not values:
+                        return ()
+                table = self._shared.get(values[0].__class__, {})
+                try:
+                        return tuple(map(table.__getitem__, values))
+                except KeyError:
+                        try:
+                                tables = self._shared
+                                return tuple([tables[v.__class__][v] for v in values])
+                        except KeyError:
+                                return self.decode(self.encode(values))
+
+        def _typecode(self):
+                return 'H' if len(self.strings) <= 0xffff else 'i'
+
+# The vocabulary shared by all sentences
+tag_vocabulary = Vocabulary()
+
+class TagColumn(object):
+        """A column of tags stored as an array of vocabulary codes.
+
+        It reads like a tuple of strings; codes gives direct access to the
+        integer codes, which are cheaper to compare and to use as keys:
+
+            sentence.ners.codes[i] == tag_vocabulary.code("PERSON")
+        """
 
-        dep_tree = {}
+        __slots__ = ('codes', 'vocabulary')
+
+        def __init__(self, values, vocabulary=tag_vocabulary):
+                self.codes = vocabulary.encode(values)
+                self.vocabulary = vocabulary
+
+        def __len__(self):
+                return len(self.codes)
+
+        def __getitem__(self, index):
+                if isinstance(index, slice):
+                        return self.vocabulary.decode(self.codes[index])
+                return self.vocabulary.strings[self.codes[index]]
+
+        def __iter__(self):
+                return itertools.imap(self.vocabulary.strings.__getitem__, self.codes)
+
+        def __eq__(self, other):
+                if isinstance(other, TagColumn) and other.vocabulary is self.vocabulary:
+                        return self.codes == other.codes
+                if isinstance(other, (TagColumn, list, tuple)):
+                        return tuple(self) == tuple(other)
+                return NotImplemented
+
+        def __ne__(self, other):
+                equal = self.__eq__(other)
+                return equal if equal is NotImplemented else not equal
+
+        __hash__ = None
+
+        def __repr__(self):
+                return 'TagColumn(%r)' % (tuple(self),)
+
+collections.Sequence.register(TagColumn)
+
+def _intern_tags(values, encode=False):
+        if encode:
+                return TagColumn(values)
+        return tag_vocabulary.intern(values)
+
+def _padded(values, n, fill):
+        values = tuple(values)
+        if len(values) < n:
+                values += (fill,) * (n - len(values))
+        return values
+
+def _int_column(values, n):
+        # Fall back to a tuple when the column is missing, short or not made of
+        # integers, so that Word objects see exactly the values we were given.
+        if len(values) == n:
+                try:
+                        return array('i', values)
+                except (TypeError, OverflowError):
+                        pass
+        return _padded(values, n, None)
+
+
+def dep_graph_parser_parenthesis(edge_str):
+        """Given a string representing a dependency edge in the 'parenthesis'
+        format, return a tuple of (parent_index, edge_label, child_index).
+
+        Args:
+            edge_str: a string representation of an edge in the dependency tree, in
+            the format edge_label(parent_word-parent_index, child_word-child_index)
+        Returns:
+            tuple of (parent_index, edge_label, child_index)
+        """
+        tokens = edge_str.split("(")
+        label = tokens[0]
+        tokens = tokens[1].split(", ")
+        parent = int(tokens[0].split("-")[-1]) - 1
+        child = int(",".join(tokens[1:]).split("-")[-1][:-1]) - 1
+        return (parent, label, child)
+
+def dep_graph_parser_triplet(edge_str):
+        """Given a string representing a dependency edge in the 'triplet' format,
+        return a tuple of (parent_index, edge_label, child_index).
+
+        Args:
+            edge_str: a string representation of an edge in the dependency tree
+            in the format "parent_index\tlabel\child_index"
+        Returns:
+            tuple of (parent_index, edge_label, child_index)
+        """
+        parent, label, child = edge_str.split()
+        # input edge used 1-based indexing
+        return (int(parent) - 1, label, int(child) - 1)
+
+# Whole-column versions of the parsers above: one regex scan over all the edges
+# of a sentence joined by newlines. Each pattern only matches edges that the
+# per-edge parser reads the same way; anything else goes through the parser.
+_TRIPLET_EDGES = re.compile(r'^[^\S\n]*([-+]?\d+)[^\S\n]+(\S+)[^\S\n]+([-+]?\d+)[^\S\n]*$', re.M)
+_PARENTHESIS_EDGES = re.compile(r'^([^(\n]*)\((?:[^(,\n]|,(?! ))*-(\d+), [^(\n]*-(\d+)\)$', re.M)
+
+# parser -> (pattern, positions of the parent, label and child groups)
+_BULK_DEP_GRAPH_PARSERS = {
+        dep_graph_parser_triplet: (_TRIPLET_EDGES, (0, 1, 2)),
+        dep_graph_parser_parenthesis: (_PARENTHESIS_EDGES, (1, 0, 2)),
+        "triplet": (_TRIPLET_EDGES, (0, 1, 2)),
+        "parenthesis": (_PARENTHESIS_EDGES, (1, 0, 2)),
+}
+
+def _parse_dep_graph(dep_graph, dep_graph_parser):
+        """Return the parents, labels and children of the edges of a dependency
+        graph as three parallel lists."""
+        if not isinstance(dep_graph, (list, tuple)):
+                dep_graph = list(dep_graph)
+        if not dep_graph:
+                return [], [], []
+        bulk = _BULK_DEP_GRAPH_PARSERS.get(dep_graph_parser)
+        if bulk is not None:
+                pattern, (parent_pos, label_pos, child_pos) = bulk
+                text = "\n".join(dep_graph)
+                if text.count("\n") == len(dep_graph) - 1:
+                        matches = pattern.findall(text)
+                        if len(matches) == len(dep_graph):
+                                fields = zip(*matches)
+                                # both formats use 1-based indexes
+                                return ([int(p) - 1 for p in fields[parent_pos]], list(fields[label_pos]),
+                                        [int(c) - 1 for c in fields[child_pos]])
+                dep_graph_parser = {"triplet": dep_graph_parser_triplet,
+                        "parenthesis": dep_graph_parser_parenthesis}.get(dep_graph_parser, dep_graph_parser)
+        parents, labels, children = [], [], []
         for path in dep_graph:
                 (parent, label, child) = dep_graph_parser(path)
-                parent, child = int(parent), int(child)
-                dep_tree[child] = {"parent":parent, "label":label}
-                if parent not in dep_tree: dep_tree[parent] = {"parent":-1, "label":"ROOT"}
+                parents.append(int(parent))
+                labels.append(label)
+                children.append(int(child))
+        return parents, labels, children
+
+
+def unpack_words(input_dict, character_offset_begin=None, character_offset_end=None, lemma=None,
+        pos=None, ner = None, words = None, dep_graph = None, dep_graph_parser = lambda x: x.split('\t'),
+        array_delim=None, encode_tags=False):
+        """Return a Sentence (a sequence of Word objects) representing a sentence
+
+        dep_graph_parser turns one edge of the dep_graph column into a tuple
+        (parent_index, label, child_index). When it is dep_graph_parser_triplet or
+        dep_graph_parser_parenthesis (or the strings "triplet" and "parenthesis")
+        the whole column is parsed at once, which is much faster.
+
+        Columns can also be given as strings as they come out of the database:
+        they are split on array_delim (e.g. "~^~") if it is given, and decoded
+        as PostgreSQL array literals (e.g. '{a,"b c"}') otherwise.
+
+        With encode_tags, POS, NER and dependency labels are stored as integer
+        codes of tag_vocabulary (see TagColumn).
+        """
+
+        def column(key, convert=None):
+                return decode_column(input_dict[key], convert, array_delim) if key != None else ()
+
+        array_character_offset_begin = column(character_offset_begin, int)
+        array_character_offset_end = column(character_offset_end, int)
+        array_lemma = column(lemma)
+        array_pos = column(pos)
+        array_ner = column(ner)
+        array_words = column(words)
+        dep_graph = column(dep_graph)
 
-        ziped_tags = map(None, array_character_offset_begin, array_character_offset_end, array_lemma,
-                array_pos, array_ner, array_words)
-        wordobjs = []
-        for i in range(0,len(ziped_tags)):
-                if i not in dep_tree : dep_tree[i] = {"parent":-1, "label":"ROOT"}
-                wordobjs.append(Word(begin_char_offset=ziped_tags[i][0], end_char_offset=ziped_tags[i][1], lemma=ziped_tags[i][2], pos=ziped_tags[i][3],
-                        ner=ziped_tags[i][4], word=ziped_tags[i][5],dep_par=dep_tree[i]["parent"], dep_label=dep_tree[i]["label"]))
-        return wordobjs
+        n = max(len(array_character_offset_begin), len(array_character_offset_end), len(array_lemma),
+                len(array_pos), len(array_ner), len(array_words))
+        dep_pars = [-1] * n
+        dep_labels = ["ROOT"] * n
+        for parent, label, child in zip(*_parse_dep_graph(dep_graph, dep_graph_parser)):
+                if 0 <= child < n:
+                        dep_pars[child] = parent if 0 <= parent < n else -1
+                        dep_labels[child] = label
 
+        return Sentence(begin_char_offsets=array_character_offset_begin,
+                end_char_offsets=array_character_offset_end, words=array_words, lemmas=array_lemma,
+                poses=array_pos, ners=array_ner, dep_pars=dep_pars, dep_labels=dep_labels,
+                encode_tags=encode_tags)
 
-def log(obj):
+
+class Logger(object):
+        """Buffered writer of log messages to STDERR, with sampling and rate limits.
+
+        Messages are collected in a per-process buffer that is written out when it
+        grows past buffer_size bytes, when a message is logged more than
+        flush_interval seconds after the last write, and when the logger is
+        flushed or closed. There is no timer: a process that logs once and then
+        stays quiet keeps the message buffered until it calls flush_log (as
+        run_parallel does after each batch) or exits. Messages can be given a
+        key: only one in sample_rate messages of each key is kept, and at most
+        rate_limit messages of each key are kept in every rate_interval seconds.
+        Closing the logger writes how many messages of each key were dropped;
+        it is closed when the process exits, including the forked workers of
+        run_parallel.
+        """
+
+        def __init__(self, stream=None, buffer_size=64 * 1024, flush_interval=1.0,
+                sample_rate=1, rate_limit=None, rate_interval=1.0):
+                """
+                Args:
+                    stream: where to write, sys.stderr (looked up at every flush) by default.
+                    buffer_size: number of buffered bytes that triggers a flush.
+                    flush_interval: seconds after which buffered messages are flushed
+                        by the next message logged.
+                    sample_rate: keep one message in sample_rate for each key.
+                    rate_limit: maximum number of messages per key and rate_interval, or None.
+                    rate_interval: length in seconds of a rate limiting window.
+                """
+                self.stream = stream
+                self.buffer_size = buffer_size
+                self.flush_interval = flush_interval
+                self.sample_rate = sample_rate
+                self.rate_limit = rate_limit
+                self.rate_interval = rate_interval
+                self._buffer = []
+                self._buffered = 0
+                self._last_flush = time.time()
+                self._seen = collections.defaultdict(int)
+                self._suppressed = collections.defaultdict(int)
+                self._windows = {}
+                _close_at_exit(self)
+                multiprocessing.util.register_after_fork(self, Logger._forked)
+
+        def log(self, obj, key=None):
+                """Buffer the string form of an object, unless the sampling or the rate
+                limit of its key drops it."""
+                now = time.time()
+                self._seen[key] += 1
+                if self.sample_rate > 1 and (self._seen[key] - 1) % self.sample_rate:
+                        self._suppressed[key] += 1
+                        return
+                if self.rate_limit is not None:
+                        window_start, count = self._windows.get(key, (now, 0))
+                        if now - window_start >= self.rate_interval:
+                                window_start, count = now, 0
+                        if count >= self.rate_limit:
+                                self._suppressed[key] += 1
+                                return
+                        self._windows[key] = (window_start, count + 1)
+                message = obj.__str__()
+                if isinstance(message, unicode):
+                        message = message.encode('utf-8')
+                self._buffer.append(message + "\n")
+                self._buffered += len(message) + 1
+                if self._buffered >= self.buffer_size or now - self._last_flush >= self.flush_interval:
+                        self.flush()
+
+        def flush(self):
+                """Write out all the buffered messages."""
+                self._last_flush = time.time()
+                if not self._buffer:
+                        return
+                stream = self.stream if self.stream is not None else sys.stderr
+                stream.write("".join(self._buffer))
+                stream.flush()
+                self._buffer = []
+                self._buffered = 0
+
+        def close(self):
+                """Flush the buffer and write a summary of the dropped messages."""
+                for key in sorted(self._suppressed):
+                        self._buffer.append("ddlib.log: suppressed %d of %d messages%s\n" % (
+                                self._suppressed[key], self._seen[key],
+                                "" if key is None else " with key %s" % (key,)))
+                self._suppressed.clear()
+                self.flush()
+                _closed(self)
+
+        def _forked(self):
+                # A forked process writes and counts its own messages, and
+                # writes its summary when it exits.
+                self._buffer = []
+                self._buffered = 0
+                self._seen.clear()
+                self._suppressed.clear()
+                self._windows = {}
+                _close_at_exit(self)
+
+
+# The RowWriters, FeatureAggregators, FeatureHashers and FeatureProfiler to
+# close when the process exits, with the order in which they were registered
+# and the process that registered them. The references are weak, so that
+# objects are not kept alive until the process exits.
+_to_close = weakref.WeakKeyDictionary()
+_registrations = itertools.count()
+
+def _close_at_exit(obj):
+        """Call obj.close() when this process exits, unless obj was closed (see
+        _closed) or garbage collected before. An object inherited by a forked
+        process is only closed there if it is registered again in it."""
+        _to_close[obj] = (next(_registrations), os.getpid())
+
+def _closed(obj):
+        """Stop tracking obj, which its owner closed."""
+        _to_close.pop(obj, None)
+
+def _close_all():
+        """Close the objects registered by this process, the latest first (e.g.
+        a FeatureAggregator before its RowWriter)."""
+        pid = os.getpid()
+        objects = [(order, obj) for obj, (order, owner) in _to_close.items() if owner == pid]
+        for order, obj in sorted(objects, key=lambda o: o[0], reverse=True):
+                _to_close.pop(obj, None)
+                try:
+                        obj.close()
+                except ValueError:
+                        # The caller closed the stream: there is nowhere to write to.
+                        pass
+
+atexit.register(_close_all)
+
+_logger = Logger()
+
+def configure_log(**kwargs):
+        """Change the settings of the logger used by log.
+
+        Accepts the same keyword arguments as the Logger constructor. Messages
+        buffered so far are flushed first.
+        """
+        global _logger
+        _logger.close()
+        _logger = Logger(**kwargs)
+
+def log(obj, key=None):
         """Print the string form of an object to STDERR.
 
+        Messages are buffered and written out in batches (see Logger and
+        configure_log), and at the latest when the process exits.
+
         Args:
         obj: The object that the user wants to log to STDERR.
+        key: (optional) Identifies the kind of message for sampling and rate
+            limits.
         """
-        sys.stderr.write(obj.__str__() + "\n")
+        _logger.log(obj, key)
+
+def flush_log():
+        """Write out the messages buffered by log."""
+        _logger.flush()
+
+class SpanView(object):
+        """A read-only view of a contiguous part of a sequence.
+
+        The view only keeps a reference to the sequence and the bounds, and
+        applies func (if any) to an element when it is accessed. It supports
+        len, indexing, iteration and `in`, and compares equal to a list or tuple
+        with the same elements; slicing it or calling materialize() returns a
+        real list.
+        """
+
+        __slots__ = ('_seq', '_start', '_stop', '_func')
+
+        def __init__(self, seq, start, stop, func=None):
+                """Create a view of seq[start:stop], with the usual slice semantics
+                for the bounds."""
+                start, stop, _ = slice(start, stop).indices(len(seq))
+                self._seq = seq
+                self._start = start
+                self._stop = max(start, stop)
+                self._func = func
+
+        def __len__(self):
+                return self._stop - self._start
+
+        def __getitem__(self, index):
+                if isinstance(index, slice):
+                        return [self[i] for i in xrange(*index.indices(len(self)))]
+                if index < 0:
+                        index += len(self)
+                if index < 0 or index >= len(self):
+                        raise IndexError('SpanView index out of range')
+                item = self._seq[self._start + index]
+                return item if self._func is None else self._func(item)
+
+        def __iter__(self):
+                seq = self._seq
+                if isinstance(seq, (list, tuple)):
+                        items = itertools.islice(seq, self._start, self._stop)
+                else:
+                        items = (seq[i] for i in xrange(self._start, self._stop))
+                return items if self._func is None else itertools.imap(self._func, items)
+
+        def __contains__(self, value):
+                for item in self:
+                        if item == value:
+                                return True
+                return False
+
+        def __eq__(self, other):
+                if isinstance(other, (SpanView, list, tuple)):
+                        return len(self) == len(other) and all(a == b for a, b in itertools.izip(self, other))
+                return NotImplemented
+
+        def __ne__(self, other):
+                equal = self.__eq__(other)
+                return equal if equal is NotImplemented else not equal
+
+        __hash__ = None
+
+        def __repr__(self):
+                return 'SpanView(%r)' % (self.materialize(),)
+
+        def materialize(self):
+                """Return the elements of the view as a new list."""
+                items = self._seq[self._start:self._stop]
+                return list(items) if self._func is None else map(self._func, items)
+
+collections.Sequence.register(SpanView)
 
-def materialize_span(words, span, func=lambda x:x):
+
+def materialize_span(words, span, func=None):
         """Given a sequence of objects and a span, return the subsequence that corresponds to the span.
 
         Args:
             words: A sequence of objects.
             span: A Span namedtuple
             func: Optional function that will be applied to each element in the result subsequence.
+
+        Returns:
+            A SpanView of the subsequence; call materialize() on it to get a list.
         """
-        return map(func, words[span.begin_word_id:(span.begin_word_id+span.length)])
+        return SpanView(words, span.begin_word_id, span.begin_word_id+span.length, func)
 
-def _fe_seq_between_words(words, begin_idx, end_idx, func=lambda x:x):
+def _fe_seq_between_words(words, begin_idx, end_idx, func=None):
         if begin_idx < end_idx:
-                return Sequence(elements=map(func, words[begin_idx+1:end_idx]), is_inversed=False)
+                return Sequence(elements=SpanView(words, begin_idx+1, end_idx, func), is_inversed=False)
         else:
-                return Sequence(elements=map(func, words[end_idx+1:begin_idx]), is_inversed=True)
+                return Sequence(elements=SpanView(words, end_idx+1, begin_idx, func), is_inversed=True)
 
 
-def tokens_between_spans(words, span1, span2, func=lambda x:x):
+def tokens_between_spans(words, span1, span2, func=None):
         """Given a sequence of objects and two spans, return the subsequence that is between these spans.
 
         Args:
@@ -72,7 +662,7 @@ def tokens_between_spans(words, span1, span2, func=lambda x:x):
 
         Returns:
             A Sequence namedtuple between these two spans. The "is_inversed" label is set
-            to be True if span1 is *AFTER* span 2.
+            to be True if span1 is *AFTER* span 2, and "elements" is a SpanView.
 
         """
         if span1.begin_word_id < span2.begin_word_id:
@@ -80,19 +670,237 @@ def tokens_between_spans(words, span1, span2, func=lambda x:x):
         else:
                 return _fe_seq_between_words(words, span1.begin_word_id, span2.begin_word_id+span2.length-1, func)
 
-def _path_to_root(words, word_idx):
-        rs = []
-        c_word_idx = word_idx
-        covered_indexes = set()
-        while True:
-                if c_word_idx in covered_indexes:
-                        break
-                rs.append(words[c_word_idx])
-                covered_indexes.add(c_word_idx)
-                if words[c_word_idx].dep_par == -1 or words[c_word_idx].dep_par == c_word_idx:
-                        break
-                c_word_idx = words[c_word_idx].dep_par
-        return rs
+class DepIndex(object):
+        """Ancestor index over the dependency parents of a sentence.
+
+        Every word is assigned the top of its tree (a root, or the word where
+        its chain of parents enters a cycle) and its depth below it, and a
+        binary-lifting table of ancestors answers lowest common ancestor
+        queries in O(log n). Walking up from a word, a
+        parent of -1 or the word itself ends the walk, and so does reaching a
+        word that was already visited. Parents outside the sentence are
+        treated as -1.
+        """
+
+        __slots__ = ('parents', 'depths', 'tops', 'cycle_ids', 'up')
+
+        def __init__(self, dep_pars):
+                n = len(dep_pars)
+                parents = array('i', [p if 0 <= p < n else -1 for p in dep_pars])
+                depths = array('i', [0]) * n
+                tops = array('i', range(n))
+                cycle_ids = array('i', [-1]) * n
+                state = [0] * n  # 0: unseen, 1: on the current walk, 2: done
+                n_cycles = 0
+                for start in xrange(n):
+                        walk = []
+                        c = start
+                        while state[c] == 0:
+                                state[c] = 1
+                                walk.append(c)
+                                if parents[c] == -1:
+                                        break
+                                c = parents[c]
+                        if state[c] == 1:
+                                # c is either a root or the first word of a new cycle
+                                # reached by this walk; it is the top of its own tree.
+                                cycle_start = walk.index(c) if parents[c] != -1 else len(walk) - 1
+                                for w in walk[cycle_start:]:
+                                        state[w] = 2
+                                        if parents[c] != -1:
+                                                cycle_ids[w] = n_cycles
+                                if parents[c] != -1:
+                                        n_cycles += 1
+                                walk = walk[:cycle_start]
+                        for w in reversed(walk):
+                                state[w] = 2
+                                depths[w] = depths[parents[w]] + 1
+                                tops[w] = tops[parents[w]]
+                up = [array('i', [parents[w] if depths[w] else w for w in xrange(n)])]
+                max_depth = max(depths) if n else 0
+                while (1 << len(up)) <= max_depth:
+                        prev = up[-1]
+                        up.append(array('i', [prev[prev[w]] for w in xrange(n)]))
+                self.parents = parents
+                self.depths = depths
+                self.tops = tops
+                self.cycle_ids = cycle_ids
+                self.up = up
+
+        def lca(self, idx1, idx2):
+                """Return the lowest common ancestor of two words, or -1 if they are
+                not in the same tree."""
+                if self.tops[idx1] != self.tops[idx2]:
+                        return -1
+                depths = self.depths
+                if depths[idx1] < depths[idx2]:
+                        idx1, idx2 = idx2, idx1
+                diff = depths[idx1] - depths[idx2]
+                k = 0
+                while diff:
+                        if diff & 1:
+                                idx1 = self.up[k][idx1]
+                        diff >>= 1
+                        k += 1
+                if idx1 == idx2:
+                        return idx1
+                for level in reversed(self.up):
+                        if level[idx1] != level[idx2]:
+                                idx1, idx2 = level[idx1], level[idx2]
+                return self.up[0][idx1]
+
+        def path(self, idx1, idx2):
+                """Return the words on the dependency path between two words.
+
+                Returns:
+                    A pair of lists of word indices: the words walked up from idx1
+                    and the words walked up from idx2, in walking order. Each word
+                    stands for the edge to its parent.
+                """
+                top1, top2 = self.tops[idx1], self.tops[idx2]
+                depths = self.depths
+                if top1 == top2:
+                        common = depths[self.lca(idx1, idx2)]
+                        return (self._walk(idx1, depths[idx1] - common),
+                                self._walk(idx2, depths[idx2] - common))
+                left = self._walk(idx1, depths[idx1])
+                right = self._walk(idx2, depths[idx2])
+                if self.cycle_ids[top1] == -1 or self.cycle_ids[top1] != self.cycle_ids[top2]:
+                        # No word in common: both walks go all the way around.
+                        left.extend(self._terminal(top1))
+                        right.extend(self._terminal(top2))
+                return left, right
+
+        def distance(self, idx1, idx2):
+                """Return the number of edges on the dependency path between two
+                words."""
+                top1, top2 = self.tops[idx1], self.tops[idx2]
+                depths = self.depths
+                distance = depths[idx1] + depths[idx2]
+                if top1 == top2:
+                        return distance - 2 * depths[self.lca(idx1, idx2)]
+                if self.cycle_ids[top1] == -1 or self.cycle_ids[top1] != self.cycle_ids[top2]:
+                        distance += len(self._terminal(top1)) + len(self._terminal(top2))
+                return distance
+
+        def distance_matrix(self, rows=None, columns=None):
+                """Return the distance between every pair of words as an n x n
+                NumPy int16 array, with the same values as distance().
+
+                Each word is given the row of its ancestors (itself included) in
+                an n x n matrix, filled one depth at a time from the row of its
+                parent. The ancestors two words of a tree have in common are the
+                words from the top of the tree down to their lowest common
+                ancestor, so the product of the matrix by its transpose gives the
+                depth of the lowest common ancestor of every pair at once, in
+                O(n^2) memory.
+
+                Args:
+                    rows: (optional) the indices of the words of the rows, all the
+                        words by default
+                    columns: (optional) the indices of the words of the columns,
+                        all the words by default
+                """
+                import numpy
+                n = len(self.parents)
+                shape = (n if rows is None else len(rows), n if columns is None else len(columns))
+                if not shape[0] or not shape[1]:
+                        return numpy.zeros(shape, dtype=numpy.int16)
+                depths = numpy.frombuffer(self.depths, dtype=numpy.intc)
+                parents = numpy.frombuffer(self.parents, dtype=numpy.intc)
+                # float32 uses the BLAS product, and is exact for these counts.
+                ancestors = numpy.zeros((n, n), dtype=numpy.float32)
+                by_depth = numpy.argsort(depths, kind='mergesort')
+                bounds = numpy.searchsorted(depths[by_depth], numpy.arange(depths.max() + 2))
+                for depth in xrange(len(bounds) - 1):
+                        words = by_depth[bounds[depth]:bounds[depth + 1]]
+                        if depth:
+                                ancestors[words] = ancestors[parents[words]]
+                        ancestors[words, words] = 1
+                if rows is None:
+                        rows = slice(None)
+                if columns is None:
+                        columns = slice(None)
+                common = numpy.dot(ancestors[rows], ancestors[columns].T).astype(numpy.intc)
+                row_depths = depths[rows][:, None]
+                column_depths = depths[columns][None, :]
+                distances = row_depths + column_depths - 2 * (common - 1)
+                same_tree = common > 0
+                if not same_tree.all():
+                        # The cycle of the top of each word (-1 for a root), and the
+                        # number of words walked at the top (see _terminal)
+                        cycle_ids = numpy.frombuffer(self.cycle_ids, dtype=numpy.intc)
+                        cycle_sizes = numpy.bincount(cycle_ids[cycle_ids >= 0], minlength=1)
+                        cycle_ids = cycle_ids[numpy.frombuffer(self.tops, dtype=numpy.intc)]
+                        terminal_lengths = numpy.where(cycle_ids >= 0, cycle_sizes[cycle_ids], 1)
+                        row_cycles = cycle_ids[rows][:, None]
+                        same_cycle = (row_cycles == cycle_ids[columns][None, :]) & (row_cycles != -1)
+                        apart = row_depths + column_depths + ~same_cycle * (
+                                terminal_lengths[rows][:, None] + terminal_lengths[columns][None, :])
+                        distances = numpy.where(same_tree, distances, apart)
+                return distances.astype(numpy.int16)
+
+        def _walk(self, idx, length):
+                rs = []
+                parents = self.parents
+                for _ in xrange(length):
+                        rs.append(idx)
+                        idx = parents[idx]
+                return rs
+
+        def _terminal(self, top):
+                # The words a walk visits once it reaches the top of its tree.
+                rs = [top]
+                if self.cycle_ids[top] != -1:
+                        c = self.parents[top]
+                        while c != top:
+                                rs.append(c)
+                                c = self.parents[c]
+                return rs
+
+
+def dep_distance_matrix(words, rows=None, columns=None):
+        """Given a sequence of Word objects, return the length of the dependency
+        path between every pair of words, computed in one pass.
+
+        Requires NumPy. The matrix takes O(n^2) memory: for long sentences where
+        only a few pairs are needed, give their words as rows and columns.
+
+        Args:
+            words: A sequence of Word objects.
+            rows: (optional) the indices of the words of the rows, all by default
+            columns: (optional) the indices of the words of the columns, all by
+                default
+
+        Returns:
+            An n x n NumPy int16 array whose [i, j] entry is
+            len(dep_path_between_words(words, i, j)), or the entries of rows x
+            columns.
+        """
+        if isinstance(words, Sentence):
+                return words.dep_index.distance_matrix(rows, columns)
+        return DepIndex([word.dep_par for word in words]).distance_matrix(rows, columns)
+
+def min_dep_distance_pair(distances, span1, span2):
+        """Given a distance matrix from dep_distance_matrix and two spans, return
+        the pair of word indices, one in each span, with the shortest dependency
+        path between them.
+
+        Args:
+            distances: A matrix returned by dep_distance_matrix.
+            span1: A Span namedtuple
+            span2: A Span namedtuple
+
+        Returns:
+            A tuple (index in span1, index in span2), or None if a span is empty.
+            Ties go to the first pair in row-major order.
+        """
+        block = distances[span1.begin_word_id:span1.begin_word_id + span1.length,
+                span2.begin_word_id:span2.begin_word_id + span2.length]
+        if block.size == 0:
+                return None
+        i, j = divmod(int(block.argmin()), block.shape[1])
+        return (span1.begin_word_id + i, span2.begin_word_id + j)
 
 def dep_path_between_words(words, begin_idx, end_idx):
         """Given a sequence of Word objects and two indices, return the sequence of Edges
@@ -106,20 +914,24 @@ def dep_path_between_words(words, begin_idx, end_idx):
         Returns:
             An Array of Edge objects, each of which corresponds to one edge on the dependency path.
         """
-        path_to_root1 = _path_to_root(words, begin_idx)
-        path_to_root2 = _path_to_root(words, end_idx)
-        common = set(path_to_root1) & set(path_to_root2)
-        #if len(common) == 0:
-        #       raise Exception('Dep Path Must be Wrong: No Common Element Between Word %d & %d.' % (begin_idx, end_idx))
+        if isinstance(words, Sentence):
+                index = words.dep_index
+                word_at = words._word
+                dep_labels = words.dep_labels
+        else:
+                index = DepIndex([word.dep_par for word in words])
+                word_at = words.__getitem__
+                dep_labels = [word.dep_label for word in words]
+        # Parents outside the sentence are -1 in the index, as in the walk.
+        dep_pars = index.parents
+        if begin_idx < 0:
+                begin_idx += len(words)
+        if end_idx < 0:
+                end_idx += len(words)
+        left, right = index.path(begin_idx, end_idx)
         path = []
-        for word in path_to_root1:
-                if word in common: break
-                path.append(DepEdge(word1=word, word2=words[word.dep_par], label=word.dep_label, is_bottom_up=True))
-        path_right = []
-        for word in path_to_root2:
-                if word in common: break
-                path_right.append(DepEdge(word1=words[word.dep_par], word2=word, label=word.dep_label, is_bottom_up=False))
-        for e in reversed(path_right):
-                path.append(e)
+        for idx in left:
+                path.append(DepEdge(word1=word_at(idx), word2=word_at(dep_pars[idx]), label=dep_labels[idx], is_bottom_up=True))
+        for idx in reversed(right):
+                path.append(DepEdge(word1=word_at(dep_pars[idx]), word2=word_at(idx), label=dep_labels[idx], is_bottom_up=False))
         return path
-
@@ -3,24 +3,85 @@
 # This file contains the generic features library that is included with ddlib.
 #
 # The three functions that a user should want to use are load_dictionary,
-# get_generic_features_mention, and get_generic_features_relation.
+# get_generic_features_mention, and get_generic_features_relation (or
+# get_generic_features_sentence, to get the features of all the mentions or
+# pairs of mentions of a sentence at once).
 # All the rest should be considered more or less private, except perhaps the
 # get_sentence method, which is actually just a wrapper around unpack_words.
 #
 # Matteo, December 2014
 #
 
-from dd import dep_path_between_words, materialize_span, Span, unpack_words
+import os
+import sys
+import time
+import collections
+import multiprocessing.util
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from dd import dep_path_between_words, materialize_span, Span, unpack_words, \
+    dep_graph_parser_parenthesis, dep_graph_parser_triplet, Sentence, DepIndex, \
+    normalize_lemma, to_strings, min_dep_distance_pair, _close_at_exit
+from matcher import PhraseMatcher
+from compile_dict import CompiledDictionary, is_compiled_dictionary
+from hashing import FeatureHasher, hash_feature
 
 MAX_KW_LENGTH = 3
 
-dictionaries = dict()
+# The number of pairs of words, times the number of words of the sentence, of
+# which the shortest dependency paths are looked for one by one before they
+# are looked up in the distance matrix of the sentence
+DEP_MATRIX_PAIRS = 4
+
+# The PhraseMatcher for the dictionaries, and the DICT_ substitution of each
+# phrase (the first dictionary containing it), built when they are first
+# needed after the dictionaries changed
+_matcher = None
+_substitutions = None
+
+
+def _invalidating(method):
+    """Wrap a method of dict that changes it, so that the matcher of the
+    dictionaries is built again."""
+    def changed(self, *args, **kwargs):
+        global _matcher, _substitutions
+        _matcher = _substitutions = None
+        return method(self, *args, **kwargs)
+    changed.__name__ = method.__name__
+    return changed
+
+
+class _Dictionaries(dict):
+    """The dictionaries, by dict_id. Any change to it (by load_dictionary or
+    directly) drops the matcher, instead of checking every dictionary for
+    changes at each lookup."""
 
+    __setitem__ = _invalidating(dict.__setitem__)
+    __delitem__ = _invalidating(dict.__delitem__)
+    clear = _invalidating(dict.clear)
+    pop = _invalidating(dict.pop)
+    popitem = _invalidating(dict.popitem)
+    setdefault = _invalidating(dict.setdefault)
+    update = _invalidating(dict.update)
 
-def load_dictionary(filename, dict_id="", func=lambda x: x):
+
+dictionaries = _Dictionaries()
+
+
+def load_dictionary(filename, dict_id="", func=None):
     """Load a dictionary to be used for generic features.
 
-    Returns the id used to identify the dictionary.
+    Returns the id used to identify the dictionary. All the dictionaries are
+    matched at once in a sentence by a PhraseMatcher, which is built again
+    after a dictionary is loaded or the dictionaries dict is changed.
+
+    The file can also be a dictionary compiled with ddlib.compile_dict, which
+    is mapped in memory instead of being read. func was then applied when
+    compiling it, and must be either omitted or the same function.
 
     Args:
         filename: full path to the dictionary. The dictionary is actually a set
@@ -31,6 +92,14 @@ def load_dictionary(filename, dict_id="", func=lambda x: x):
     """
     if dict_id == "":
         dict_id = str(len(dictionaries))
+    if is_compiled_dictionary(filename):
+        dictionary = CompiledDictionary(filename)
+        if func is not None:
+            dictionary.check_func(func)
+        dictionaries[str(dict_id)] = dictionary
+        return str(dict_id)
+    if func is None:
+        func = lambda x: x
     with open(filename, 'rt') as dict_file:
         dictionary = set()
         for line in dict_file:
@@ -40,55 +109,175 @@ def load_dictionary(filename, dict_id="", func=lambda x: x):
     return str(dict_id)
 
 
-def get_generic_features_mention(sentence, span, length_bin_size=5):
+class FeatureTemplate(object):
+    """Which families of generic features to generate, and how.
+
+    The families are:
+        - seq: the words, lemmas, NER and POS tags of a mention, or between
+          the mentions of a relation (WORD_SEQ, LEMMA_SEQ, NER_SEQ, POS_SEQ)
+        - window: the lemmas and NER tags around the mention(s) (W_)
+        - ngram: the ngrams of lemmas between the mentions of a relation
+          (NGRAM)
+        - dictionary: whether the mention(s) are in a dictionary (IN_DICT)
+        - dep_path: the dependency path between the mentions of a relation
+          (BETW)
+        - keyword: the dictionary keywords in the sentence and the dependency
+          paths to them (KW_IND, KW)
+        - capital: whether the mention(s) start with a capital letter
+          (STARTS_WITH_CAPITAL)
+        - length: the length of the mention(s) (LENGTH, LENGTHS)
+    """
+
+    FAMILIES = ("seq", "window", "ngram", "dictionary", "dep_path", "keyword",
+                "capital", "length")
+
+    def __init__(self, seq=True, window=True, ngram=True, dictionary=True,
+                 dep_path=True, keyword=True, capital=True, length=True,
+                 window_size=3, ngram_size=3, profile=False):
+        """
+        Args:
+            seq, window, ngram, dictionary, dep_path, keyword, capital,
+                length: whether to generate each family of features
+            window_size: the maximum size of the windows around the mentions
+            ngram_size: the maximum size of the ngrams between the mentions
+            profile: whether to measure the time spent on each family and the
+                number of features it yields. The totals are written to stderr
+                when the process exits.
+        """
+        self.seq = seq
+        self.window = window
+        self.ngram = ngram
+        self.dictionary = dictionary
+        self.dep_path = dep_path
+        self.keyword = keyword
+        self.capital = capital
+        self.length = length
+        self.window_size = window_size
+        self.ngram_size = ngram_size
+        self.profile = profile
+
+
+class FeatureProfiler(object):
+    """Cumulative time spent and number of features yielded by each family of
+    generic features, for templates with profile=True."""
+
+    def __init__(self, stream=None):
+        """
+        Args:
+            stream: where to write the report, sys.stderr by default
+        """
+        self.stream = stream
+        self.times = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        _close_at_exit(self)
+        multiprocessing.util.register_after_fork(
+            self, FeatureProfiler._forked)
+
+    def record(self, family, seconds, count):
+        self.times[family] += seconds
+        self.counts[family] += count
+
+    def report(self):
+        """Write the totals of each family, most expensive first."""
+        if not self.times:
+            return
+        stream = self.stream if self.stream is not None else sys.stderr
+        total = sum(self.times.values())
+        stream.write("ddlib.gen_feats profile (pid %d):\n" % os.getpid())
+        for family in sorted(self.times, key=self.times.get, reverse=True):
+            stream.write("  %-10s %9.3fs %5.1f%% %10d features\n" % (
+                family, self.times[family],
+                100.0 * self.times[family] / total if total else 0.0,
+                self.counts[family]))
+        stream.flush()
+
+    def close(self):
+        """Write the report, as done when the process exits."""
+        self.report()
+
+    def _forked(self):
+        # A worker reports what it generated itself.
+        self.times.clear()
+        self.counts.clear()
+        _close_at_exit(self)
+
+
+_default_template = FeatureTemplate()
+_profiler = FeatureProfiler()
+
+
+def get_generic_features_mention(
+        sentence, span, length_bin_size=5, hasher=None, template=None):
     """Yield 'generic' features for a mention in a sentence.
 
     Args:
         sentence: a list of Word objects
         span: a Span namedtuple
         length_bin_size: the size of the bins for the length feature
+        hasher: (optional) a FeatureHasher. If given, the 64-bit ids of the
+            features are yielded instead of the features.
+        template: (optional) a FeatureTemplate selecting the families of
+            features to generate. By default all of them are.
     """
-    # Mention sequence features (words, lemmas, ners, and poses)
-    for seq_feat in _get_seq_features(sentence, span):
-        yield seq_feat
-    # Window (left and right, up to size 3, with combinations) around the
-    # mention
-    for window_feat in _get_window_features(sentence, span):
-        yield window_feat
-    # Is (substring of) mention in a dictionary?
-    for dict_indicator_feat in _get_dictionary_indicator_features(
-            sentence, span):
-        yield dict_indicator_feat
+    features = _get_mention_features(
+        _SentenceContext(sentence), span, length_bin_size, template)
+    if hasher is not None:
+        features = hasher.hash_all(features)
+    for feature in features:
+        yield feature
+
+
+def _get_mention_features(context, span, length_bin_size, template=None):
+    """Yield the features of get_generic_features_mention, using the
+    sentence-wide artifacts of a _SentenceContext."""
+    if template is None:
+        template = _default_template
+    sentence = context.sentence
+
     # Dependency path(s) from mention to keyword(s). Various transformations of
     # the dependency path are done.
-    for (i, j) in _get_substring_indices(len(sentence), MAX_KW_LENGTH):
-        if i >= span.begin_word_id and i < span.begin_word_id + span.length:
-            continue
-        if j > span.begin_word_id and j < span.begin_word_id + span.length:
-            continue
-        is_in_dictionary = False
-        for dict_id in dictionaries:
-            if " ".join(map(lambda x: str(x.lemma), sentence[i:j])) in \
-                    dictionaries[dict_id]:
-                is_in_dictionary = True
-                yield "KW_IND_[" + dict_id + "]"
-                break
-        if is_in_dictionary:
+    def keyword():
+        for (i, j, dict_ids) in context.keyword_matches():
+            if i >= span.begin_word_id and \
+                    i < span.begin_word_id + span.length:
+                continue
+            if j > span.begin_word_id and j < span.begin_word_id + span.length:
+                continue
+            yield "KW_IND_[" + dict_ids[0] + "]"
             kw_span = Span(begin_word_id=i, length=j-i)
             for dep_path_feature in _get_min_dep_path_features(
-                    sentence, span, kw_span, "KW"):
+                    sentence, span, kw_span, "KW", context):
                 yield dep_path_feature
+
     # The mention starts with a capital
-    if sentence[span.begin_word_id].word[0].isupper():
-        yield "STARTS_WITH_CAPITAL"
+    def capital():
+        if sentence[span.begin_word_id].word[0].isupper():
+            yield "STARTS_WITH_CAPITAL"
+
     # Length of the mention
-    length = len(" ".join(materialize_span(sentence, span, lambda x: x.word)))
-    bin_id = length // length_bin_size
-    length_feat = "LENGTH_" + str(bin_id)
-    yield length_feat
+    def length():
+        length = len(" ".join(
+            materialize_span(sentence, span, lambda x: x.word)))
+        bin_id = length // length_bin_size
+        yield "LENGTH_" + str(bin_id)
+
+    return _get_family_features(template, (
+        # Mention sequence features (words, lemmas, ners, and poses)
+        ("seq", lambda: context.features(_get_seq_features, span)),
+        # Window (left and right, up to size 3, with combinations) around the
+        # mention
+        ("window", lambda: context.features(
+            _get_window_features, span, template.window_size)),
+        # Is (substring of) mention in a dictionary?
+        ("dictionary", lambda: context.dictionary_indicator_features(span)),
+        ("keyword", keyword),
+        ("capital", capital),
+        ("length", length)))
 
 
-def get_generic_features_relation(sentence, span1, span2, length_bin_size=5):
+def get_generic_features_relation(
+        sentence, span1, span2, length_bin_size=5, hasher=None,
+        template=None):
     """Yield 'generic' features for a relation in a sentence.
 
     Args:
@@ -96,7 +285,70 @@ def get_generic_features_relation(sentence, span1, span2, length_bin_size=5):
         span1: the first Span of the relation
         span2: the second Span of the relation
         length_bin_size: the size of the bins for the length feature
+        hasher: (optional) a FeatureHasher. If given, the 64-bit ids of the
+            features are yielded instead of the features.
+        template: (optional) a FeatureTemplate selecting the families of
+            features to generate. By default all of them are.
+    """
+    features = _get_relation_features(
+        _SentenceContext(sentence), span1, span2, length_bin_size, template)
+    if hasher is not None:
+        features = hasher.hash_all(features)
+    for feature in features:
+        yield feature
+
+
+def get_generic_features_sentence(
+        sentence, mentions, pairs=None, length_bin_size=5, hasher=None,
+        template=None):
+    """Yield 'generic' features for all the mentions, or all the pairs of
+    mentions, of a sentence, as (id, feature) tuples.
+
+    The features are the same as those of get_generic_features_mention (or
+    get_generic_features_relation), but what they have in common, such as the
+    dictionary matches in the sentence, the features of each span and the
+    dependency paths between spans, is computed only once.
+
+    Args:
+        sentence: a list of Word objects
+        mentions: a dict, or a sequence of (mention_id, span) pairs, mapping
+            the id of each mention to its Span
+        pairs: (optional) a sequence of (pair_id, mention_id1, mention_id2)
+            tuples. If given, the relation features of each pair are yielded
+            as (pair_id, feature) tuples; otherwise the mention features of
+            each mention are yielded as (mention_id, feature) tuples.
+        length_bin_size: the size of the bins for the length features
+        hasher: (optional) a FeatureHasher. If given, the 64-bit ids of the
+            features are yielded instead of the features.
+        template: (optional) a FeatureTemplate selecting the families of
+            features to generate. By default all of them are.
     """
+    context = _SentenceContext(sentence)
+    if pairs is None:
+        if isinstance(mentions, dict):
+            mentions = mentions.iteritems()
+        groups = ((mention_id, _get_mention_features(
+            context, span, length_bin_size, template))
+            for mention_id, span in mentions)
+    else:
+        spans = dict(mentions)
+        groups = ((pair_id, _get_relation_features(
+            context, spans[mention_id1], spans[mention_id2], length_bin_size,
+            template)) for pair_id, mention_id1, mention_id2 in pairs)
+    for group_id, features in groups:
+        if hasher is not None:
+            features = hasher.hash_all(features)
+        for feature in features:
+            yield (group_id, feature)
+
+
+def _get_relation_features(
+        context, span1, span2, length_bin_size, template=None):
+    """Yield the features of get_generic_features_relation, using the
+    sentence-wide artifacts of a _SentenceContext."""
+    if template is None:
+        template = _default_template
+    sentence = context.sentence
     # Check whether the order of the spans is inverted. We use this information
     # to add a prefix to *all* the features.
     order = sorted([
@@ -108,111 +360,303 @@ def get_generic_features_relation(sentence, span1, span2, length_bin_size=5):
     end = order[3]
     if begin == span2.begin_word_id:
         inverted = "INV_"
-        yield "IS_INVERTED"
     else:
         inverted = ""
     betw_span = Span(begin_word_id=betw_begin, length=betw_end - betw_begin)
     covering_span = Span(begin_word_id=begin, length=end - begin)
+
+    def is_inverted():
+        if inverted:
+            yield "IS_INVERTED"
+
     # Words, Lemmas, Ners, and Poses sequence between the mentions
-    for seq_feat in _get_seq_features(sentence, betw_span):
-        yield inverted + seq_feat
+    def seq():
+        for seq_feat in context.features(_get_seq_features, betw_span):
+            yield inverted + seq_feat
+
     # Window feature (left and right, up to size 3, combined)
-    for window_feat in _get_window_features(
-            sentence, covering_span, isolated=False):
-        yield inverted + window_feat
+    def window():
+        for window_feat in context.features(
+                _get_window_features, covering_span, template.window_size,
+                True, False):
+            yield inverted + window_feat
+
     # Ngrams of up to size 3 between the mentions
-    for ngram_feat in _get_ngram_features(sentence, betw_span):
-        yield inverted + ngram_feat
+    def ngram():
+        for ngram_feat in context.features(
+                _get_ngram_features, betw_span, template.ngram_size):
+            yield inverted + ngram_feat
+
     # Indicator features of whether the mentions are in dictionaries
-    found1 = False
-    for feat1 in _get_dictionary_indicator_features(
-            sentence, span1, prefix=inverted + "IN_DICT"):
-        found1 = True
-        found2 = False
-        for feat2 in _get_dictionary_indicator_features(
-                sentence, span2, prefix=""):
-            found2 = True
-            yield feat1 + feat2
-        if not found2:
-            yield feat1 + "_[_NONE]"
-    if not found1:
-        for feat2 in _get_dictionary_indicator_features(
-                sentence, span2, prefix=""):
-            found2 = True
-            yield inverted + "IN_DICT_[_NONE]" + feat2
+    def dictionary():
+        feats2 = context.dictionary_indicator_features(span2, prefix="")
+        found1 = False
+        for feat1 in context.dictionary_indicator_features(
+                span1, prefix=inverted + "IN_DICT"):
+            found1 = True
+            for feat2 in feats2:
+                yield feat1 + feat2
+            if not feats2:
+                yield feat1 + "_[_NONE]"
+        if not found1:
+            for feat2 in feats2:
+                yield inverted + "IN_DICT_[_NONE]" + feat2
+
     # Dependency path (and transformations) between the mention
-    for betw_dep_path_feature in _get_min_dep_path_features(
-            sentence, span1, span2, inverted + "BETW"):
-        yield betw_dep_path_feature
+    def dep_path():
+        return _get_min_dep_path_features(
+            sentence, span1, span2, inverted + "BETW", context)
+
     # Dependency paths (and transformations) between the mentions and keywords
-    for (i, j) in _get_substring_indices(len(sentence), MAX_KW_LENGTH):
-        if (i >= begin and i < betw_begin) or (i >= betw_end and i < end):
-            continue
-        if (j > begin and j <= betw_begin) or (j > betw_end and j <= end):
-            continue
-        is_in_dictionary = False
-        for dict_id in dictionaries:
-            if " ".join(map(lambda x: str(x.lemma), sentence[i:j])) in \
-                    dictionaries[dict_id]:
-                is_in_dictionary = True
-                yield inverted + "KW_IND_[" + dict_id + "]"
-                break
-        if is_in_dictionary:
+    def keyword():
+        for (i, j, dict_ids) in context.keyword_matches():
+            if (i >= begin and i < betw_begin) or \
+                    (i >= betw_end and i < end):
+                continue
+            if (j > begin and j <= betw_begin) or \
+                    (j > betw_end and j <= end):
+                continue
+            yield inverted + "KW_IND_[" + dict_ids[0] + "]"
             kw_span = Span(begin_word_id=i, length=j-i)
-            path1 = _get_min_dep_path(sentence, span1, kw_span)
-            lemmas1 = []
-            labels1 = []
-            for edge in path1:
-                lemmas1.append(str(edge.word2.lemma))
-                labels1.append(edge.label)
-            both1 = []
-            for j in range(len(labels1)):
-                both1.append(labels1[j])
-                both1.append(lemmas1[j])
-            both1 = both1[:-1]
-            path2 = _get_min_dep_path(sentence, span2, kw_span)
-            lemmas2 = []
-            labels2 = []
-            for edge in path2:
-                lemmas2.append(str(edge.word2.lemma))
-                labels2.append(edge.label)
-            both2 = []
-            for j in range(len(labels2)):
-                both2.append(labels2[j])
-                both2.append(lemmas2[j])
-            both2 = both2[:-1]
-            yield inverted + "KW_[" + " ".join(both1) + "]_[" + \
-                " ".join(both2) + "]"
-            yield inverted + "KW_L_[" + " ".join(labels1) + "]_[" + \
-                " ".join(labels2) + "]"
-            for j in range(1, len(both1), 2):
-                for dict_id in dictionaries:
-                    if both1[j] in dictionaries[dict_id]:
-                        both1[j] = "DICT_" + str(dict_id)
-                        break  # Picking up the first dictionary we find
-            for j in range(1, len(both2), 2):
-                for dict_id in dictionaries:
-                    if both2[j] in dictionaries[dict_id]:
-                        both2[j] = "DICT_" + str(dict_id)
-                        break  # Picking up the first dictionary we find
-            yield inverted + "KW_D_[" + " ".join(both1) + "]_[" + \
-                " ".join(both2) + "]"
+            both1, labels1, dict_both1 = context.min_dep_path_strings(
+                span1, kw_span, str_labels=False)
+            both2, labels2, dict_both2 = context.min_dep_path_strings(
+                span2, kw_span, str_labels=False)
+            yield inverted + "KW_[" + both1 + "]_[" + both2 + "]"
+            yield inverted + "KW_L_[" + labels1 + "]_[" + labels2 + "]"
+            yield inverted + "KW_D_[" + dict_both1 + "]_[" + dict_both2 + \
+                "]"
+
     # The mentions start with a capital letter
-    first_capital = sentence[span1.begin_word_id].word[0].isupper()
-    second_capital = sentence[span2.begin_word_id].word[0].isupper()
-    capital_feat = inverted + "STARTS_WITH_CAPITAL_[" + str(first_capital) + \
-        "_" + str(second_capital) + "]"
-    yield capital_feat
+    def capital():
+        first_capital = sentence[span1.begin_word_id].word[0].isupper()
+        second_capital = sentence[span2.begin_word_id].word[0].isupper()
+        yield inverted + "STARTS_WITH_CAPITAL_[" + str(first_capital) + \
+            "_" + str(second_capital) + "]"
+
     # The lengths of the mentions
-    first_length = len(" ".join(materialize_span(
-        sentence, span1, lambda x: str(x.word))))
-    second_length = len(" ".join(materialize_span(
-        sentence, span2, lambda x: str(x.word))))
-    first_bin_id = first_length // length_bin_size
-    second_bin_id = second_length // length_bin_size
-    length_feat = inverted + "LENGTHS_[" + str(first_bin_id) + "_" + \
-        str(second_bin_id) + "]"
-    yield length_feat
+    def length():
+        first_length = len(" ".join(materialize_span(
+            sentence, span1, lambda x: str(x.word))))
+        second_length = len(" ".join(materialize_span(
+            sentence, span2, lambda x: str(x.word))))
+        first_bin_id = first_length // length_bin_size
+        second_bin_id = second_length // length_bin_size
+        yield inverted + "LENGTHS_[" + str(first_bin_id) + "_" + \
+            str(second_bin_id) + "]"
+
+    return _get_family_features(template, (
+        (None, is_inverted),
+        ("seq", seq),
+        ("window", window),
+        ("ngram", ngram),
+        ("dictionary", dictionary),
+        ("dep_path", dep_path),
+        ("keyword", keyword),
+        ("capital", capital),
+        ("length", length)))
+
+
+def _get_family_features(template, families):
+    """Yield the features of the families enabled in the template.
+
+    Args:
+        template: a FeatureTemplate
+        families: a sequence of (family, function) pairs, where the function
+            returns the features of the family. A family of None is always
+            enabled.
+    """
+    for family, generate in families:
+        if family is not None and not getattr(template, family):
+            continue
+        if not template.profile or family is None:
+            for feature in generate():
+                yield feature
+            continue
+        start = time.time()
+        features = list(generate())
+        _profiler.record(family, time.time() - start, len(features))
+        for feature in features:
+            yield feature
+
+
+class _SentenceContext(object):
+    """The artifacts of the generic features that do not depend on the
+    mentions, computed once for a sentence and shared by all its mentions and
+    pairs of mentions."""
+
+    def __init__(self, sentence):
+        self.sentence = sentence
+        self._lemma_strings = None
+        self._normalized_lemmas = None
+        self._ner_strings = None
+        self._matches = None
+        self._keyword_matches = None
+        self._features = {}
+        self._dep_index = None
+        self._dep_distances = None
+        self._dep_pairs = 0
+        self._min_dep_paths = {}
+        self._min_dep_path_strings = {}
+
+    def lemma_strings(self):
+        """Return the lemmas of the sentence, converted with to_strings."""
+        if self._lemma_strings is None:
+            if isinstance(self.sentence, Sentence):
+                self._lemma_strings = self.sentence.lemma_strings
+            else:
+                self._lemma_strings = to_strings(
+                    [word.lemma for word in self.sentence])
+        return self._lemma_strings
+
+    def normalized_lemmas(self):
+        """Return the lemmas of the sentence, converted with to_strings, with
+        the numbers replaced by _NUMBER."""
+        if self._normalized_lemmas is None:
+            if isinstance(self.sentence, Sentence):
+                self._normalized_lemmas = self.sentence.normalized_lemmas
+            else:
+                self._normalized_lemmas = map(
+                    normalize_lemma, self.lemma_strings())
+        return self._normalized_lemmas
+
+    def ner_strings(self):
+        """Return the NER tags of the sentence, converted with to_strings."""
+        if self._ner_strings is None:
+            if isinstance(self.sentence, Sentence):
+                self._ner_strings = self.sentence.ner_strings
+            else:
+                self._ner_strings = to_strings(
+                    [word.ner for word in self.sentence])
+        return self._ner_strings
+
+    def dictionary_matches(self):
+        """Return _get_dictionary_matches(sentence)."""
+        if self._matches is None:
+            if dictionaries:
+                self._matches = _get_dictionary_matcher().find(
+                    self.lemma_strings())
+            else:
+                self._matches = []
+        return self._matches
+
+    def keyword_matches(self):
+        """Return _get_keyword_matches(sentence)."""
+        if self._keyword_matches is None:
+            self._keyword_matches = _get_keyword_matches(
+                self.sentence, self.dictionary_matches())
+        return self._keyword_matches
+
+    def features(self, func, *args):
+        """Return the features yielded by func(sentence, *args, context) as a
+        list, computed only once for the same func and args."""
+        key = (func, args)
+        features = self._features.get(key)
+        if features is None:
+            features = self._features[key] = list(
+                func(self.sentence, *args, context=self))
+        return features
+
+    def dictionary_indicator_features(self, span, prefix="IN_DICT"):
+        """Return the features of _get_dictionary_indicator_features as a
+        list."""
+        # They only depend on the length of the span.
+        key = (_get_dictionary_indicator_features, span.length, prefix)
+        features = self._features.get(key)
+        if features is None:
+            features = self._features[key] = list(
+                _get_dictionary_indicator_features(
+                    self.sentence, span, prefix=prefix,
+                    matches=self.dictionary_matches()))
+        return features
+
+    def dep_index(self):
+        """Return the DepIndex of the sentence."""
+        if self._dep_index is None:
+            if isinstance(self.sentence, Sentence):
+                self._dep_index = self.sentence.dep_index
+            else:
+                self._dep_index = DepIndex(
+                    [word.dep_par for word in self.sentence])
+        return self._dep_index
+
+    def min_dep_path(self, span1, span2):
+        """Return the shortest dependency path between two Span objects, as a
+        list of DepEdge objects, or None if a span is empty.
+
+        Among the pairs of words (one in each span) at the shortest distance,
+        the path of the first one (in the order of the words of span1, then of
+        span2) is returned.
+
+        The distances of the pairs are computed one by one until the spans
+        asked for have had as many pairs of words as DEP_MATRIX_PAIRS times
+        the number of words of the sentence, about what computing the
+        distance matrix of the sentence (see DepIndex.distance_matrix) costs.
+        After that, they are looked up in the matrix with
+        min_dep_distance_pair.
+        """
+        key = (span1, span2)
+        if key not in self._min_dep_paths:
+            index = self.dep_index()
+            n = len(index.parents)
+            n_pairs = span1.length * span2.length
+            if n_pairs > 1 and self._dep_distances is None and np is not None:
+                self._dep_pairs += n_pairs
+                if self._dep_pairs >= DEP_MATRIX_PAIRS * n:
+                    self._dep_distances = index.distance_matrix()
+            if n_pairs > 1 and self._dep_distances is not None and \
+                    0 <= span1.begin_word_id and \
+                    span1.begin_word_id + span1.length <= n and \
+                    0 <= span2.begin_word_id and \
+                    span2.begin_word_id + span2.length <= n:
+                min_pair = min_dep_distance_pair(
+                    self._dep_distances, span1, span2)
+            else:
+                min_pair = None
+                min_distance = None
+                for i in range(span1.begin_word_id,
+                               span1.begin_word_id + span1.length):
+                    for j in range(span2.begin_word_id,
+                                   span2.begin_word_id + span2.length):
+                        distance = index.distance(i, j)
+                        if min_distance is None or distance < min_distance:
+                            min_pair = (i, j)
+                            min_distance = distance
+            self._min_dep_paths[key] = dep_path_between_words(
+                self.sentence, *min_pair) if min_pair is not None else None
+        return self._min_dep_paths[key]
+
+    def min_dep_path_strings(self, span1, span2, str_labels=True):
+        """Return the strings of the shortest dependency path between two Span
+        objects used by the features: the labels and lemmas of the path, the
+        labels only, and the labels and lemmas with the lemmas that are in a
+        dictionary replaced by DICT_ and the id of the (first) dictionary.
+
+        Args:
+            span1: the first Span
+            span2: the second Span
+            str_labels: whether to convert the labels with str()
+        """
+        key = (span1, span2, str_labels)
+        strings = self._min_dep_path_strings.get(key)
+        if strings is None:
+            path = self.min_dep_path(span1, span2)
+            lemmas = [str(edge.word2.lemma) for edge in path]
+            if str_labels:
+                labels = [str(edge.label) for edge in path]
+            else:
+                labels = [edge.label for edge in path]
+            both = []
+            for label, lemma in zip(labels, lemmas):
+                both.append(label)
+                both.append(lemma)
+            both = both[:-1]
+            dict_both = list(both)
+            for j in range(1, len(dict_both), 2):
+                dict_both[j] = _get_dictionary_substitution(dict_both[j])
+            strings = self._min_dep_path_strings[key] = (
+                " ".join(both), " ".join(labels), " ".join(dict_both))
+        return strings
 
 
 def _get_substring_indices(_len, max_substring_len):
@@ -224,7 +668,7 @@ def _get_substring_indices(_len, max_substring_len):
             yield (start, end)
 
 
-def _get_ngram_features(sentence, span, window=3):
+def _get_ngram_features(sentence, span, window=3, context=None):
     """Yields ngram features. These are all substrings of size up to window in
     the part of the sentence covered by the span.
 
@@ -236,12 +680,57 @@ def _get_ngram_features(sentence, span, window=3):
         sentence: a list of Word objects
         span: the Span identifying the area for generating the substrings
         window: maximum size of a substring
+        context: (optional) the _SentenceContext of the sentence
     """
-    for i in range(span.begin_word_id, span.begin_word_id + span.length):
-        for j in range(1, window + 1):
-            if i+j <= span.begin_word_id + span.length:
-                yield "NGRAM_" + str(j) + "_[" + " ".join(
-                    map(lambda x: str(x.lemma), sentence[i:i+j])) + "]"
+    if context is None:
+        context = _SentenceContext(sentence)
+    lemmas = context.lemma_strings()
+    begin = span.begin_word_id
+    end = span.begin_word_id + span.length
+    heads = _ngram_heads(window)
+    if begin < 0 or end > len(lemmas):
+        # Out of the sentence, the slices are cut short.
+        for i in range(begin, end):
+            for j in range(1, window + 1):
+                if i+j <= end:
+                    yield heads[j] + " ".join(lemmas[i:i+j]) + "]"
+        return
+    for i in range(begin, end):
+        # Each ngram extends the previous one by a word.
+        ngram = lemmas[i]
+        yield heads[1] + ngram + "]"
+        for j in range(2, min(window, end - i) + 1):
+            ngram += " " + lemmas[i+j-1]
+            yield heads[j] + ngram + "]"
+
+
+# The beginnings of the ngram and window features, by size
+_NGRAM_HEADS = []
+_WINDOW_HEADS = {}
+
+
+def _ngram_heads(window):
+    while len(_NGRAM_HEADS) <= window:
+        _NGRAM_HEADS.append("NGRAM_" + str(len(_NGRAM_HEADS)) + "_[")
+    return _NGRAM_HEADS
+
+
+def _window_heads(window):
+    """Return the beginnings of the window features of each size: for the
+    left and right windows, and for their combinations."""
+    heads = _WINDOW_HEADS.get(window)
+    if heads is None:
+        sizes = range(1, window + 1)
+        heads = _WINDOW_HEADS[window] = (
+            ["W_LEFT_" + str(i) + "_[" for i in sizes],
+            ["W_LEFT_NER_" + str(i) + "_[" for i in sizes],
+            ["W_RIGHT_" + str(i) + "_[" for i in sizes],
+            ["W_RIGHT_NER_" + str(i) + "_[" for i in sizes],
+            [["W_LEMMA_L_" + str(i) + "_R_" + str(j) + "_[" for j in sizes]
+             for i in sizes],
+            [["W_NER_L_" + str(i) + "_R_" + str(j) + "_[" for j in sizes]
+             for i in sizes])
+    return heads
 
 
 def _get_min_dep_path(sentence, span1, span2):
@@ -253,18 +742,19 @@ def _get_min_dep_path(sentence, span1, span2):
         span2: the second Span
     Returns: a list of DepEdge objects
     """
-    min_path = None
-    min_path_length = 200  # ridiculously high number?
-    for i in range(span1.begin_word_id, span1.begin_word_id + span1.length):
-        for j in range(
-                span2.begin_word_id, span2.begin_word_id + span2.length):
-            p = dep_path_between_words(sentence, i, j)
-            if len(p) < min_path_length:
-                min_path = p
-    return min_path
-
-
-def _get_min_dep_path_features(sentence, span1, span2, prefix="BETW_"):
+    return _SentenceContext(sentence).min_dep_path(span1, span2)
+
+
+def _get_dictionary_substitution(lemma):
+    """Return DICT_ followed by the id of the first dictionary containing the
+    lemma, or the lemma itself if it is in no dictionary."""
+    if _substitutions is None:
+        _get_dictionary_matcher()
+    return _substitutions.get(lemma, lemma)
+
+
+def _get_min_dep_path_features(
+        sentence, span1, span2, prefix="BETW_", context=None):
     """Yield the minimum dependency path features between two Span objects.
     Various variants of the dependency path are yielded:
         - using both labels and lemmas,
@@ -277,30 +767,18 @@ def _get_min_dep_path_features(sentence, span1, span2, prefix="BETW_"):
         span1: the first Span
         span2: the second Span
         prefix: string prepended to all features
+        context: (optional) the _SentenceContext of the sentence
     """
-    min_path = _get_min_dep_path(sentence, span1, span2)
-    if min_path:
-        min_path_lemmas = []
-        min_path_labels = []
-        for edge in min_path:
-            min_path_lemmas.append(str(edge.word2.lemma))
-            min_path_labels.append(str(edge.label))
-        both = []
-        for j in range(len(min_path_labels)):
-            both.append(min_path_labels[j])
-            both.append(min_path_lemmas[j])
-        both = both[:-1]
-        yield prefix + "_[" + " ".join(both) + "]"
-        yield prefix + "_L_[" + " ".join(min_path_labels) + "]"
-        for j in range(1, len(both), 2):
-            for dict_id in dictionaries:
-                if both[j] in dictionaries[dict_id]:
-                    both[j] = "DICT_" + str(dict_id)
-                    break  # Picking up the first dictionary we find
-        yield prefix + "_D_[" + " ".join(both) + "]"
-
-
-def _get_seq_features(sentence, span):
+    if context is None:
+        context = _SentenceContext(sentence)
+    if context.min_dep_path(span1, span2):
+        both, labels, dict_both = context.min_dep_path_strings(span1, span2)
+        yield prefix + "_[" + both + "]"
+        yield prefix + "_L_[" + labels + "]"
+        yield prefix + "_D_[" + dict_both + "]"
+
+
+def _get_seq_features(sentence, span, context=None):
     """Yield the sequence features in a Span
 
     These include:
@@ -312,6 +790,7 @@ def _get_seq_features(sentence, span):
     Args:
         sentence: a list of Word objects
         span: the Span
+        context: (optional) the _SentenceContext of the sentence
     """
     word_seq_feat = "WORD_SEQ_[" + " ".join(materialize_span(
         sentence, span, lambda x: x.word)) + "]"
@@ -328,12 +807,17 @@ def _get_seq_features(sentence, span):
 
 
 def _get_window_features(
-        sentence, span, window=3, combinations=True, isolated=True):
+        sentence, span, window=3, combinations=True, isolated=True,
+        context=None):
     """Yield the window features around a Span
 
     These are basically the n-grams around the span, up to a window of size
     'window'
 
+    The window on the left of a span near the start of the sentence wraps
+    around to the words at its end, as it always has; this is kept so that
+    the features of existing models do not change.
+
     Args:
         sentence: a list of Word objects
         span: the span
@@ -342,82 +826,65 @@ def _get_window_features(
             the left and on the right
         isolated: Whether to yield features that do not combine the windows on
             the left and on the right
+        context: (optional) the _SentenceContext of the sentence
     """
+    if context is None:
+        context = _SentenceContext(sentence)
+    lemmas = context.normalized_lemmas()
+    ners = context.ner_strings()
     span_end_idx = span.begin_word_id + span.length - 1
+    # The windows are joined incrementally: left_lemmas[i] is the window of
+    # size i + 1 on the left, and so on.
     left_lemmas = []
     left_ners = []
     right_lemmas = []
     right_ners = []
     try:
         for i in range(1, window + 1):
-            lemma = str(sentence[span.begin_word_id - i].lemma)
-            try:
-                float(lemma)
-                lemma = "_NUMBER"
-            except ValueError:
-                pass
+            lemma = lemmas[span.begin_word_id - i]
+            ner = ners[span.begin_word_id - i]
+            if left_lemmas:
+                lemma += " " + left_lemmas[-1]
+                ner += " " + left_ners[-1]
             left_lemmas.append(lemma)
-            left_ners.append(str(sentence[span.begin_word_id - i].ner))
+            left_ners.append(ner)
     except IndexError:
         pass
-    left_lemmas.reverse()
-    left_ners.reverse()
     try:
         for i in range(1, window + 1):
-            lemma = str(sentence[span_end_idx + i].lemma)
-            try:
-                float(lemma)
-                lemma = "_NUMBER"
-            except ValueError:
-                pass
+            lemma = lemmas[span_end_idx + i]
+            ner = ners[span_end_idx + i]
+            if right_lemmas:
+                lemma = right_lemmas[-1] + " " + lemma
+                ner = right_ners[-1] + " " + ner
             right_lemmas.append(lemma)
-            right_ners.append(str(sentence[span_end_idx + i].ner))
+            right_ners.append(ner)
     except IndexError:
         pass
+    left_heads, left_ner_heads, right_heads, right_ner_heads, lemma_heads, \
+        ner_heads = _window_heads(window)
     if isolated:
         for i in range(len(left_lemmas)):
-            yield "W_LEFT_" + str(i+1) + "_[" + " ".join(left_lemmas[-i-1:]) + \
-                "]"
-            yield "W_LEFT_NER_" + str(i+1) + "_[" + " ".join(left_ners[-i-1:]) +\
-                "]"
+            yield left_heads[i] + left_lemmas[i] + "]"
+            yield left_ner_heads[i] + left_ners[i] + "]"
         for i in range(len(right_lemmas)):
-            yield "W_RIGHT_" + str(i+1) + "_[" + " ".join(right_lemmas[:i+1]) +\
-                "]"
-            yield "W_RIGHT_NER_" + str(i+1) + "_[" + \
-                " ".join(right_ners[:i+1]) + "]"
+            yield right_heads[i] + right_lemmas[i] + "]"
+            yield right_ner_heads[i] + right_ners[i] + "]"
     if combinations:
+        right_lemmas = [lemma + "]" for lemma in right_lemmas]
+        right_ners = [ner + "]" for ner in right_ners]
         for i in range(len(left_lemmas)):
-            curr_left_lemmas = " ".join(left_lemmas[-i-1:])
-            try:
-                curr_left_ners = " ".join(left_ners[-i-1:])
-            except TypeError:
-                new_ners = []
-                for ner in left_ners[-i-1:]:
-                    to_add = ner
-                    if not to_add:
-                        to_add = "None"
-                    new_ners.append(to_add)
-                curr_left_ners = " ".join(new_ners)
+            curr_left_lemmas = left_lemmas[i] + "]_["
+            curr_left_ners = left_ners[i] + "]_["
+            curr_lemma_heads = lemma_heads[i]
+            curr_ner_heads = ner_heads[i]
             for j in range(len(right_lemmas)):
-                curr_right_lemmas = " ".join(right_lemmas[:j+1])
-                try:
-                    curr_right_ners = " ".join(right_ners[:j+1])
-                except TypeError:
-                    new_ners = []
-                    for ner in right_ners[:j+1]:
-                        to_add = ner
-                        if not to_add:
-                            to_add = "None"
-                        new_ners.append(to_add)
-                    curr_right_ners = " ".join(new_ners)
-                yield "W_LEMMA_L_" + str(i+1) + "_R_" + str(j+1) + "_[" + \
-                    curr_left_lemmas + "]_[" + curr_right_lemmas + "]"
-                yield "W_NER_L_" + str(i+1) + "_R_" + str(j+1) + "_[" + \
-                    curr_left_ners + "]_[" + curr_right_ners + "]"
+                yield curr_lemma_heads[j] + curr_left_lemmas + right_lemmas[j]
+                yield curr_ner_heads[j] + curr_left_ners + right_ners[j]
 
 
 def _get_dictionary_indicator_features(
-        sentence, span, window=3, prefix="IN_DICT"):
+        sentence, span, window=3, prefix="IN_DICT", matches=None):
     """Yield the indicator features for whether a substring of the span is in
 the dictionaries
 
@@ -426,51 +893,84 @@ the dictionaries
         span: the span
         window: the maximum size of a substring
         prefix: a string to prepend to all yielded features
+        matches: (optional) the result of _get_dictionary_matches(sentence)
     """
     in_dictionaries = set()
-    for i in range(window + 1):
-        for j in range(span.length - i):
-            phrase = " ".join(map(lambda x: str(x.lemma), sentence[j:j+i+1]))
-            for dict_id in dictionaries:
-                if phrase in dictionaries[dict_id]:
-                    in_dictionaries.add(dict_id)
+    if span.length <= len(sentence):
+        if matches is None:
+            matches = _get_dictionary_matches(sentence)
+        # The dictionaries are added to the set in the same order as when
+        # looking up each substring, so that the features come out in the same
+        # order.
+        for (length, start, dict_ids) in sorted(
+                (j - i, i, dict_ids) for (i, j, dict_ids) in matches
+                if j <= span.length and j - i <= window + 1):
+            in_dictionaries.update(dict_ids)
+    else:
+        for i in range(window + 1):
+            for j in range(span.length - i):
+                phrase = " ".join(
+                    map(lambda x: str(x.lemma), sentence[j:j+i+1]))
+                for dict_id in dictionaries:
+                    if phrase in dictionaries[dict_id]:
+                        in_dictionaries.add(dict_id)
     for dict_id in in_dictionaries:
         yield prefix + "_[" + str(dict_id) + "]"
     # yield prefix + "_JOIN_[" + " ".join(
     #    map(lambda x: str(x), sorted(in_dictionaries))) + "]"
 
 
-def dep_graph_parser_parenthesis(edge_str):
-    """Given a string representing a dependency edge in the 'parenthesis'
-    format, return a tuple of (parent_index, edge_label, child_index).
+def _get_dictionary_matcher():
+    """Return the PhraseMatcher for the current dictionaries, building it (and
+    the DICT_ substitutions) if they changed since it was last built."""
+    global _matcher, _substitutions
+    if _matcher is None:
+        matcher = PhraseMatcher(dictionaries.items())
+        prefixes = dict((dict_id, "DICT_" + str(dict_id))
+                        for dict_id in dictionaries)
+        if any(isinstance(dictionary, CompiledDictionary)
+               for dictionary in dictionaries.itervalues()):
+            substitutions = _LookupSubstitutions(matcher, prefixes)
+        else:
+            substitutions = dict(
+                (phrase, prefixes[dict_ids[0]])
+                for phrase, dict_ids in matcher.phrases.iteritems())
+        _matcher, _substitutions = matcher, substitutions
+    return _matcher
 
-    Args:
-        edge_str: a string representation of an edge in the dependency tree, in
-        the format edge_label(parent_word-parent_index, child_word-child_index)
-    Returns:
-        tuple of (parent_index, edge_label, child_index)
-    """
-    tokens = edge_str.split("(")
-    label = tokens[0]
-    tokens = tokens[1].split(", ")
-    parent = int(tokens[0].split("-")[-1]) - 1
-    child = int(",".join(tokens[1:]).split("-")[-1][:-1]) - 1
-    return (parent, label, child)
 
+class _LookupSubstitutions(object):
+    """The DICT_ substitutions when there are compiled dictionaries, which
+    are probed as well as the phrases of the matcher."""
 
-def dep_graph_parser_triplet(edge_str):
-    """Given a string representing a dependency edge in the 'triplet' format,
-    return a tuple of (parent_index, edge_label, child_index).
+    def __init__(self, matcher, prefixes):
+        self.matcher = matcher
+        self.prefixes = prefixes
 
-    Args:
-        edge_str: a string representation of an edge in the dependency tree
-        in the format "parent_index\tlabel\child_index"
-    Returns:
-        tuple of (parent_index, edge_label, child_index)
-    """
-    parent, label, child = edge_str.split()
-    # input edge used 1-based indexing
-    return (int(parent) - 1, label, int(child) - 1)
+    def get(self, lemma, default):
+        dict_ids = self.matcher.lookup(lemma)
+        return self.prefixes[dict_ids[0]] if dict_ids else default
+
+
+def _get_dictionary_matches(sentence):
+    """Return the substrings of the sentence (as sequences of lemmas) that are
+    in the dictionaries, as a list of (start, end, dict_ids) sorted by start
+    and then by decreasing end. dict_ids are the ids of the dictionaries
+    containing the substring, in the order of the dictionaries dict."""
+    if not dictionaries:
+        return []
+    return _get_dictionary_matcher().find(
+        _SentenceContext(sentence).lemma_strings())
+
+
+def _get_keyword_matches(sentence, matches=None):
+    """Return the matches of _get_dictionary_matches that are keywords, i.e.,
+    in the same order as _get_substring_indices(len(sentence), MAX_KW_LENGTH)
+    would yield them."""
+    if matches is None:
+        matches = _get_dictionary_matches(sentence)
+    return [(i, j, dict_ids) for (i, j, dict_ids) in matches
+            if j - i <= MAX_KW_LENGTH and j < len(sentence)]
 
 
 def dep_transform_parenthesis_to_triplet(edge_str):
@@ -512,8 +1012,9 @@ def get_span(span_begin, span_length):
 
 def get_sentence(
         begin_char_offsets, end_char_offsets, words, lemmas, poses,
-        dependencies, ners, dep_format_parser=dep_graph_parser_parenthesis):
-    """Return a list of Word objects representing a sentence.
+        dependencies, ners, dep_format_parser=dep_graph_parser_parenthesis,
+        array_delim=None, encode_tags=False):
+    """Return a Sentence (a sequence of Word objects) representing a sentence.
 
     This is effectively a wrapper around unpack_words, but with a less
     cumbersome interface.
@@ -533,6 +1034,11 @@ def get_sentence(
             (parent_index, label, child_index) representing the edge. Look at
             the code for dep_graph_parser_parenthesis and
             dep_graph_parser_triplet for examples.
+        array_delim: (optional) the delimiter used to join the lists given as
+            strings (e.g. "~^~"). Lists given as strings without a delimiter
+            are decoded as PostgreSQL array literals.
+        encode_tags: (optional) if True, POS tags, NER tags and dependency
+            labels are stored as integer codes (see ddlib.TagColumn).
     """
     obj = dict()
     obj['lemma'] = lemmas
@@ -542,10 +1048,11 @@ def get_sentence(
     obj['dep_graph'] = dependencies
     obj['ch_of_beg'] = begin_char_offsets
     obj['ch_of_end'] = end_char_offsets
-    # list of Word objects
+    # Sentence of Word objects
     word_obj_list = unpack_words(
         obj, character_offset_begin='ch_of_beg',
         character_offset_end='ch_of_end', lemma='lemma', pos='pos',
         ner='ner', words='words', dep_graph='dep_graph',
-        dep_graph_parser=dep_format_parser)
+        dep_graph_parser=dep_format_parser, array_delim=array_delim,
+        encode_tags=encode_tags)
     return word_obj_list
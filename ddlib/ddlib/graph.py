@@ -0,0 +1,273 @@
+#! /usr/bin/env python
+#
+# Reading the binary factor graph of the DimmWitted sampler.
+#
+# util/tobinary.py (or src/main/c/binarize.cpp) converts the grounding into
+# graph.variables, graph.weights, graph.factors and graph.edges, and writes
+# their numbers of records to graph.meta. Graph maps these files in memory as
+# NumPy structured arrays, so that a grounding can be inspected and checked
+# without running the sampler, and without reading it into memory:
+#
+#   graph = ddlib.graph.Graph("/path/to/output")
+#   print graph.stats()
+#   for problem in graph.validate():
+#       print problem
+#
+# or from the command line:
+#
+#   python -m ddlib.graph /path/to/output
+#
+# The records are big-endian:
+#
+#   variable: vid (8 bytes), is_evidence (1), initial value (double, 8),
+#       type (2), edge count (8, always -1), cardinality (8)
+#   weight: wid (8), is_fixed (1), initial value (double, 8)
+#   factor: fid (8), wid (8), function id (2), number of edges (8)
+#   edge: vid (8), fid (8), position in the factor (8), is_positive (1),
+#       predicate (8)
+#
+# The ids of the variables, weights and factors are expected to be 0 to their
+# number minus 1.
+#
+
+import os
+import sys
+import argparse
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+if np is not None:
+    VARIABLE = np.dtype([("vid", ">i8"), ("is_evidence", "u1"),
+                         ("initial_value", ">f8"), ("type", ">i2"),
+                         ("edge_count", ">i8"), ("cardinality", ">i8")])
+    WEIGHT = np.dtype([("wid", ">i8"), ("is_fixed", "u1"),
+                       ("initial_value", ">f8")])
+    FACTOR = np.dtype([("fid", ">i8"), ("wid", ">i8"), ("function_id", ">i2"),
+                       ("n_edges", ">i8")])
+    EDGE = np.dtype([("vid", ">i8"), ("fid", ">i8"), ("position", ">i8"),
+                     ("is_positive", "u1"), ("predicate", ">i8")])
+
+# Number of records converted to native integers at a time
+BLOCK_SIZE = 1 << 22
+
+# The files of a graph, in the order of their numbers in graph.meta
+FILES = ("weights", "variables", "factors", "edges")
+
+
+def read_meta(filename):
+    """Return the numbers of weights, variables, factors and edges written to
+    a graph.meta file."""
+    with open(filename) as f:
+        fields = f.readline().strip().split(",")
+    try:
+        if len(fields) >= 4:
+            return tuple(int(n) for n in fields[:4])
+    except ValueError:
+        pass
+    raise ValueError("%s: expected the numbers of weights, variables, " %
+                     filename + "factors and edges, got %r" % (fields,))
+
+
+class Graph(object):
+    """The binary files of a factor graph, mapped in memory read-only.
+
+    The variables, weights, factors and edges attributes are NumPy structured
+    arrays of the records of each file (with the VARIABLE, WEIGHT, FACTOR and
+    EDGE dtypes). Incomplete records at the end of a file are ignored, and
+    reported by validate.
+
+    Args:
+        folder: the folder of the graph files
+        meta: (optional) the graph.meta file, folder/graph.meta by default.
+            If it does not exist, the numbers of records are not checked.
+    """
+
+    def __init__(self, folder, meta=None):
+        if np is None:
+            raise ImportError("ddlib.graph requires NumPy")
+        self.folder = folder
+        if meta is None:
+            meta = os.path.join(folder, "graph.meta")
+        self.meta = read_meta(meta) if os.path.isfile(meta) else None
+        self.trailing_bytes = {}
+        for name, dtype in zip(FILES, (WEIGHT, VARIABLE, FACTOR, EDGE)):
+            filename = os.path.join(folder, "graph." + name)
+            size = os.path.getsize(filename)
+            self.trailing_bytes[name] = size % dtype.itemsize
+            if size < dtype.itemsize:
+                records = np.zeros(0, dtype=dtype)
+            else:
+                records = np.memmap(filename, dtype=dtype, mode="r",
+                                    shape=(size // dtype.itemsize,))
+            setattr(self, name, records)
+        self._variable_degrees = None
+
+    def evidence_ratio(self):
+        """Return the fraction of the variables that are evidence."""
+        if not len(self.variables):
+            return 0.0
+        n_evidence = sum(int(np.count_nonzero(block)) for start, block in
+                         _blocks(self.variables, "is_evidence"))
+        return float(n_evidence) / len(self.variables)
+
+    def variable_degrees(self):
+        """Return the number of edges of each variable, by vid."""
+        if self._variable_degrees is None:
+            self._variable_degrees = _count(self.edges, "vid",
+                                            len(self.variables))[0]
+        return self._variable_degrees
+
+    def degree_distribution(self):
+        """Return the number of variables with each number of edges."""
+        return np.bincount(self.variable_degrees())
+
+    def arity_distribution(self):
+        """Return the number of factors with each number of edges."""
+        counts = np.zeros(1, dtype=np.int64)
+        for start, block in _blocks(self.factors, "n_edges"):
+            block = np.bincount(block[block >= 0])
+            if len(block) > len(counts):
+                counts = np.concatenate(
+                    [counts, np.zeros(len(block) - len(counts), np.int64)])
+            counts[:len(block)] += block
+        return counts
+
+    def orphan_variables(self):
+        """Return the vids of the variables without edges."""
+        return np.flatnonzero(self.variable_degrees() == 0)
+
+    def weight_usage(self):
+        """Return the number of factors of each weight, by wid."""
+        return _count(self.factors, "wid", len(self.weights))[0]
+
+    def stats(self):
+        """Return a dict of the numbers of records and of the statistics of
+        the graph."""
+        weight_usage = self.weight_usage()
+        degrees = self.variable_degrees()
+        return {
+            "weights": len(self.weights),
+            "variables": len(self.variables),
+            "factors": len(self.factors),
+            "edges": len(self.edges),
+            "evidence_ratio": self.evidence_ratio(),
+            "orphan_variables": int(np.count_nonzero(degrees == 0)),
+            "max_variable_degree": int(degrees.max()) if len(degrees) else 0,
+            "degree_distribution": self.degree_distribution().tolist(),
+            "arity_distribution": self.arity_distribution().tolist(),
+            "unused_weights": int(np.count_nonzero(weight_usage == 0)),
+            "max_weight_usage":
+                int(weight_usage.max()) if len(weight_usage) else 0,
+        }
+
+    def validate(self):
+        """Check that the graph is consistent, and return a list of the
+        problems found (empty if there are none)."""
+        problems = []
+        for i, name in enumerate(FILES):
+            records = getattr(self, name)
+            if self.trailing_bytes[name]:
+                problems.append("graph.%s ends with an incomplete record of "
+                                "%d bytes" % (name, self.trailing_bytes[name]))
+            if self.meta is not None and self.meta[i] != len(records):
+                problems.append("graph.meta has %d %s, graph.%s has %d" % (
+                    self.meta[i], name, name, len(records)))
+        for name, field in (("variables", "vid"), ("weights", "wid"),
+                            ("factors", "fid")):
+            records = getattr(self, name)
+            counts, invalid = _count(records, field, len(records))
+            problems.extend(_invalid(name, field, records, invalid))
+            duplicates = np.flatnonzero(counts > 1)
+            if len(duplicates):
+                problems.append("%d %s ids are used more than once, e.g. %d" % (
+                    len(duplicates), field, duplicates[0]))
+        edges_of_factors = _count(self.edges, "fid", len(self.factors))
+        problems.extend(_invalid("edges", "fid", self.edges,
+                                 edges_of_factors[1]))
+        problems.extend(_invalid(
+            "edges", "vid", self.edges,
+            _count(self.edges, "vid", len(self.variables))[1]))
+        problems.extend(_invalid(
+            "factors", "wid", self.factors,
+            _count(self.factors, "wid", len(self.weights))[1]))
+        n_edges = sum(int(block.sum()) for start, block in
+                      _blocks(self.factors, "n_edges"))
+        if n_edges != len(self.edges):
+            problems.append("the factors have %d edges, graph.edges has %d" % (
+                n_edges, len(self.edges)))
+        # The number of edges of each factor, by fid
+        expected = np.zeros(len(self.factors), dtype=np.int64)
+        for start, block in _blocks(self.factors, "fid"):
+            valid = (block >= 0) & (block < len(self.factors))
+            expected[block[valid]] = self.factors["n_edges"][
+                start:start + len(block)][valid]
+        wrong = np.flatnonzero(expected != edges_of_factors[0])
+        if len(wrong):
+            problems.append(
+                "%d factors do not have as many edges as they should, e.g. "
+                "fid %d has %d instead of %d" % (
+                    len(wrong), wrong[0], edges_of_factors[0][wrong[0]],
+                    expected[wrong[0]]))
+        return problems
+
+
+def _blocks(records, field, block_size=BLOCK_SIZE):
+    """Yield the index of the first record and the values of field as native
+    integers of each block of block_size records."""
+    for start in xrange(0, len(records), block_size):
+        yield start, records[field][start:start + block_size].astype(np.int64)
+
+
+def _count(records, field, n):
+    """Return the number of records with each value of field in [0, n), and
+    the number and the index of the first of the other records."""
+    counts = np.zeros(n, dtype=np.int64)
+    n_invalid = 0
+    first_invalid = None
+    for start, block in _blocks(records, field):
+        valid = (block >= 0) & (block < n)
+        if not valid.all():
+            if first_invalid is None:
+                first_invalid = start + int(np.flatnonzero(~valid)[0])
+            n_invalid += len(block) - int(np.count_nonzero(valid))
+            block = block[valid]
+        if len(block):
+            low = int(block.min())
+            block = np.bincount(block - low)
+            counts[low:low + len(block)] += block
+    return counts, (n_invalid, first_invalid)
+
+
+def _invalid(name, field, records, invalid):
+    """Return the problem of the records of which field is out of range, as
+    counted by _count."""
+    n_invalid, first_invalid = invalid
+    if not n_invalid:
+        return []
+    return ["%d %s have a %s out of range, e.g. record %d (%s %d)" % (
+        n_invalid, name, field, first_invalid, field,
+        records[field][first_invalid])]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print the statistics of a binary factor graph and check "
+                    "that it is consistent.")
+    parser.add_argument("folder", help="the folder of the graph files")
+    parser.add_argument("--meta", help="the graph.meta file, "
+                                       "folder/graph.meta by default")
+    args = parser.parse_args()
+    graph = Graph(args.folder, args.meta)
+    for name, value in sorted(graph.stats().items()):
+        print "%s\t%s" % (name, value)
+    problems = graph.validate()
+    for problem in problems:
+        print >>sys.stderr, problem
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
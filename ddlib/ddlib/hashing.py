@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+#
+# Hashing of feature strings into 64-bit integer ids.
+#
+# The generic features are long strings that are written by the extractors,
+# copied into the feature tables, joined during grounding and stored again as
+# weight descriptions. With a FeatureHasher, the generators yield a stable
+# signed 64-bit id for each feature instead (suitable for a bigint column),
+# and can write the id of each distinct feature with its string to a side file
+# for debugging:
+#
+#   hasher = ddlib.FeatureHasher("/tmp/features-{pid}.tsv")
+#   for feature in ddlib.get_generic_features_relation(
+#           sentence, span1, span2, hasher=hasher):
+#       print str(relation_id) + "\t" + str(feature)
+#
+
+import os
+import struct
+import hashlib
+import multiprocessing.util
+
+from dd import _close_at_exit, _closed
+
+
+def hash_feature(feature):
+    """Return the 64-bit id of a feature string: the first 8 bytes of its MD5
+    digest, as a signed big-endian integer. Unicode strings are hashed by
+    their UTF-8 encoding."""
+    if isinstance(feature, unicode):
+        feature = feature.encode("utf-8")
+    return struct.unpack(">q", hashlib.md5(feature).digest()[:8])[0]
+
+
+class FeatureHasher(object):
+    """Turns feature strings into their 64-bit ids, remembering the ids already
+    computed, and optionally writing each distinct feature to a side file as
+    "id<TAB>feature" lines.
+    """
+
+    def __init__(self, dictionary_file=None, buffer_size=64 * 1024,
+                 cache_size=1 << 20):
+        """
+        Args:
+            dictionary_file: (optional) the path of the side file, or a stream.
+                "{pid}" in a path is replaced by the id of the process writing
+                it, so that the processes of a run_parallel pool (or any
+                multiprocessing pool) do not write to the same file. The file
+                is appended to.
+            buffer_size: number of bytes buffered before writing to the side
+                file
+            cache_size: number of feature ids remembered. The cache is
+                emptied when it is full, so a feature can then be written to
+                the side file again (as it can by different processes).
+        """
+        self.dictionary_file = dictionary_file
+        self.buffer_size = buffer_size
+        self.cache_size = cache_size
+        self._hashes = {}
+        self._stream = None
+        self._buffer = []
+        self._buffered = 0
+        _close_at_exit(self)
+        multiprocessing.util.register_after_fork(self, FeatureHasher._forked)
+
+    def __call__(self, feature):
+        """Return the id of a feature."""
+        feature_id = self._hashes.get(feature)
+        if feature_id is None:
+            if len(self._hashes) >= self.cache_size:
+                self._hashes = {}
+            feature_id = self._hashes[feature] = hash_feature(feature)
+            if self.dictionary_file is not None:
+                self._record(feature_id, feature)
+        return feature_id
+
+    def hash_all(self, features):
+        """Yield the ids of features."""
+        for feature in features:
+            yield self(feature)
+
+    def flush(self):
+        """Write the buffered features to the side file."""
+        if self._buffer:
+            self._open().write("".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        if self._stream is not None:
+            self._stream.flush()
+
+    def close(self):
+        """Flush the side file, and close it if it was opened from a path."""
+        self.flush()
+        if self._stream is not None and \
+                isinstance(self.dictionary_file, basestring):
+            self._stream.close()
+            self._stream = None
+        _closed(self)
+
+    def __del__(self):
+        # A hasher dropped without being closed still writes its features.
+        if self._buffer:
+            try:
+                self.flush()
+            except ValueError:
+                pass
+
+    def _forked(self):
+        # In a child process, what the parent buffered or already wrote is the
+        # parent's to write, and what the child buffers is written when it
+        # exits.
+        self._buffer = []
+        self._buffered = 0
+        self._hashes = {}
+        if isinstance(self.dictionary_file, basestring):
+            self._stream = None
+        _close_at_exit(self)
+
+    def _record(self, feature_id, feature):
+        if isinstance(feature, unicode):
+            feature = feature.encode("utf-8")
+        line = "%d\t%s\n" % (feature_id, feature)
+        self._buffer.append(line)
+        self._buffered += len(line)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def _open(self):
+        if self._stream is None:
+            if isinstance(self.dictionary_file, basestring):
+                self._stream = open(self.dictionary_file.replace(
+                    "{pid}", str(os.getpid())), "a")
+            else:
+                self._stream = self.dictionary_file
+        return self._stream
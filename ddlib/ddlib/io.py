@@ -0,0 +1,533 @@
+#! /usr/bin/env python
+#
+# Reading and writing of the rows that tsv_extractor and json_extractor UDFs
+# exchange with DeepDive.
+#
+# read_rows turns the input of an extractor into typed rows following a
+# declared schema, and RowWriter writes the output rows, escaping them
+# properly and flushing them in large chunks:
+#
+#   from ddlib.io import read_rows, RowWriter
+#   out = RowWriter()
+#   for row in read_rows("words text[], relation_id bigint"):
+#       out.write(row.relation_id, len(row.words))
+#
+# FeatureAggregator sits in front of a RowWriter to write each distinct
+# (id, feature) row of a batch only once.
+#
+
+import os
+import sys
+import re
+import json
+import collections
+import multiprocessing.util
+
+from dd import log, _close_at_exit, _closed
+from pgarray import ARR_DELIM, decode_array, encode_array, split_array
+
+# How NULL is written in the text output of each database
+POSTGRES_NULL = "\\N"
+MYSQL_NULL = "NULL"
+
+BLOCK_SIZE = 1 << 20
+
+
+def parse_schema(schema):
+    """Return a list of (name, type) pairs from a schema.
+
+    Args:
+        schema: either a string of comma-separated "name type" declarations,
+            e.g. "words text[], relation_id bigint", or a sequence of (name,
+            type) pairs. Supported types are text, int, bigint, float, real,
+            double precision, boolean and arrays of any of them (e.g. "int[]").
+    """
+    if isinstance(schema, basestring):
+        columns = []
+        for declaration in schema.split(","):
+            name, _, column_type = declaration.strip().partition(" ")
+            columns.append((name, column_type.strip()))
+        schema = columns
+    columns = []
+    for name, column_type in schema:
+        column_type = column_type.lower()
+        base_type = column_type[:-2] if column_type.endswith("[]") else \
+            column_type
+        if base_type not in _CONVERTERS:
+            raise ValueError("Unsupported type '%s' for column '%s'" % (
+                column_type, name))
+        columns.append((name, column_type))
+    return columns
+
+
+def read_rows(schema, stream=None, format="tsv", null=POSTGRES_NULL,
+              array_delim=None, errors="strict", block_size=BLOCK_SIZE):
+    """Yield the rows of an extractor input as namedtuples.
+
+    The input is read in blocks of block_size bytes. Fields are converted to
+    the types declared in the schema; NULL fields become None.
+
+    Args:
+        schema: the columns of the input, see parse_schema. The fields of the
+            namedtuples are the column names, with characters that are not
+            valid in a Python identifier (e.g. the '.' in "p1.start_position")
+            replaced by '_'.
+        stream: where to read from, sys.stdin by default
+        format: "tsv" for tsv_extractor input (PostgreSQL COPY text format),
+            "json" for json_extractor input (one JSON object per line)
+        null: how NULL is written in a TSV input (POSTGRES_NULL or MYSQL_NULL)
+        array_delim: if set, array columns in a TSV input are split on this
+            delimiter (e.g. ARR_DELIM) instead of being parsed as PostgreSQL
+            array literals
+        errors: "strict" to raise ValueError on a malformed row, "skip" to log
+            it and go on
+        block_size: number of bytes read at a time
+    """
+    if stream is None:
+        stream = sys.stdin
+    parse = row_parser(schema, format, null, array_delim)
+    for line in _read_lines(stream, block_size):
+        try:
+            yield parse(line)
+        except ValueError as e:
+            if errors != "skip":
+                raise
+            log(str(e), key="ddlib.io")
+
+
+def row_parser(schema, format="tsv", null=POSTGRES_NULL, array_delim=None):
+    """Return a function that parses one line of extractor input (without the
+    newline) into a namedtuple, raising ValueError if the line is malformed.
+
+    The arguments are the same as for read_rows.
+    """
+    columns = parse_schema(schema)
+    row_type = collections.namedtuple(
+        "Row", [re.sub(r"\W", "_", name) for name, _ in columns])
+    if format == "tsv":
+        decode = _tsv_row_decoder(columns, null, array_delim)
+    elif format == "json":
+        decode = _json_row_decoder(columns)
+    else:
+        raise ValueError("Unsupported format '%s'" % format)
+
+    def parse(line):
+        try:
+            return _new_tuple(row_type, decode(line))
+        except (ValueError, TypeError, KeyError) as e:
+            raise ValueError("Failed to parse row %r: %s" % (line, e))
+    return parse
+
+
+class RowWriter(object):
+    """Buffered writer of extractor output rows.
+
+    Rows are encoded as they are written and sent to the stream in chunks of
+    about buffer_size bytes. The buffer is flushed when the writer is closed
+    (or used as a context manager) and, as a safety net, when it is garbage
+    collected or the process exits. Do not mix print statements with a RowWriter on the same stream:
+    the buffered rows would come out after the printed lines.
+    """
+
+    def __init__(self, stream=None, format="tsv", null=POSTGRES_NULL,
+                 array_delim=None, buffer_size=BLOCK_SIZE):
+        """
+        Args:
+            stream: where to write to, sys.stdout by default
+            format: "tsv" to write rows in PostgreSQL COPY text format, "json"
+                to write one JSON object per line
+            null: how to write None in TSV output
+            array_delim: if set, lists are written in TSV output joined by this
+                delimiter instead of as PostgreSQL array literals
+            buffer_size: number of bytes buffered before writing
+        """
+        if format not in ("tsv", "json"):
+            raise ValueError("Unsupported format '%s'" % format)
+        self.stream = stream if stream is not None else sys.stdout
+        self.format = format
+        self.null = null
+        self.array_delim = array_delim
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        _close_at_exit(self)
+
+    def write(self, *fields, **named_fields):
+        """Write one row.
+
+        In TSV format the fields are given positionally. In JSON format they
+        are given as keyword arguments, or as a single dict.
+        """
+        if self.format == "tsv":
+            # Rows made of plain strings that need no escaping are joined in
+            # one go; anything else is encoded field by field.
+            try:
+                line = "\t".join(fields)
+            except TypeError:
+                line = None
+            if line is None or line.__class__ is not str or \
+                    line.count("\t") != len(fields) - 1 or \
+                    _NEEDS_ESCAPE.search(line) is not None:
+                line = "\t".join([self._encode(f) for f in fields])
+            line += "\n"
+        else:
+            obj = fields[0] if fields else named_fields
+            line = json.dumps(obj) + "\n"
+        self._buffer.append(line)
+        self._buffered += len(line)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def write_line(self, line):
+        """Write a line that is already encoded (e.g. fields the caller joined
+        with tabs), as it is, followed by a newline."""
+        if isinstance(line, unicode):
+            line = line.encode("utf-8")
+        line += "\n"
+        self._buffer.append(line)
+        self._buffered += len(line)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write out the buffered rows."""
+        if self._buffer:
+            self.stream.write("".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        self.stream.flush()
+
+    def close(self):
+        """Flush the buffered rows. The stream itself is left open."""
+        self.flush()
+        _closed(self)
+
+    def __del__(self):
+        # A writer dropped without being closed still writes its rows.
+        if self._buffer:
+            try:
+                self.flush()
+            except ValueError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _encode(self, value):
+        if value is None:
+            return self.null
+        if isinstance(value, (list, tuple)):
+            if self.array_delim is not None:
+                return _escape(self.array_delim.join(
+                    [_to_str(v) for v in value]))
+            return _escape(encode_array(value))
+        return _escape(_to_str(value))
+
+
+class FeatureAggregator(object):
+    """Aggregates the (id, feature) rows of a batch before writing them.
+
+    Each distinct row is written once, in the order in which it first
+    appeared, when the batch ends (on flush). Optionally, the number of times
+    it appeared is written as a third column. With a dictionary file, the
+    features of a batch are replaced by small integer codes, and each batch
+    writes the feature of each code to the dictionary file, as
+    "batch<TAB>code<TAB>feature" lines. The output rows are then
+    (id, batch, code) or (id, batch, code, count). Batch numbers are unique
+    across processes, so that the dictionaries of the batches can be loaded
+    into one table and joined on (batch, code).
+    """
+
+    def __init__(self, writer=None, count=False, dictionary_file=None,
+                 max_rows=1 << 20):
+        """
+        Args:
+            writer: the RowWriter to write the aggregated rows to, a RowWriter
+                on sys.stdout by default
+            count: whether to write the number of times each row appeared
+            dictionary_file: (optional) the path of the dictionary file, or a
+                stream. "{pid}" in a path is replaced by the id of the process
+                writing it. The file is appended to.
+            max_rows: number of distinct rows after which the batch is ended
+                automatically, to bound the memory used
+        """
+        self.writer = writer if writer is not None else RowWriter()
+        self.count = count
+        self.dictionary_file = dictionary_file
+        self.max_rows = max_rows
+        self._counts = {}
+        self._order = []
+        self._batches = 0
+        self._dictionary = None
+        _close_at_exit(self)
+        multiprocessing.util.register_after_fork(
+            self, FeatureAggregator._forked)
+
+    def write(self, row_id, feature):
+        """Add an (id, feature) row to the batch."""
+        key = (row_id, feature)
+        n = self._counts.get(key)
+        if n is None:
+            self._counts[key] = 1
+            self._order.append(key)
+            if len(self._order) >= self.max_rows:
+                self.flush()
+        else:
+            self._counts[key] = n + 1
+
+    def write_all(self, row_id, features):
+        """Add a row for each of the features of an id to the batch."""
+        for feature in features:
+            self.write(row_id, feature)
+
+    def flush(self):
+        """End the batch: write its rows (and its dictionary), and flush the
+        writer."""
+        if self._order:
+            write = self.writer.write
+            counts = self._counts
+            if self.dictionary_file is None:
+                for key in self._order:
+                    if self.count:
+                        write(key[0], key[1], counts[key])
+                    else:
+                        write(key[0], key[1])
+            else:
+                batch = self._next_batch()
+                codes = {}
+                dictionary = self._open()
+                for key in self._order:
+                    feature = key[1]
+                    code = codes.get(feature)
+                    if code is None:
+                        code = codes[feature] = len(codes)
+                        dictionary.write(batch, code, feature)
+                    if self.count:
+                        write(key[0], batch, code, counts[key])
+                    else:
+                        write(key[0], batch, code)
+                dictionary.flush()
+            self._counts = {}
+            self._order = []
+        self.writer.flush()
+
+    def close(self):
+        """End the batch, and close the dictionary file if it was opened from
+        a path."""
+        self.flush()
+        if self._dictionary is not None and \
+                isinstance(self.dictionary_file, basestring):
+            self._dictionary.close()
+            self._dictionary.stream.close()
+            self._dictionary = None
+        _closed(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _next_batch(self):
+        self._batches += 1
+        return (os.getpid() << 32) + self._batches
+
+    def _forked(self):
+        # In a child process, the rows of the parent are the parent's to
+        # write, and the rows of the child are the child's to write when it
+        # exits.
+        self._counts = {}
+        self._order = []
+        self._batches = 0
+        if isinstance(self.dictionary_file, basestring):
+            self._dictionary = None
+        _close_at_exit(self)
+
+    def _open(self):
+        if self._dictionary is None:
+            if isinstance(self.dictionary_file, basestring):
+                stream = open(self.dictionary_file.replace(
+                    "{pid}", str(os.getpid())), "a")
+            else:
+                stream = self.dictionary_file
+            self._dictionary = RowWriter(stream=stream)
+        return self._dictionary
+
+
+_new_tuple = tuple.__new__
+
+
+def _read_lines(stream, block_size):
+    """Yield the lines of a stream, without the newline, reading it in
+    blocks."""
+    pending = ""
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        lines = (pending + block).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def _to_bool(field):
+    return field in ("t", "true", "1", "TRUE", "True")
+
+
+_CONVERTERS = {
+    "text": str,
+    "varchar": str,
+    "int": int,
+    "integer": int,
+    "bigint": int,
+    "float": float,
+    "real": float,
+    "double precision": float,
+    "boolean": _to_bool,
+    "bool": _to_bool,
+}
+
+_TSV_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t",
+                "v": "\v"}
+_TSV_ESCAPE = re.compile(r"\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))",
+                         re.S)
+
+
+def _unescape_match(m):
+    if m.group(1):
+        return chr(int(m.group(1), 8) & 0xff)
+    if m.group(2):
+        return chr(int(m.group(2), 16))
+    return _TSV_ESCAPES.get(m.group(3), m.group(3))
+
+
+def _unescape(field):
+    """Undo the escaping of the PostgreSQL COPY text format."""
+    if "\\" not in field:
+        return field
+    return _TSV_ESCAPE.sub(_unescape_match, field)
+
+
+_NEEDS_ESCAPE = re.compile(r"[\\\n\r]")
+
+
+def _escape(field):
+    """Escape a field for the PostgreSQL COPY text format."""
+    if "\t" not in field and _NEEDS_ESCAPE.search(field) is None:
+        return field
+    return field.replace("\\", "\\\\").replace("\t", "\\t").replace(
+        "\n", "\\n").replace("\r", "\\r")
+
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _tsv_row_decoder(columns, null, array_delim):
+    """Return a function that decodes a TSV line into a tuple of values."""
+    decoders = []
+    for name, column_type in columns:
+        if column_type.endswith("[]"):
+            convert = _CONVERTERS[column_type[:-2]]
+            if convert is str:
+                convert = None
+            if array_delim is not None:
+                def decoder(field, convert=convert):
+                    return split_array(_unescape(field), array_delim, convert)
+            else:
+                def decoder(field, convert=convert):
+                    return decode_array(_unescape(field), convert)
+        else:
+            convert = _CONVERTERS[column_type]
+            if convert is str:
+                decoder = _unescape
+            else:
+                def decoder(field, convert=convert):
+                    return convert(_unescape(field))
+        decoders.append(decoder)
+    n_columns = len(decoders)
+
+    def decode_escaped(line):
+        fields = line.split("\t")
+        if len(fields) != n_columns:
+            raise ValueError("expected %d columns, found %d" % (
+                n_columns, len(fields)))
+        return tuple([None if f == null else d(f)
+                      for d, f in zip(decoders, fields)])
+
+    # Most lines have no escape sequence at all. For those, a function
+    # specialized for the schema (in the spirit of collections.namedtuple)
+    # unpacks the fields and converts them without any per-field call
+    # overhead for text columns.
+    namespace = {"null": null, "delim": array_delim,
+                 "decode_escaped": decode_escaped,
+                 "decode_array": decode_array, "split_array": split_array}
+    expressions = []
+    for i, (name, column_type) in enumerate(columns):
+        namespace["c%d" % i] = _CONVERTERS[column_type.rstrip("[]")]
+        if not column_type.endswith("[]"):
+            value = "f%d" if namespace["c%d" % i] is str else "c%d(f%d)"
+        else:
+            if namespace["c%d" % i] is str:
+                namespace["c%d" % i] = None
+            if array_delim is None:
+                value = "decode_array(f%d, c%d)"
+            else:
+                value = "split_array(f%d, delim, c%d)"
+        expressions.append(("(None if f%d == null else " % i) +
+                           value.replace("%d", str(i)) + ")")
+    fields = "".join("f%d, " % i for i in range(n_columns))
+    source = ("def decode(line):\n"
+              "    if '\\\\' in line:\n"
+              "        return decode_escaped(line)\n"
+              "    try:\n"
+              "        %s= line.split('\\t')\n"
+              "    except ValueError:\n"
+              "        return decode_escaped(line)\n"
+              "    return (%s)\n" % (fields, "".join(e + ", " for e in expressions)))
+    exec source in namespace
+    return namespace["decode"]
+
+
+def _json_converter(column_type):
+    """Return a function that converts a JSON value to the type a TSV field
+    of the column is decoded to."""
+    if column_type.endswith("[]"):
+        convert = _json_converter(column_type[:-2])
+
+        def converter(value):
+            if isinstance(value, basestring):
+                value = decode_array(_to_str(value))
+            return [None if v is None else convert(v) for v in value]
+        return converter
+    convert = _CONVERTERS[column_type]
+    if convert is str:
+        return _to_str
+    if convert is _to_bool:
+        return lambda value: _to_bool(value) \
+            if isinstance(value, basestring) else bool(value)
+    return convert
+
+
+def _json_row_decoder(columns):
+    """Return a function that decodes a JSON line into a list of values."""
+    names = [name for name, _ in columns]
+    converters = [_json_converter(column_type) for _, column_type in columns]
+
+    def decode(line):
+        obj = json.loads(line)
+        return [None if value is None else convert(value) for convert, value
+                in zip(converters, [obj.get(name) for name in names])]
+    return decode
@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+#
+# Matching of dictionary phrases in sentences.
+#
+# The generic features look for every phrase of a sentence (a sequence of
+# lemmas joined by spaces) in every dictionary. PhraseMatcher compiles all the
+# dictionaries into a single Aho-Corasick automaton over tokens, so that one
+# left-to-right pass over the lemmas of a sentence finds all the phrases that
+# appear in any dictionary, however many dictionaries there are.
+#
+# Compiled dictionaries (see compile_dict) are too large to be put in the
+# automaton, and are instead probed with every phrase of the sentence up to the
+# number of words of their longest entry. Their matches are merged with those
+# of the automaton.
+#
+
+from compile_dict import CompiledDictionary
+
+
+class PhraseMatcher(object):
+    """An Aho-Corasick automaton over the phrases of a set of dictionaries.
+
+    A phrase matches a sequence of tokens if it is equal to the tokens joined
+    by single spaces.
+    """
+
+    def __init__(self, dictionaries):
+        """
+        Args:
+            dictionaries: a sequence of (dict_id, dictionary) pairs, where
+                each dictionary is a collection of phrases. Entries that are
+                not strings are ignored, since they never match.
+        """
+        # The dict_ids of the dictionaries containing each phrase, in the
+        # order of the dictionaries
+        self.phrases = {}
+        self._positions = {}
+        self._probed = []
+        for position, (dict_id, dictionary) in enumerate(dictionaries):
+            self._positions[dict_id] = position
+            if isinstance(dictionary, CompiledDictionary):
+                self._probed.append((dict_id, dictionary))
+                continue
+            for phrase in dictionary:
+                if isinstance(phrase, basestring):
+                    self.phrases.setdefault(phrase, []).append(dict_id)
+        for phrase, dict_ids in self.phrases.iteritems():
+            self.phrases[phrase] = tuple(dict_ids)
+        # The automaton: the transitions, the failure link, the phrase ending
+        # at each node (as (length, dict_ids)), and the link to the next node
+        # on the failure chain at which a phrase ends.
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None]
+        self._output_link = [0]
+        self.max_length = 0
+        for phrase, dict_ids in self.phrases.iteritems():
+            tokens = phrase.split(" ")
+            self.max_length = max(self.max_length, len(tokens))
+            node = 0
+            for token in tokens:
+                next_node = self._goto[node].get(token)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][token] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                    self._output_link.append(0)
+                node = next_node
+            self._output[node] = (len(tokens), dict_ids)
+        self._link()
+        # The number of words of the longest entry of a compiled dictionary
+        self._probed_length = 0
+        for dict_id, dictionary in self._probed:
+            self._probed_length = max(self._probed_length,
+                                      dictionary.max_words)
+        self.max_length = max(self.max_length, self._probed_length)
+
+    def _link(self):
+        """Compute the failure and output links, breadth first."""
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for token, child in self._goto[node].iteritems():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(token, 0)
+                if fail == child:
+                    fail = 0
+                self._fail[child] = fail
+                self._output_link[child] = fail if self._output[fail] else \
+                    self._output_link[fail]
+
+    def lookup(self, phrase):
+        """Return the dict_ids of the dictionaries containing a phrase, or an
+        empty tuple."""
+        dict_ids = self.phrases.get(phrase, ())
+        if self._probed:
+            probed = [dict_id for dict_id, dictionary in self._probed
+                      if phrase in dictionary]
+            if probed:
+                dict_ids = self._merge(dict_ids, probed)
+        return dict_ids
+
+    def find(self, tokens):
+        """Return all the phrases of the dictionaries found in a sequence of
+        tokens, as a list of (start, end, dict_ids) sorted by start, and then
+        by decreasing end.
+
+        Args:
+            tokens: a sequence of strings, e.g. the lemmas of a sentence
+        """
+        if not self.phrases and not self._probed:
+            return []
+        for token in tokens:
+            if " " in token:
+                # A phrase could span a part of a token; look at every phrase.
+                return self._find_joined(tokens)
+        matches = self._find_phrases(tokens) if self.phrases else []
+        if self._probed:
+            matches = self._find_probed(tokens, matches)
+        return matches
+
+    def _find_phrases(self, tokens):
+        # The matches of the automaton, i.e., of the dictionaries in memory
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        output_link = self._output_link
+        matches = []
+        node = 0
+        for end, token in enumerate(tokens, 1):
+            while node and token not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(token, 0)
+            found = node if output[node] else output_link[node]
+            while found:
+                length, dict_ids = output[found]
+                matches.append((end - length, -end, dict_ids))
+                found = output_link[found]
+        matches.sort()
+        return [(start, -end, dict_ids) for start, end, dict_ids in matches]
+
+    def _find_probed(self, tokens, matches):
+        # Add the matches of the compiled dictionaries to those of the
+        # automaton.
+        found = dict(((start, end), dict_ids)
+                     for start, end, dict_ids in matches)
+        for start in xrange(len(tokens)):
+            for end in xrange(min(len(tokens), start + self._probed_length),
+                              start, -1):
+                phrase = " ".join(tokens[start:end])
+                probed = [dict_id for dict_id, dictionary in self._probed
+                          if end - start <= dictionary.max_words and
+                          phrase in dictionary]
+                if probed:
+                    dict_ids = found.get((start, end))
+                    found[(start, end)] = self._merge(dict_ids, probed) \
+                        if dict_ids else tuple(probed)
+        matches = [(start, end, dict_ids)
+                   for (start, end), dict_ids in found.iteritems()]
+        matches.sort(key=lambda match: (match[0], -match[1]))
+        return matches
+
+    def _find_joined(self, tokens):
+        # A phrase of max_length words has max_length - 1 spaces, so no
+        # sequence of more tokens can be equal to it.
+        matches = []
+        for start in xrange(len(tokens)):
+            for end in xrange(min(len(tokens), start + self.max_length),
+                              start, -1):
+                dict_ids = self.lookup(" ".join(tokens[start:end]))
+                if dict_ids:
+                    matches.append((start, end, dict_ids))
+        return matches
+
+    def _merge(self, dict_ids, other_dict_ids):
+        return tuple(sorted(set(dict_ids).union(other_dict_ids),
+                            key=self._positions.__getitem__))
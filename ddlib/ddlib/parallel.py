@@ -0,0 +1,188 @@
+#! /usr/bin/env python
+#
+# Running a UDF on all the cores of a machine from a single process.
+#
+# The tsv_extractor runs one Python interpreter per input chunk, and each of
+# them pays for loading the dictionaries and other resources of the UDF.
+# run_parallel instead loads them once, forks a pool of workers that share
+# them copy-on-write, and feeds the workers batches of input rows:
+#
+#   import ddlib
+#
+#   def init():
+#       ddlib.load_dictionary(APP_HOME + "/udf/dicts/married.txt", "married")
+#
+#   def process_row(row):
+#       ...
+#       yield (row.relation_id, feature)
+#
+#   ddlib.run_parallel(process_row, init=init,
+#                      schema="words text[], relation_id bigint")
+#
+
+import sys
+import collections
+import multiprocessing
+import multiprocessing.util
+
+from dd import flush_log, _close_all
+from io import BLOCK_SIZE, RowWriter, row_parser, _read_lines
+
+# Set in the parent process before forking, so that the workers inherit them
+# instead of receiving them through pickling.
+_process_row = None
+_parse = None
+_writer = None
+_aggregator = None
+
+
+class _Chunks(object):
+    """A stream that keeps what is written to it."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def flush(self):
+        pass
+
+
+def run_parallel(process_row, init=None, schema=None, processes=None,
+                 batch_size=1000, ordered=True, input=None, output=None,
+                 aggregator=None, **read_options):
+    """Run process_row on every row of the input using a pool of processes,
+    and write what it returns to the output.
+
+    Args:
+        process_row: a function called with each input row that returns (or
+            yields) the output rows for it. Output rows that are strings are
+            written as they are, one per line, without escaping (so a UDF can
+            return the TSV lines it used to print); tuples and lists are
+            written as TSV rows, with their fields escaped (see
+            ddlib.io.RowWriter).
+        init: (optional) a function called once, before the workers are
+            forked. Whatever it loads (e.g. with load_dictionary) is shared by
+            all the workers.
+        schema: (optional) the schema of the input (see ddlib.io.read_rows).
+            If given, process_row receives namedtuples parsed by the workers;
+            otherwise it receives the lines of the input without the newline.
+        processes: number of worker processes, the number of cores by default.
+            With 1, rows are processed in this process.
+        batch_size: number of input rows sent to a worker at a time
+        ordered: if True, the output follows the order of the input; if False,
+            batches are written as soon as they are done
+        input: where to read from, sys.stdin by default
+        output: where to write to, sys.stdout by default
+        aggregator: (optional) a ddlib.io.FeatureAggregator. process_row must
+            then return (id, feature) pairs, which are aggregated batch by
+            batch. Its writer is replaced by the one of the batches.
+        read_options: format, null and array_delim, passed on to
+            ddlib.io.row_parser when schema is given
+    """
+    global _process_row, _parse, _writer, _aggregator
+    if init is not None:
+        init()
+    if input is None:
+        input = sys.stdin
+    if output is None:
+        output = sys.stdout
+    _process_row = process_row
+    _parse = row_parser(schema, **read_options) if schema is not None \
+        else None
+    _writer = None
+    _aggregator = aggregator
+    batches = _batches(_read_lines(input, BLOCK_SIZE), batch_size)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes <= 1:
+        for batch in batches:
+            output.write(_run_batch(batch))
+        output.flush()
+        return
+    # Anything buffered now would be written once by every worker.
+    flush_log()
+    output.flush()
+    pool = multiprocessing.Pool(processes, _init_worker)
+    try:
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.apply_async(_run_batch, (batch,)))
+            # Bound the number of batches in flight, so that the input is
+            # not read into memory faster than it is processed.
+            while len(pending) >= 2 * processes:
+                output.write(_next_result(pending, ordered))
+        while pending:
+            output.write(_next_result(pending, ordered))
+        output.flush()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _init_worker():
+    # Pool workers end with os._exit, which skips the atexit handlers. Close
+    # the ddlib objects of the worker when it finishes instead, so that what
+    # its FeatureHashers, FeatureAggregators and RowWriters buffered is
+    # written. Those of the parent (and its other exit handlers) are left to
+    # the parent.
+    multiprocessing.util.Finalize(None, _close_all, exitpriority=0)
+
+
+def _batches(lines, batch_size):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _next_result(pending, ordered):
+    """Remove a finished batch from pending and return its output: the
+    oldest one if ordered, otherwise the first one to finish."""
+    if not ordered:
+        while True:
+            for result in pending:
+                if result.ready():
+                    pending.remove(result)
+                    return result.get()
+            pending[0].wait(0.01)
+    return pending.popleft().get()
+
+
+def _run_batch(batch):
+    """Process a batch of input lines and return the output as a string."""
+    global _writer
+    if _writer is None:
+        _writer = RowWriter(stream=_Chunks())
+        if _aggregator is not None:
+            _aggregator.writer = _writer
+    writer = _writer
+    if _aggregator is not None:
+        for line in batch:
+            row = _parse(line) if _parse is not None else line
+            for row_id, feature in _process_row(row) or ():
+                _aggregator.write(row_id, feature)
+        _aggregator.flush()
+    else:
+        for line in batch:
+            row = _parse(line) if _parse is not None else line
+            for out in _process_row(row) or ():
+                if isinstance(out, basestring):
+                    writer.write_line(out)
+                else:
+                    writer.write(*out)
+    writer.flush()
+    # Workers exit without running atexit handlers, so the log is flushed
+    # after every batch.
+    flush_log()
+    output = "".join(writer.stream.chunks)
+    writer.stream.chunks = []
+    return output
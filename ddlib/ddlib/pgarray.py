@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+#
+# Decoding and encoding of the text representations of arrays that extractor
+# UDFs receive from the database: PostgreSQL array literals such as
+# {a,"b c",NULL} (including nested arrays), and arrays aggregated into a single
+# string joined with ARR_DELIM, as done in the examples.
+#
+
+import re
+
+# The delimiter used by the examples to aggregate arrays into a single string
+ARR_DELIM = "~^~"
+
+# Tokens of an array literal: braces, delimiters, quoted elements (with
+# backslash escapes) and unquoted elements. Whitespace between tokens is
+# skipped.
+_TOKEN = re.compile(r'\s*(?:([{}])|(,)|"((?:[^"\\]|\\.)*)"|'
+                    r'((?:[^{},"\\\s]|\\.)(?:[^{},"\\]|\\.)*))', re.S)
+_BACKSLASH = re.compile(r"\\(.)", re.S)
+_DIMENSIONS = re.compile(r"^\s*(?:\[-?\d+:-?\d+\])+\s*=")
+_NEEDS_QUOTES = re.compile(r'[{}",\\\s]')
+
+
+def decode_array(text, convert=None):
+    """Decode a PostgreSQL array literal into a (possibly nested) list.
+
+    Unquoted NULL elements become None. Optional dimension decorations such
+    as "[0:2]=" are ignored.
+
+    Args:
+        text: the array literal, e.g. '{a,"b c",NULL}' or '{{1,2},{3,4}}'
+        convert: (optional) a function applied to every non-NULL element, e.g.
+            int
+    Raises:
+        ValueError if text is not a well-formed array literal.
+    """
+    if text[:1] == "[":
+        text = _DIMENSIONS.sub("", text, 1)
+    text = text.strip()
+    if text[:1] != "{" or text[-1:] != "}":
+        raise ValueError("Not an array literal: %r" % text)
+    body = text[1:-1]
+    # Fast path: a one-dimensional array without quoted or escaped elements
+    # is a plain split.
+    if '"' not in body and "\\" not in body and "{" not in body and \
+            "}" not in body:
+        if not body.strip():
+            return []
+        elements = body.split(",")
+        if " " in body or "\t" in body or "\n" in body:
+            elements = [e.strip() for e in elements]
+        if "" in elements:
+            raise ValueError("Empty element in array literal: %r" % text)
+        if convert is None:
+            return [None if len(e) == 4 and e.upper() == "NULL" else e
+                    for e in elements]
+        return [None if len(e) == 4 and e.upper() == "NULL" else convert(e)
+                for e in elements]
+    return _decode_nested(text, convert)
+
+
+def _decode_nested(text, convert):
+    stack = []
+    result = None
+    expect_element = True
+    pos = 0
+    end = len(text.rstrip())
+    while pos < end:
+        m = _TOKEN.match(text, pos)
+        if m is None:
+            raise ValueError("Malformed array literal: %r" % text)
+        pos = m.end()
+        brace, comma, quoted, unquoted = m.groups()
+        if brace == "{":
+            if not expect_element:
+                raise ValueError("Malformed array literal: %r" % text)
+            stack.append([])
+        elif brace == "}":
+            if not stack:
+                raise ValueError("Malformed array literal: %r" % text)
+            finished = stack.pop()
+            if stack:
+                stack[-1].append(finished)
+            elif result is None:
+                result = finished
+            else:
+                raise ValueError("Malformed array literal: %r" % text)
+            expect_element = False
+            continue
+        elif comma:
+            if expect_element or not stack:
+                raise ValueError("Malformed array literal: %r" % text)
+        else:
+            if not expect_element or not stack:
+                raise ValueError("Malformed array literal: %r" % text)
+            if quoted is not None and unquoted is None:
+                value = _BACKSLASH.sub(r"\1", quoted)
+            else:
+                value = unquoted.rstrip()
+                if value.upper() == "NULL":
+                    value = None
+                elif "\\" in value:
+                    value = _BACKSLASH.sub(r"\1", value)
+            if value is not None and convert is not None:
+                value = convert(value)
+            stack[-1].append(value)
+            expect_element = False
+            continue
+        expect_element = True
+    if stack or result is None:
+        raise ValueError("Malformed array literal: %r" % text)
+    return result
+
+
+def encode_array(values):
+    """Encode a (possibly nested) list as a PostgreSQL array literal.
+
+    None becomes NULL; elements that are empty, spell NULL, or contain
+    braces, quotes, commas, backslashes or whitespace are quoted.
+    """
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append("NULL")
+            continue
+        if isinstance(value, (list, tuple)):
+            elements.append(encode_array(value))
+            continue
+        if isinstance(value, unicode):
+            element = value.encode("utf-8")
+        elif isinstance(value, bool):
+            element = "t" if value else "f"
+        elif isinstance(value, float):
+            element = repr(value)
+        else:
+            element = str(value)
+        if element == "" or element.upper() == "NULL" or \
+                _NEEDS_QUOTES.search(element) is not None:
+            element = '"' + element.replace("\\", "\\\\").replace(
+                '"', '\\"') + '"'
+        elements.append(element)
+    return "{" + ",".join(elements) + "}"
+
+
+def split_array(text, delim=ARR_DELIM, convert=None):
+    """Split an array aggregated into a single string with delim.
+
+    An empty string is an empty array.
+    """
+    if not text:
+        return []
+    elements = text.split(delim)
+    if convert is None:
+        return elements
+    return map(convert, elements)
+
+
+def join_array(values, delim=ARR_DELIM):
+    """Join an array into a single string with delim, the inverse of
+    split_array."""
+    return delim.join([v.encode("utf-8") if isinstance(v, unicode) else str(v)
+                       for v in values])
+
+
+def decode_column(value, convert=None, delim=None):
+    """Return a column of a sentence as a list.
+
+    Lists and tuples are returned as they are. Strings are decoded: split on
+    delim if it is given, parsed as a PostgreSQL array literal otherwise.
+    """
+    if not isinstance(value, basestring):
+        return value
+    if delim is not None:
+        return split_array(value, delim, convert)
+    return decode_array(value, convert)
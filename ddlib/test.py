@@ -1,7 +1,24 @@
 #! /usr/bin/env python
 
+import os
+import shutil
+import tempfile
 import unittest
+import weakref
+from StringIO import StringIO
 import ddlib as dd
+from ddlib.io import read_rows, RowWriter, FeatureAggregator
+from ddlib.pgarray import decode_array, encode_array, split_array
+from ddlib.matcher import PhraseMatcher
+from ddlib.compile_dict import compile_dictionary, CompiledDictionary
+from ddlib import graph
+from ddlib.gen_feats import _get_min_dep_path, _get_min_dep_path_features, \
+  _get_dictionary_substitution, _SentenceContext
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 class TestDDLib(unittest.TestCase):
 
@@ -24,6 +41,526 @@ class TestDDLib(unittest.TestCase):
     words_between = dd.tokens_between_spans(self.words, span1, span1)
     self.assertEqual(words_between[:], (False, []))
 
+  def test_unpack_words(self):
+    obj = {"words": self.words, "lemma": self.lemma,
+           "pos": ["NNP", "VBD", "NNP", "CD", "NNS", "RB"],
+           "dep_graph": ["2\tnsubj\t1", "2\tdobj\t3"]}
+    sentence = dd.unpack_words(obj, words="words", lemma="lemma", pos="pos",
+      dep_graph="dep_graph", dep_graph_parser=dd.dep_graph_parser_triplet)
+    self.assertEqual(len(sentence), 6)
+    self.assertEqual(sentence[0], dd.Word(begin_char_offset=None,
+      end_char_offset=None, word="Tanja", lemma="Tanja", pos="NNP", ner=None,
+      dep_par=1, dep_label="nsubj"))
+    self.assertEqual(sentence[-1].dep_par, -1)
+    self.assertEqual(sentence[-1].dep_label, "ROOT")
+    self.assertEqual([w.lemma for w in sentence], self.lemma)
+    self.assertEqual(dd.materialize_span(sentence, dd.Span(0, 2),
+      lambda w: w.word), ["Tanja", "married"])
+
+  def test_unpack_words_dep_graph_formats(self):
+    edges = ["nsubj(married-2, Tanja-1)", "dobj(married-2, Jake-3)",
+             "root(ROOT-0, married-2)"]
+    for parser in ["parenthesis", dd.dep_graph_parser_parenthesis,
+                   lambda e: dd.dep_graph_parser_parenthesis(e)]:
+      sentence = dd.unpack_words({"words": self.words, "dep_graph": edges},
+        words="words", dep_graph="dep_graph", dep_graph_parser=parser)
+      self.assertEqual(list(sentence.dep_pars), [1, -1, 1, -1, -1, -1])
+      self.assertEqual(sentence.dep_labels[:3], ("nsubj", "root", "dobj"))
+    with self.assertRaises(ValueError):
+      dd.unpack_words({"words": self.words, "dep_graph": ["1\tnsubj"]},
+        words="words", dep_graph="dep_graph", dep_graph_parser="triplet")
+
+  def test_tag_vocabulary(self):
+    vocabulary = dd.Vocabulary()
+    self.assertEqual(list(vocabulary.encode(["NN", "VB", "NN", None])),
+      [1, 2, 1, 0])
+    self.assertEqual(vocabulary.decode([2, 1]), ("VB", "NN"))
+    self.assertEqual(vocabulary.code(u"NN"), 3)
+    sentence = dd.Sentence(words=["a", "b"], poses=["NN", "VB"],
+      ners=[u"O", u"O"], encode_tags=True)
+    self.assertTrue(isinstance(sentence.poses, dd.TagColumn))
+    self.assertEqual(sentence.poses, ("NN", "VB"))
+    self.assertEqual(sentence.ners.codes[0],
+      dd.tag_vocabulary.code(u"O"))
+    self.assertEqual(sentence[1], dd.Sentence(words=["a", "b"],
+      poses=["NN", "VB"], ners=[u"O", u"O"])[1])
+    self.assertEqual(type(sentence[0].ner), unicode)
+    self.assertEqual(sentence[0].dep_label, "ROOT")
+
+  def test_dep_path_between_words(self):
+    sentence = dd.get_sentence(range(6), range(6), self.words, self.lemma,
+      ["NNP", "VBD", "NNP", "CD", "NNS", "RB"],
+      ["2\tnsubj\t1", "2\tdobj\t3", "5\tnum\t4", "6\tnpadvmod\t5",
+       "2\tadvmod\t6"], ["O"] * 6, dd.dep_graph_parser_triplet)
+    path = dd.dep_path_between_words(sentence, 0, 3)
+    self.assertEqual([(e.word1.word, e.word2.word, e.label, e.is_bottom_up)
+      for e in path], [("Tanja", "married", "nsubj", True),
+      ("married", "ago", "advmod", False), ("ago", "years", "npadvmod", False),
+      ("years", "five", "num", False)])
+    self.assertEqual(sentence.dep_index.distance(0, 3), 4)
+    self.assertEqual(dd.dep_path_between_words(sentence, 4, 4), [])
+
+  def test_dep_path_with_cycle(self):
+    sentence = dd.Sentence(words=["a", "b", "c"], dep_pars=[1, 0, 1],
+      dep_labels=["x", "y", "z"])
+    path = dd.dep_path_between_words(sentence, 2, 0)
+    self.assertEqual([(e.word1.word, e.word2.word) for e in path], [("c", "b")])
+    self.assertEqual(dd.dep_path_between_words(sentence, 1, 0), [])
+    self.assertEqual(dd.dep_path_between_words(list(sentence), 2, 0), path)
+
+  def test_dep_path_with_parent_outside_sentence(self):
+    def edges(words):
+      return [(e.word1.word, e.word2.word, e.label) for e in
+        dd.dep_path_between_words(words, 0, 2)]
+    labels = ["x", "y", "z"]
+    expected = edges(dd.Sentence(words=["a", "b", "c"], dep_pars=[-1, -1, 1],
+      dep_labels=labels))
+    sentence = dd.Sentence(words=["a", "b", "c"], dep_pars=[7, 5, 1],
+      dep_labels=labels)
+    self.assertEqual(edges(sentence), expected)
+    self.assertEqual(edges(list(sentence)), expected)
+    sentence = dd.unpack_words({"words": self.words, "dep_graph":
+      ["nsubj(married-9, Tanja-1)", "dobj(married-2, Jake-3)"]},
+      words="words", dep_graph="dep_graph", dep_graph_parser="parenthesis")
+    self.assertEqual(list(sentence.dep_pars[:3]), [-1, -1, 1])
+
+  @unittest.skipIf(numpy is None, "requires numpy")
+  def test_dep_distance_matrix(self):
+    sentence = dd.Sentence(words=self.words, dep_pars=[1, -1, 1, 4, 5, 1])
+    distances = dd.dep_distance_matrix(sentence)
+    self.assertEqual(distances.dtype, numpy.int16)
+    for i in range(6):
+      for j in range(6):
+        self.assertEqual(distances[i, j],
+          len(dd.dep_path_between_words(sentence, i, j)))
+    self.assertEqual(dd.min_dep_distance_pair(distances, dd.Span(0, 1),
+      dd.Span(3, 3)), (0, 5))
+    self.assertEqual(dd.dep_distance_matrix(sentence, [4, 0], [5]).tolist(),
+      [[distances[4, 5]], [distances[0, 5]]])
+    # Several trees, a cycle and a parent outside the sentence
+    index = dd.DepIndex([-1, 0, 3, 4, 2, 4, 9, -1])
+    distances = index.distance_matrix()
+    self.assertEqual(distances.tolist(), [[index.distance(i, j)
+      for j in range(8)] for i in range(8)])
+    # Once enough pairs were asked for, the shortest paths of a sentence are
+    # looked up in its distance matrix, with the same results.
+    context = _SentenceContext(sentence)
+    spans = [dd.Span(i, length) for i in range(6)
+      for length in range(1, 7 - i)]
+    paths = [context.min_dep_path(span1, span2) for span1 in spans
+      for span2 in spans]
+    self.assertTrue(context._dep_distances is not None)
+    self.assertEqual(paths, [_get_min_dep_path(sentence, span1, span2)
+      for span1 in spans for span2 in spans])
+
+  @unittest.skipIf(numpy is None, "requires numpy")
+  def test_graph(self):
+    directory = tempfile.mkdtemp()
+    try:
+      records = {
+        "weights": numpy.array([(0, 0, 0.5), (1, 1, 0.0)], graph.WEIGHT),
+        "variables": numpy.array([(vid, vid < 2, 1.0, 0, -1, 2)
+          for vid in range(4)], graph.VARIABLE),
+        "factors": numpy.array([(0, 0, 4, 2), (1, 0, 4, 1)], graph.FACTOR),
+        "edges": numpy.array([(0, 0, 0, 1, 1), (1, 0, 1, 0, 1),
+          (2, 1, 0, 1, 1)], graph.EDGE)}
+      for name, data in records.items():
+        data.tofile(os.path.join(directory, "graph." + name))
+      with open(os.path.join(directory, "graph.meta"), "w") as f:
+        f.write("2,4,2,3,graph.weights,graph.variables,graph.factors," +
+          "graph.edges\n")
+      g = graph.Graph(directory)
+      self.assertEqual(os.path.getsize(os.path.join(directory,
+        "graph.variables")), 4 * 35)
+      self.assertEqual(g.validate(), [])
+      stats = g.stats()
+      self.assertEqual((stats["evidence_ratio"], stats["orphan_variables"],
+        stats["unused_weights"]), (0.5, 1, 1))
+      self.assertEqual(stats["degree_distribution"], [1, 3])
+      self.assertEqual(stats["arity_distribution"], [0, 1, 1])
+      self.assertEqual(list(g.orphan_variables()), [3])
+      self.assertEqual(list(g.weight_usage()), [2, 0])
+      with open(os.path.join(directory, "graph.edges"), "ab") as f:
+        numpy.array([(7, 1, 1, 1, 1)], graph.EDGE).tofile(f)
+      self.assertEqual(graph.Graph(directory).validate(), [
+        "graph.meta has 3 edges, graph.edges has 4",
+        "1 edges have a vid out of range, e.g. record 3 (vid 7)",
+        "the factors have 3 edges, graph.edges has 4",
+        "1 factors do not have as many edges as they should, e.g. fid 1 " +
+        "has 2 instead of 1"])
+    finally:
+      shutil.rmtree(directory)
+
+  def test_logger(self):
+    stream = StringIO()
+    logger = dd.Logger(stream=stream, sample_rate=2, rate_limit=2,
+      rate_interval=3600)
+    for i in range(6):
+      logger.log(i, key="row")
+    logger.log("other")
+    self.assertEqual(stream.getvalue(), "")
+    logger.close()
+    self.assertEqual(stream.getvalue().splitlines(), ["0", "2", "other",
+      "ddlib.log: suppressed 4 of 6 messages with key row"])
+    # The workers of run_parallel write their own summaries when they exit.
+    fd, path = tempfile.mkstemp()
+    try:
+      with os.fdopen(fd, "w") as f:
+        dd.configure_log(stream=f, sample_rate=2)
+        try:
+          dd.run_parallel(lambda line: dd.log(line, key="row"), processes=2,
+            batch_size=7, input=StringIO("".join("%d\n" % i
+            for i in range(50))), output=StringIO())
+        finally:
+          dd.configure_log()
+      with open(path) as f:
+        lines = f.read().splitlines()
+    finally:
+      os.remove(path)
+    summaries = [map(int, l.split()[2:5:2]) for l in lines
+      if l.startswith("ddlib.log: suppressed")]
+    self.assertTrue(summaries)
+    self.assertEqual(sum(seen for suppressed, seen in summaries), 50)
+    self.assertEqual(len(lines) - len(summaries) + sum(suppressed
+      for suppressed, seen in summaries), 50)
+
+  def test_span_view(self):
+    view = dd.materialize_span(self.words, dd.Span(1, 3), lambda w: w.upper())
+    self.assertEqual(len(view), 3)
+    self.assertEqual(view[-1], "FIVE")
+    self.assertTrue("JAKE" in view)
+    self.assertFalse("Jake" in view)
+    self.assertEqual(list(view), ["MARRIED", "JAKE", "FIVE"])
+    self.assertEqual(view.materialize(), ["MARRIED", "JAKE", "FIVE"])
+    self.assertEqual(view[1:], ["JAKE", "FIVE"])
+    self.assertEqual(len(dd.materialize_span(self.words, dd.Span(5, 4))), 1)
+
+  def test_read_rows(self):
+    data = StringIO('{Tanja,"Jake Smith",NULL}\t1\ta\\tb\n'
+                    '{}\t\\N\t\\N\n')
+    rows = list(read_rows("words text[], relation_id bigint, note text",
+      stream=data, block_size=7))
+    self.assertEqual(rows[0], (["Tanja", "Jake Smith", None], 1, "a\tb"))
+    self.assertEqual(rows[1].words, [])
+    self.assertEqual(rows[1].relation_id, None)
+    rows = list(read_rows([("p1.words", "text[]"), ("p1.start", "int")],
+      stream=StringIO("a~^~b\t3\n"), array_delim=dd.io.ARR_DELIM))
+    self.assertEqual(rows[0].p1_words, ["a", "b"])
+    self.assertRaises(ValueError, list, read_rows("a int, b int",
+      stream=StringIO("1\n")))
+    rows = list(read_rows("words text[], id bigint, score float, ok boolean",
+      stream=StringIO('{"words": ["a", "\\u00e9"], "id": "3", "score": 1, ' +
+      '"ok": "t"}\n{"id": null, "ok": false}\n'), format="json"))
+    self.assertEqual(rows, [(["a", "\xc3\xa9"], 3, 1.0, True),
+      (None, None, None, False)])
+    self.assertEqual([type(v) for v in rows[0]], [list, int, float, bool])
+
+  def test_row_writer(self):
+    out = StringIO()
+    with RowWriter(stream=out) as writer:
+      writer.write(1, None, "a\tb\\", ["x", "y z", None], 0.1, True)
+    self.assertEqual(out.getvalue(),
+      '1\t\\N\ta\\tb\\\\\t{x,"y z",NULL}\t0.1\tt\n')
+    rows = list(read_rows("a int, b text, c text, d text[], e float, f bool",
+      stream=StringIO(out.getvalue())))
+    self.assertEqual(rows[0], (1, None, "a\tb\\", ["x", "y z", None], 0.1,
+      True))
+
+  def test_feature_aggregator(self):
+    out = StringIO()
+    with FeatureAggregator(RowWriter(stream=out), count=True) as aggregator:
+      aggregator.write_all(1, ["a", "b", "a"])
+      aggregator.write(2, "a")
+      aggregator.write(1, "b")
+    self.assertEqual(out.getvalue(), "1\ta\t2\n1\tb\t2\n2\ta\t1\n")
+    out = StringIO()
+    dictionary = StringIO()
+    aggregator = FeatureAggregator(RowWriter(stream=out),
+      dictionary_file=dictionary)
+    aggregator.write_all(1, ["a\tb", "c", "a\tb"])
+    aggregator.write(2, "c")
+    aggregator.flush()
+    aggregator.write(3, "c")
+    aggregator.close()
+    rows = list(read_rows("id int, batch bigint, code int",
+      stream=StringIO(out.getvalue())))
+    codes = dict(((batch, code), feature) for batch, code, feature in
+      read_rows("batch bigint, code int, feature text",
+      stream=StringIO(dictionary.getvalue())))
+    self.assertEqual([(row.id, codes[row.batch, row.code]) for row in rows],
+      [(1, "a\tb"), (1, "c"), (2, "c"), (3, "c")])
+    self.assertEqual([row.code for row in rows], [0, 1, 1, 0])
+    self.assertNotEqual(rows[0].batch, rows[3].batch)
+
+  def test_pgarray(self):
+    self.assertEqual(decode_array("{}"), [])
+    self.assertEqual(decode_array("{1, 2,NULL}", int), [1, 2, None])
+    self.assertEqual(decode_array('{"a \\"b\\"",NULL,"NULL",c\\,d}'),
+      ['a "b"', None, "NULL", "c,d"])
+    self.assertEqual(decode_array('[1:2][1:1]={{"x y"},{z}}'),
+      [["x y"], ["z"]])
+    self.assertRaises(ValueError, decode_array, "{a,{b}")
+    self.assertRaises(ValueError, decode_array, "a,b")
+    values = [["a b", None, "NULL", ""], ['q"\\', "{}"]]
+    self.assertEqual(decode_array(encode_array(values)), values)
+    self.assertEqual(split_array("a~^~b"), ["a", "b"])
+    self.assertEqual(split_array(""), [])
+
+  def test_get_sentence_from_strings(self):
+    sentence = dd.get_sentence("{0,6}", "{5,13}", '{Tanja,"married"}',
+      "{Tanja,marry}", "{NNP,VBD}", '{"nsubj(married-2, Tanja-1)"}',
+      "{PERSON,O}")
+    self.assertEqual(sentence[0].begin_char_offset, 0)
+    self.assertEqual(sentence[1].lemma, "marry")
+    self.assertEqual(sentence[0].dep_par, 1)
+    sentence = dd.get_sentence("0~^~6", "5~^~13", "Tanja~^~married",
+      "Tanja~^~marry", "NNP~^~VBD", "2\tnsubj\t1", "PERSON~^~O",
+      dd.dep_graph_parser_triplet, array_delim="~^~")
+    self.assertEqual(list(sentence.end_char_offsets), [5, 13])
+    self.assertEqual(sentence[0].dep_label, "nsubj")
+
+  def test_phrase_matcher(self):
+    matcher = PhraseMatcher([("d1", ["a b", "b", "c a b"]),
+      ("d2", ["b", "b c a b c"]), ("d3", [1])])
+    self.assertEqual(matcher.find("c a b c a b c".split()), [
+      (0, 3, ("d1",)), (1, 3, ("d1",)), (2, 7, ("d2",)), (2, 3, ("d1", "d2")),
+      (3, 6, ("d1",)), (4, 6, ("d1",)), (5, 6, ("d1", "d2"))])
+    self.assertEqual(matcher.find(["c", "a b", "x"]), [(0, 2, ("d1",)),
+      (1, 2, ("d1",))])
+    self.assertEqual(matcher.lookup("b"), ("d1", "d2"))
+    self.assertEqual(matcher.find([]), [])
+
+  def test_compiled_dictionary(self):
+    directory = tempfile.mkdtemp()
+    try:
+      source = os.path.join(directory, "dict.txt")
+      compiled = os.path.join(directory, "dict.ddict")
+      with open(source, "w") as f:
+        f.write("Wife\nmarry\n a b \nwife\n")
+      self.assertEqual(compile_dictionary(source, compiled, str.lower), 3)
+      dictionary = CompiledDictionary(compiled)
+      self.assertEqual(set(dictionary), set(["wife", "marry", "a b"]))
+      self.assertTrue(u"a b" in dictionary)
+      self.assertFalse("Wife" in dictionary or "" in dictionary)
+      self.assertEqual(dictionary.max_words, 2)
+      dictionary.close()
+      self.assertRaises(ValueError, dd.load_dictionary, compiled, "c",
+        str.upper)
+      self.assertRaises(ValueError, dd.load_dictionary, compiled, "c",
+        lambda entry: entry.lower())
+      self.assertRaises(ValueError, compile_dictionary, source, compiled,
+        lambda entry: entry.lower())
+      dict_id = dd.load_dictionary(compiled, "c", str.lower)
+      try:
+        matcher = PhraseMatcher([("m", ["marry", "b"]),
+          (dict_id, dd.dictionaries[dict_id])])
+        self.assertEqual(matcher.find(["a", "b", "marry"]),
+          [(0, 2, ("c",)), (1, 2, ("m",)), (2, 3, ("m", "c"))])
+        # The dictionaries in memory are matched by the automaton, with
+        # phrases longer than those of the compiled dictionary, and merged
+        # with the compiled dictionary's matches in the order of the
+        # dictionaries.
+        matcher = PhraseMatcher([(dict_id, dd.dictionaries[dict_id]),
+          ("m", ["marry", "b", "a b marry wife"])])
+        tokens = ["a", "b", "marry", "wife", "a", "b"]
+        self.assertEqual(matcher.find(tokens), [(0, 4, ("m",)),
+          (0, 2, ("c",)), (1, 2, ("m",)), (2, 3, ("c", "m")),
+          (3, 4, ("c",)), (4, 6, ("c",)), (5, 6, ("m",))])
+        self.assertEqual(matcher.find(tokens), matcher._find_joined(tokens))
+      finally:
+        dd.dictionaries.pop(dict_id).close()
+    finally:
+      shutil.rmtree(directory)
+
+  def test_get_generic_features_sentence(self):
+    sentence = dd.get_sentence(range(5), range(1, 6),
+      ["Tanja", "married", "Jake", "in", "1989"],
+      ["Tanja", "marry", "Jake", "in", "1989"], ["NNP", "VBD", "NNP", "IN",
+      "CD"], ["2\tnsubj\t1", "2\tdobj\t3", "2\tprep\t4", "4\tpobj\t5"],
+      ["PERSON", "O", "PERSON", "O", "DATE"], dd.dep_graph_parser_triplet)
+    mentions = {"m1": dd.Span(0, 1), "m2": dd.Span(2, 1), "m3": dd.Span(4, 1)}
+    pairs = [("p1", "m1", "m2"), ("p2", "m2", "m1"), ("p3", "m1", "m3")]
+    expected = [(pair_id, feature) for pair_id, m1, m2 in pairs
+      for feature in dd.get_generic_features_relation(sentence,
+        mentions[m1], mentions[m2])]
+    self.assertEqual(list(dd.get_generic_features_sentence(sentence,
+      mentions, pairs)), expected)
+    features = set(dd.get_generic_features_sentence(sentence, mentions))
+    self.assertEqual(features, set((mention_id, feature)
+      for mention_id, span in mentions.items()
+      for feature in dd.get_generic_features_mention(sentence, span)))
+
+  def test_min_dep_path(self):
+    sentence = dd.Sentence(words=["a", "b", "c", "d"], lemmas=["a", "b", "c",
+      "d"], dep_pars=[-1, 0, 1, 2], dep_labels=["ROOT", "x", "y", "z"])
+    path = _get_min_dep_path(sentence, dd.Span(2, 2), dd.Span(0, 1))
+    self.assertEqual([(e.word1.word, e.word2.word) for e in path],
+      [("c", "b"), ("b", "a")])
+    self.assertEqual(_get_min_dep_path(list(sentence), dd.Span(2, 2),
+      dd.Span(0, 1)), path)
+    self.assertEqual(list(_get_min_dep_path_features(sentence, dd.Span(2, 2),
+      dd.Span(0, 1), "BETW")), ["BETW_[y b x]", "BETW_L_[y x]",
+      "BETW_D_[y b x]"])
+    self.assertEqual(_get_min_dep_path(sentence, dd.Span(2, 0),
+      dd.Span(0, 1)), None)
+    dd.dictionaries["k"] = frozenset(["b", "c"])
+    try:
+      self.assertEqual(list(_get_min_dep_path_features(sentence,
+        dd.Span(3, 1), dd.Span(0, 1), "BETW"))[2],
+        "BETW_D_[z DICT_k y DICT_k x]")
+      dd.dictionaries["j"] = frozenset(["b"])
+      self.assertEqual(_get_dictionary_substitution("b"),
+        "DICT_" + [d for d in dd.dictionaries if d in "jk"][0])
+      self.assertEqual(_get_dictionary_substitution("d"), "d")
+      # A dictionary loaded after a lookup is used by the next one.
+      fd, path = tempfile.mkstemp()
+      try:
+        os.write(fd, "d\n")
+        os.close(fd)
+        self.assertEqual(dd.load_dictionary(path, "l"), "l")
+      finally:
+        os.remove(path)
+      self.assertEqual(_get_dictionary_substitution("d"), "DICT_l")
+      del dd.dictionaries["l"]
+      self.assertEqual(_get_dictionary_substitution("d"), "d")
+    finally:
+      dd.dictionaries.pop("k")
+      dd.dictionaries.pop("j", None)
+      dd.dictionaries.pop("l", None)
+
+  def test_feature_template(self):
+    sentence = dd.Sentence(words=self.words, lemmas=self.words,
+      poses=["NN"] * len(self.words), ners=["O"] * len(self.words))
+    template = dd.FeatureTemplate(**dict.fromkeys(
+      dd.FeatureTemplate.FAMILIES, False))
+    template.length = True
+    self.assertEqual(list(dd.get_generic_features_mention(sentence,
+      dd.Span(0, 1), template=template)), ["LENGTH_1"])
+    template = dd.FeatureTemplate(window_size=1, ngram_size=1, profile=True)
+    features = list(dd.get_generic_features_relation(sentence, dd.Span(1, 1),
+      dd.Span(4, 1), template=template))
+    self.assertEqual([f for f in features if f.startswith(("NGRAM", "W_"))],
+      ["W_LEMMA_L_1_R_1_[Tanja]_[ago]", "W_NER_L_1_R_1_[O]_[O]",
+       "NGRAM_1_[Jake]", "NGRAM_1_[five]"])
+    profiler = dd.gen_feats._profiler
+    self.assertEqual(profiler.counts["ngram"], 2)
+    profiler.times.clear()
+    profiler.counts.clear()
+
+  def test_normalized_lemmas(self):
+    sentence = dd.Sentence(words=self.words,
+      lemmas=["1.5", " -3 ", "inf", "nano", "tanja", None],
+      ners=["NUMBER", "O"])
+    self.assertEqual(sentence.normalized_lemmas,
+      ["_NUMBER", "_NUMBER", "_NUMBER", "nano", "tanja", "None"])
+    self.assertIs(sentence.normalized_lemmas, sentence.normalized_lemmas)
+    self.assertEqual(sentence.ner_strings,
+      ["NUMBER", "O", "None", "None", "None", "None"])
+    unicode_sentence = dd.Sentence(words=self.words[:3],
+      lemmas=[u"caf\xe9", u"2", u"x"], ners=[u"\xc9", u"O", u"O"])
+    self.assertEqual(unicode_sentence.normalized_lemmas,
+      ["caf\xc3\xa9", "_NUMBER", "x"])
+    self.assertEqual(unicode_sentence.ner_strings, ["\xc3\x89", "O", "O"])
+    self.assertEqual(list(dd.gen_feats._get_window_features(sentence,
+      dd.Span(3, 1), window=1, combinations=False)),
+      ["W_LEFT_1_[_NUMBER]", "W_LEFT_NER_1_[None]", "W_RIGHT_1_[tanja]",
+       "W_RIGHT_NER_1_[None]"])
+
+  def test_unicode_lemmas(self):
+    words = [u"w%d" % i for i in range(10)]
+    lemmas = list(words)
+    lemmas[6] = u"caf\xe9"
+    sentence = dd.Sentence(words=words, lemmas=lemmas, ners=[u"O"] * 10,
+      poses=[u"NN"] * 10, dep_pars=[-1] + range(9), dep_labels=[u"x"] * 10)
+    for s in (sentence, list(sentence)):
+      self.assertTrue(list(dd.get_generic_features_mention(s, dd.Span(0, 1))))
+      self.assertTrue(list(dd.get_generic_features_relation(s, dd.Span(0, 1),
+        dd.Span(2, 1))))
+      self.assertTrue("W_LEFT_1_[caf\xc3\xa9]" in
+        dd.get_generic_features_mention(s, dd.Span(7, 1)))
+
+  def test_feature_hasher(self):
+    self.assertEqual(dd.hash_feature("NGRAM_1_[marry]"),
+      dd.hash_feature(u"NGRAM_1_[marry]"))
+    self.assertEqual(dd.hash_feature(""), -3162216497309240828)
+    side_file = StringIO()
+    hasher = dd.FeatureHasher(side_file)
+    sentence = dd.Sentence(words=self.words, lemmas=self.words,
+      poses=["NN"] * len(self.words), ners=["O"] * len(self.words))
+    span = dd.Span(1, 2)
+    features = list(dd.get_generic_features_mention(sentence, span))
+    ids = list(dd.get_generic_features_mention(sentence, span,
+      hasher=hasher))
+    self.assertEqual(ids, map(dd.hash_feature, features))
+    hasher.flush()
+    self.assertEqual(side_file.getvalue().splitlines(), ["%d\t%s" % item
+      for item in sorted(set(zip(ids, features)), key=lambda i:
+        features.index(i[1]))])
+    hasher = dd.FeatureHasher(cache_size=2)
+    self.assertEqual(map(hasher, features[:5]),
+      map(dd.hash_feature, features[:5]))
+    self.assertTrue(len(hasher._hashes) <= 2)
+
+  def test_run_parallel(self):
+    data = "".join("%d\t{a,b}\n" % i for i in range(50))
+    def process_row(row):
+      yield (row.id * 2, len(row.words))
+    for processes, ordered in ((1, True), (2, True), (2, False)):
+      out = StringIO()
+      dd.run_parallel(process_row, schema="id int, words text[]",
+        processes=processes, batch_size=7, ordered=ordered,
+        input=StringIO(data), output=out)
+      lines = out.getvalue().splitlines()
+      expected = ["%d\t2" % (i * 2) for i in range(50)]
+      self.assertEqual(lines if ordered else sorted(lines, key=lambda l:
+        int(l.split()[0])), expected)
+    out = StringIO()
+    dd.run_parallel(lambda row: [(row.id % 3, w) for w in row.words],
+      schema="id int, words text[]", processes=2, batch_size=7,
+      input=StringIO(data), output=out,
+      aggregator=FeatureAggregator(count=True))
+    self.assertEqual(out.getvalue().splitlines()[:4],
+      ["0\ta\t3", "0\tb\t3", "1\ta\t2", "1\tb\t2"])
+    # The rows the parent buffered are not written by the workers.
+    fd, path = tempfile.mkstemp()
+    try:
+      writer = RowWriter(stream=os.fdopen(fd, "w"))
+      writer.write("parent")
+      out = StringIO()
+      dd.run_parallel(lambda line: [line.split("\t")[0] + "\tfeat\\x",
+        (line.split("\t")[0], "a\tb")], processes=2, batch_size=7,
+        input=StringIO(data), output=out)
+      writer.close()
+      writer.stream.close()
+      with open(path) as f:
+        self.assertEqual(f.read(), "parent\n")
+    finally:
+      os.remove(path)
+    # String rows are written as they are, tuples are escaped.
+    self.assertEqual(out.getvalue().splitlines()[:4], ["0\tfeat\\x",
+      "0\ta\\tb", "1\tfeat\\x", "1\ta\\tb"])
+    self.assertEqual(len(out.getvalue().splitlines()), 100)
+
+  def test_close_at_exit(self):
+    out = StringIO()
+    writer = RowWriter(stream=out)
+    writer.write("a")
+    aggregator = FeatureAggregator(writer)
+    aggregator.write(1, "f")
+    closed = StringIO()
+    RowWriter(stream=closed).close()
+    left_open = RowWriter(stream=closed)
+    closed.close()
+    dd.dd._close_all()
+    self.assertEqual(out.getvalue(), "a\n1\tf\n")
+    # Writers are not kept alive, and write their rows when collected.
+    out = StringIO()
+    writer = RowWriter(stream=out)
+    writer.write("b")
+    ref = weakref.ref(writer)
+    del writer
+    self.assertEqual((ref(), out.getvalue()), (None, "b\n"))
+
 
 if __name__ == '__main__':
   unittest.main()
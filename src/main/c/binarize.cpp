@@ -1,6 +1,9 @@
 
 /*
  * Transform a TSV format factor graph file and output corresponding binary format used in DeepDive
+ *
+ * Prints a summary line "mode<TAB>input file<TAB>records<TAB>edges" to stdout,
+ * with the number of records written (and of edges, for factors; 0 otherwise)
  */
 
 #include <iostream>
@@ -28,8 +31,8 @@ using namespace std;
 #define bswap_16(x) \
      ((unsigned short int) ((((x) >> 8) & 0xff) | (((x) & 0xff) << 8)))
 
-// read variables and convert to binary format
-void load_var(std::string filename) {
+// read variables and convert to binary format, return the number of variables
+long load_var(std::string filename) {
   std::ifstream fin(filename.c_str());
   std::ofstream fout((filename + ".bin").c_str(), std::ios::binary | std::ios::out);
 
@@ -39,6 +42,7 @@ void load_var(std::string filename) {
   short type;
   long edge_count = -1;
   long cardinality;
+  long nvar = 0;
 
   edge_count = bswap_64(edge_count);
   // std::cerr << filename << " " << inc << std::endl;
@@ -56,21 +60,24 @@ void load_var(std::string filename) {
     fout.write((char*)&type, 2);
     fout.write((char *)&edge_count, 8);
     fout.write((char*)&cardinality, 8);
+    nvar++;
   }
 
   fin.close();
   fout.close();
+  return nvar;
 }
 
 
-// convert weights
-void load_weight(std::string filename) {
+// convert weights, return the number of weights
+long load_weight(std::string filename) {
   std::ifstream fin(filename.c_str());
   std::ofstream fout((filename + ".bin").c_str(), std::ios::binary | std::ios::out);
 
   long wid;
   int isfixed;
   double initial_value;
+  long nweight = 0;
 
   while(fin >> wid >> isfixed >> initial_value){
     wid = bswap_64(wid);
@@ -79,15 +86,18 @@ void load_weight(std::string filename) {
     fout.write((char*)&wid, 8);
     fout.write((char*)&isfixed, 1);
     fout.write((char*)&initval, 8);
+    nweight++;
   }
 
   fin.close();
   fout.close();
+  return nweight;
 }
 
 // load factors
 // fid, wid, vids
-void load_factor(std::string filename, short funcid, long nvar, char** positives) {
+// return the number of factors, and set nedge to the number of edges
+long load_factor(std::string filename, short funcid, long nvar, char** positives, long &nedge) {
   std::ifstream fin(filename.c_str());
   std::ofstream fout((filename + "_factors.bin").c_str(), std::ios::binary | std::ios::out);
   std::ofstream fedgeout((filename + "_edges.bin").c_str(), std::ios::binary | std::ios::out);
@@ -95,7 +105,7 @@ void load_factor(std::string filename, short funcid, long nvar, char** positives
   long factorid = 0;
   long weightid = 0;
   long variableid = 0;
-  long nedge = 0;
+  long nfactor = 0;
   long nvars_big = bswap_64(nvar);
   long predicate = funcid == 5 ? -1 : 1;
   vector<int> positives_vec;
@@ -107,6 +117,7 @@ void load_factor(std::string filename, short funcid, long nvar, char** positives
   }
 
   predicate = bswap_64(predicate);
+  nedge = 0;
 
   const char field_delim = '\t'; // tsv file delimiter
   const char array_delim = ','; // array delimiter
@@ -181,43 +192,50 @@ void load_factor(std::string filename, short funcid, long nvar, char** positives
     }
     n_vars = bswap_64(n_vars);
     fout.write((char *)&n_vars, 8);
-
+    nfactor++;
   }
-  std::cout << nedge << std::endl;
 
   fin.close();
   fout.close();
   fedgeout.close();
+  return nfactor;
 }
 
-void load_active(std::string filename) {
+// convert ids, return the number of ids
+long load_active(std::string filename) {
   std::ifstream fin(filename.c_str());
   std::ofstream fout((filename + ".bin").c_str(), std::ios::binary);
 
   long id;
+  long nid = 0;
   while (fin >> id) {
     id = bswap_64(id);
     fout.write((char*)&id, 8);
+    nid++;
   }
   fin.close();
   fout.close();
+  return nid;
 }
 
 int main(int argc, char** argv){
   std::string app(argv[1]);
+  long nrecord = 0;
+  long nedge = 0;
   // std::cerr << app << " " << argv[2] << " " << argv[3] << std::endl;
   if(app.compare("variable")==0){
-    load_var(argv[2]);
+    nrecord = load_var(argv[2]);
   } else if(app.compare("weight")==0){
-    load_weight(argv[2]);
+    nrecord = load_weight(argv[2]);
   } else if(app.compare("factor")==0){
-    load_factor(argv[2], atoi(argv[3]), atoi(argv[4]), &argv[5]);
+    nrecord = load_factor(argv[2], atoi(argv[3]), atoi(argv[4]), &argv[5], nedge);
   } else if (app.compare("active") == 0) {
-    load_active(argv[2]);
+    nrecord = load_active(argv[2]);
   } else {
     std::cout << "Unsupported type" << std::endl;
     exit(1);
   }
+  std::cout << app << "\t" << argv[2] << "\t" << nrecord << "\t" << nedge << std::endl;
   return 0;
 }
 
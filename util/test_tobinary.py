@@ -0,0 +1,221 @@
+#! /usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+import sys
+import threading
+import tobinary
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+BINARIZE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+  "src", "main", "c", "binarize.cpp")
+
+# A small grounding: an array and a scalar column (function 5, of which the
+# predicates are -1), three scalar columns, and a single array column, with
+# empty arrays and \N for the NULL variable ids; negative and fractional
+# initial values; variables in two files.
+GROUNDING = {
+  "dd_factormeta": "f1\t5\ttrue false\nf2\t0\ttrue true false\nf3\t4\ttrue\n",
+  "dd_factors_f1_out": "0\t0\t{0,1}\t2\n1\t1\t{}\t3\n2\t1\t{4,3,2}\t\\N\n",
+  "dd_factors_f2_out": "3\t2\t0\t1\t4\n4\t3\t-1\t2\t3\n",
+  "dd_factors_f3_out": "5\t0\t{1,2}\n6\t1\t{}\n7\t2\t{\\N}\n",
+  "dd_variables_a": "0\t1\t1\t0\t2\n1\t0\t-0.75\t0\t2\n2\t1\t0.5\t0\t2\n",
+  "dd_variables_b": "3\t0\t-1.5\t1\t4\n4\t0\t0\t0\t2\n",
+  "dd_weights": "0\t0\t-2.25\n1\t1\t1.5\n2\t0\t-3\n3\t1\t3\n",
+}
+
+GRAPH_FILES = ("weights", "variables", "factors", "edges")
+
+
+def write_grounding(folder, files=GROUNDING):
+  if not os.path.isdir(folder):
+    os.makedirs(folder)
+  for name, data in files.items():
+    with open(os.path.join(folder, name), "w") as f:
+      f.write(data)
+
+
+def read_graph(folder):
+  """Return the contents of the graph files and the numbers of graph.meta."""
+  contents = {}
+  for name in GRAPH_FILES:
+    with open(os.path.join(folder, "graph." + name), "rb") as f:
+      contents[name] = f.read()
+  with open(os.path.join(folder, "graph.meta")) as f:
+    contents["meta"] = f.read().split(",")[:4]
+  return contents
+
+
+@unittest.skipIf(numpy is None, "requires numpy")
+class TestToBinary(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.input_folder = os.path.join(self.directory, "input")
+    write_grounding(self.input_folder)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def compile_binarize(self):
+    """Return the path of src/main/c/binarize.cpp compiled, the
+    transform_script of convert_with_format_converter."""
+    path = os.path.join(self.directory, "binarize")
+    try:
+      subprocess.check_call(["g++", "-O2", "-o", path, BINARIZE])
+    except (OSError, subprocess.CalledProcessError):
+      self.skipTest("cannot compile binarize.cpp")
+    return path
+
+  def convert_with_format_converter(self, transform_script):
+    # convert_with_format_converter leaves its chunks in the input folder.
+    input_folder = os.path.join(self.directory, "format_converter_input")
+    output_folder = os.path.join(self.directory, "format_converter")
+    shutil.copytree(self.input_folder, input_folder)
+    os.mkdir(output_folder)
+    tobinary.convert_with_format_converter(input_folder, transform_script,
+      output_folder)
+    return read_graph(output_folder)
+
+  def test_format_converter(self):
+    expected = self.convert_with_format_converter(self.compile_binarize())
+    self.assertEqual(expected["meta"], ["4", "5", "8", "19"])
+    for chunk_size in (7, 64, tobinary.CHUNK_SIZE):
+      output_folder = os.path.join(self.directory, "output%d" % chunk_size)
+      tobinary.convert(self.input_folder, output_folder, processes=2,
+        chunk_size=chunk_size)
+      self.assertEqual(read_graph(output_folder), expected)
+
+  def test_meta(self):
+    binarize = self.compile_binarize()
+    counts = ["4", "5", "8", "19"]
+    self.assertEqual(self.convert_with_format_converter(binarize)["meta"],
+      counts)
+    # Older versions of binarize print no summary: the records are counted
+    # from the sizes of the graph files.
+    shutil.rmtree(os.path.join(self.directory, "format_converter_input"))
+    shutil.rmtree(os.path.join(self.directory, "format_converter"))
+    script = os.path.join(self.directory, "binarize_without_summary")
+    with open(script, "w") as f:
+      f.write("#! /bin/sh\nexec %s \"$@\" >/dev/null\n" % binarize)
+    os.chmod(script, 0755)
+    self.assertEqual(self.convert_with_format_converter(script)["meta"],
+      counts)
+
+  def test_read_summary(self):
+    path = os.path.join(self.directory, "dd_summary")
+    self.assertEqual(tobinary.read_summary(path), dict.fromkeys(
+      ("variable", "weight", "factor", "edge")))
+    with open(path, "w") as f:
+      f.write("factor\tdd_factors_f1_outaa\t3\t9\n"
+        "variable\tdd_variables_a\t0\t0\n"
+        "variable\tdd_variables_aaa\t3\t0\n"
+        "factor\tdd_factors_f1_outab\t2\t6\n"
+        "not a summary line\n")
+    self.assertEqual(tobinary.read_summary(path), {"variable": 3,
+      "weight": None, "factor": 5, "edge": 15})
+
+  def test_incremental(self):
+    output_folder = os.path.join(self.directory, "output")
+    segments = os.path.join(output_folder, tobinary.SEGMENTS)
+
+    def encoded_files():
+      # The segments written again since they were all made old
+      encoded = sorted(name for name in os.listdir(segments)
+        if os.path.getmtime(os.path.join(segments, name)) != 0)
+      for name in os.listdir(segments):
+        os.utime(os.path.join(segments, name), (0, 0))
+      return encoded
+
+    tobinary.convert(self.input_folder, output_folder, processes=2,
+      chunk_size=16, incremental=True)
+    self.assertEqual(len(encoded_files()), 9)
+    # A file dumped again with the same content is not encoded again.
+    os.utime(os.path.join(self.input_folder, "dd_weights"), (1, 1))
+    tobinary.convert(self.input_folder, output_folder, processes=2,
+      chunk_size=16, incremental=True)
+    self.assertEqual(encoded_files(), [])
+    write_grounding(self.input_folder, {
+      "dd_factors_f2_out": "3\t2\t0\t1\t4\n4\t3\t-1\t2\t3\n8\t1\t4\t4\t4\n"})
+    counts = tobinary.convert(self.input_folder, output_folder, processes=2,
+      chunk_size=16, incremental=True)
+    self.assertEqual(encoded_files(), ["dd_factors_f2_out.edges",
+      "dd_factors_f2_out.factors"])
+    fresh_folder = os.path.join(self.directory, "fresh")
+    self.assertEqual(tobinary.convert(self.input_folder, fresh_folder,
+      processes=2), counts)
+    self.assertEqual(read_graph(output_folder), read_graph(fresh_folder))
+
+  def test_streams(self):
+    expected_folder = os.path.join(self.directory, "expected")
+    counts = tobinary.convert(self.input_folder, expected_folder, processes=2)
+    expected = read_graph(expected_folder)
+    fifo_folder = os.path.join(self.directory, "fifos")
+    os.mkdir(fifo_folder)
+    names = sorted(GROUNDING)
+    for name in names:
+      if name != "dd_factormeta":
+        os.mkfifo(os.path.join(fifo_folder, name))
+    write_grounding(fifo_folder, {"dd_factormeta": GROUNDING["dd_factormeta"]})
+
+    def write_fifos():
+      # In the reverse of the order of their records in the graph files, each
+      # to its end before the next one is opened
+      for name in reversed(names):
+        if name != "dd_factormeta":
+          with open(os.path.join(fifo_folder, name), "w") as f:
+            f.write(GROUNDING[name])
+
+    writer = threading.Thread(target=write_fifos)
+    writer.daemon = True
+    writer.start()
+    output_folder = os.path.join(self.directory, "output")
+    self.assertEqual(tobinary.convert_streams(fifo_folder, output_folder,
+      processes=2, chunk_size=16), counts)
+    writer.join()
+    self.assertEqual(read_graph(output_folder), expected)
+
+  def test_stdin(self):
+    expected_folder = os.path.join(self.directory, "expected")
+    tobinary.convert(self.input_folder, expected_folder, processes=2)
+    output_folder = os.path.join(self.directory, "output")
+    os.remove(os.path.join(self.input_folder, "dd_variables_b"))
+    with open(os.devnull, "w") as devnull:
+      process = subprocess.Popen([sys.executable, tobinary.__file__,
+        "--stdin", "dd_variables_b", self.input_folder, "binarize",
+        output_folder], stdin=subprocess.PIPE, stdout=devnull)
+      process.communicate(GROUNDING["dd_variables_b"])
+    self.assertEqual(process.returncode, 0)
+    self.assertEqual(read_graph(output_folder), read_graph(expected_folder))
+    write_grounding(self.input_folder)
+    for table in ("dd_factors_f4_out", "dd_weight", "variables_b"):
+      self.assertRaises(ValueError, tobinary.convert_streams,
+        self.input_folder, output_folder, stdin_table=table)
+
+  def test_null_initial_values(self):
+    # binarize.cpp stops reading variables and weights at \N, which is
+    # read as 0 as in the factors.
+    write_grounding(self.input_folder, {
+      "dd_variables_a": "0\t1\t\\N\t0\t2\n1\t\\N\t0.5\t0\t2\n",
+      "dd_weights": "0\t0\t\\N\n1\t1\t-1.5\n"})
+    os.remove(os.path.join(self.input_folder, "dd_variables_b"))
+    output_folder = os.path.join(self.directory, "output")
+    tobinary.convert(self.input_folder, output_folder, processes=1)
+    variables = numpy.fromfile(os.path.join(output_folder, "graph.variables"),
+      tobinary.VARIABLE)
+    weights = numpy.fromfile(os.path.join(output_folder, "graph.weights"),
+      tobinary.WEIGHT)
+    self.assertEqual(variables["initial_value"].tolist(), [0.0, 0.5])
+    self.assertEqual(variables["is_evidence"].tolist(), [1, 0])
+    self.assertEqual(weights["initial_value"].tolist(), [0.0, -1.5])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,92 +1,847 @@
 #! /usr/bin/env python
 
 # Script to convert grounding files in TSV format to binary format for dimmwitted sampler
-# Usage: python tobinary.py [input folder] transform_script [output folder]
-# It split the specific files in the input folder and for each of them calls the C++ binary to convert the format
+# Usage: python tobinary.py [--incremental | --stream | --stdin TABLE] [input folder] transform_script [output folder]
+#
+# Each dd_factors_*_out, dd_variables_* and dd_weights file of the input folder
+# is read once: it is cut into chunks at line boundaries, and a pool of
+# processes encodes the chunks, which are appended in order to graph.factors,
+# graph.edges, graph.variables and graph.weights in the output folder. The
+# numbers of records encoded are written to graph.meta.
+#
+# With --incremental (or DEEPDIVE_INCREMENTAL_BINARIZATION set), the records
+# of each input file are kept in the output folder, and only the input files
+# that changed since the last incremental conversion are encoded again (see
+# convert_incrementally).
+#
+# With --stream, each input file is read once from start to end instead, so
+# the grounding can create them as named pipes (mkfifo) and write each table
+# to its pipe with COPY ... TO STDOUT, without writing the TSV files to disk.
+# The pipes are read concurrently, so the tables can be written in any order.
+# With --stdin TABLE, the input file TABLE is read from the standard input
+# (see convert_streams); TABLE must be dd_weights, a dd_variables_* table or
+# the dd_factors_*_out file of a factor of dd_factormeta.
+#
+# The records are big-endian, as written by transform_script
+# (src/main/c/binarize.cpp), which is only used when NumPy is not available:
+#   variable: vid (8 bytes), is_evidence (1), initial value (double, 8),
+#     type (2), edge count (8, always -1), cardinality (8)
+#   weight: wid (8), is_fixed (1), initial value (double, 8)
+#   factor: fid (8), wid (8), function id (2), number of edges (8)
+#   edge: vid (8), fid (8), position in the factor (8), is_positive (1),
+#     predicate (8, -1 for function 5 and 1 otherwise)
 
 import sys
 import re
 import os
+import json
+import hashlib
+import argparse
+import string
+import collections
+import shutil
+import tempfile
+import threading
+import Queue
+import warnings
+import multiprocessing
 
-# set up parameters
-CHUNKSIZE = '10000000'
-INPUTFOLDER = sys.argv[1]
-transform_script = sys.argv[2]
-OUTPUTFOLDER = sys.argv[3]
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
-# clean up folder
-os.system('rm -rf ' + INPUTFOLDER + "/dd_tmp")
-os.system('mkdir -p ' + INPUTFOLDER + "/dd_tmp")
-os.system('rm -rf ' + INPUTFOLDER + "/nedges_")
+# Number of bytes of input encoded at a time by a process
+CHUNK_SIZE = 1 << 23
 
-if not os.path.isfile(INPUTFOLDER + "/dd_factormeta"):
-  os.system("touch %s/dd_factormeta" %INPUTFOLDER)
+# The graph files the records of each kind of input file go to
+OUTPUTS = {'factor': ('factors', 'edges'), 'variable': ('variables',),
+  'weight': ('weights',), 'hash': ()}
 
-# handle factors
-for l in open(INPUTFOLDER + "/dd_factormeta"):
-  (factor_name, function_id, positives) = l.split('\t')
-  positives = positives.strip().replace('true', '1').replace('false', '0').split(' ')
-  nvars = '%d' % len(positives)
+# In incremental conversions, the fingerprints of the input files and the
+# folder of their records, in the output folder
+MANIFEST = 'graph.manifest'
+SEGMENTS = 'graph.segments'
 
-  print "SPLITTING", factor_name, "..."
-  os.system('split -a 10 -l ' + CHUNKSIZE + ' ' + INPUTFOLDER + '/dd_factors_' + factor_name + '_out ' + INPUTFOLDER + '/dd_tmp/dd_factors_' + factor_name + '_out')
+if np is not None:
+  VARIABLE = np.dtype([('vid', '>i8'), ('is_evidence', 'u1'),
+    ('initial_value', '>f8'), ('type', '>i2'), ('edge_count', '>i8'),
+    ('cardinality', '>i8')])
+  WEIGHT = np.dtype([('wid', '>i8'), ('is_fixed', 'u1'),
+    ('initial_value', '>f8')])
+  FACTOR = np.dtype([('fid', '>i8'), ('wid', '>i8'), ('function_id', '>i2'),
+    ('n_edges', '>i8')])
+  EDGE = np.dtype([('vid', '>i8'), ('fid', '>i8'), ('position', '>i8'),
+    ('is_positive', 'u1'), ('predicate', '>i8')])
 
-  print "BINARIZE ", factor_name, "..."
-  os.system('ls ' + INPUTFOLDER + '/dd_tmp | egrep "^dd_factors_' + factor_name + '_out"  | xargs -P 40 -I {} -n 1 sh -c \'' + transform_script + ' factor ' + INPUTFOLDER + '/dd_tmp/{} ' + function_id + ' ' + nvars + ' ' + (' '.join(positives)) + ' \' | awk \'{s+=$1} END {printf \"%.0f\\n\", s}\' >>' + INPUTFOLDER + "/dd_nedges_")
+_ATOL = re.compile(r'\s*([-+]?\d+)')
+_ATOF = re.compile(r'\s*([-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?)')
 
-# handle variables
-for f in os.listdir(INPUTFOLDER):
-  if f.startswith('dd_variables_'):
-    print "SPLITTING", f, "..."
-    os.system("touch %s/dd_tmp/%s" %(INPUTFOLDER, f))
-    os.system('split -a 10 -l ' + CHUNKSIZE + ' ' + INPUTFOLDER + '/' + f + ' ' + INPUTFOLDER + '/dd_tmp/' + f)
+# The characters of whitespace-separated integers
+_INTEGER_CHARACTERS = '0123456789+-' + string.whitespace
 
-    print "BINARIZE ", f, "..."
-    os.system('ls ' + INPUTFOLDER + '/dd_tmp | egrep "^' + f + '"  | xargs -P 40 -I {} -n 1 sh -c \'' + transform_script + ' variable ' + INPUTFOLDER + '/dd_tmp/{} \'')
+# Turns the arrays of the factor files into whitespace-separated values
+_ARRAY_DELIMITERS = string.maketrans('{},', '   ')
 
-# handle weights
-print "BINARIZE ", 'weights', "..."
-os.system(transform_script + ' weight ' + INPUTFOLDER + '/dd_weights')
 
-# move files
-os.system('rm -rf ' + INPUTFOLDER + "/dd_factors")
-os.system('mkdir -p ' + INPUTFOLDER + "/dd_factors")
-os.system('mv ' + INPUTFOLDER + '/dd_tmp/dd_factors*.bin ' + INPUTFOLDER + '/dd_factors')
+def atol(field):
+  """Parse the integer at the beginning of a field (0 if there is none), as
+  the C function atol used by transform_script."""
+  m = _ATOL.match(field)
+  return int(m.group(1)) if m else 0
 
-os.system('rm -rf ' + INPUTFOLDER + "/dd_variables")
-os.system('mkdir -p ' + INPUTFOLDER + "/dd_variables")
-os.system('mv ' + INPUTFOLDER + '/dd_tmp/dd_variables*.bin ' + INPUTFOLDER + '/dd_variables')
 
-nfactor_files = 0
-nvariable_files = 0
+def atof(field):
+  """Parse the number at the beginning of a field (0.0 if there is none, as
+  for \\N), as the C function atof used by transform_script."""
+  try:
+    return float(field)
+  except ValueError:
+    m = _ATOF.match(field)
+    return float(m.group(1)) if m else 0.0
 
-# counting
-print "COUNTING", "variables", "..."
-os.system('wc -l ' + INPUTFOLDER + "/dd_tmp/dd_variables_* | tail -n 1 | sed -e 's/^[ \t]*//g' | cut -d ' ' -f 1 > " + INPUTFOLDER + '/dd_nvariables_wc')
-os.system('export dd_nvar=`cat ' + INPUTFOLDER + '/dd_nvariables_wc`; echo $dd_nvar + %d | bc > ' % nvariable_files + INPUTFOLDER + '/dd_nvariables; unset dd_nvar')
 
-print "COUNTING", "factors", "..."
-os.system('wc -l ' + INPUTFOLDER + "/dd_tmp/dd_factors_* | tail -n 1 | sed -e 's/^[ \t]*//g' | cut -d ' ' -f 1 > " + INPUTFOLDER + '/dd_nfactors_wc')
-os.system('export dd_nfact=`cat ' + INPUTFOLDER + '/dd_nfactors_wc`; echo $dd_nfact + %d | bc > ' % nfactor_files + INPUTFOLDER + '/dd_nfactors; unset dd_nfact')
+def parse_ints(fields):
+  """Return a NumPy int64 array of the integers in a sequence of strings."""
+  try:
+    return np.asarray(fields).astype(np.int64)
+  except ValueError:
+    return np.array([atol(f) for f in fields], dtype=np.int64)
 
-print "COUNTING", "weights", "..."
-os.system('wc -l ' + INPUTFOLDER + "/dd_weights | tail -n 1 | sed -e 's/^[ \t]*//g' | cut -d ' ' -f 1 > " + INPUTFOLDER + '/dd_nweights')
 
-os.system("awk '{{ sum += $1 }} END {{ printf \"%.0f\\n\", sum }}' {0}/dd_nedges_ > {0}/dd_nedges".format(INPUTFOLDER))
+def parse_floats(fields):
+  """Return a NumPy float64 array of the numbers in a sequence of strings."""
+  try:
+    return np.asarray(fields).astype(np.float64)
+  except ValueError:
+    return np.array([atof(f) for f in fields], dtype=np.float64)
 
-# concatenate files
-print "CONCATENATING FILES..."
-os.system("cat {0}/dd_nweights {0}/dd_nvariables {0}/dd_nfactors {0}/dd_nedges | tr '\n' ',' > {0}/graph.meta".format(INPUTFOLDER))
-os.system("echo {0}/graph.weights,{0}/graph.variables,{0}/graph.factors,{0}/graph.edges >> {1}/graph.meta".format(OUTPUTFOLDER, INPUTFOLDER))
 
-if INPUTFOLDER != OUTPUTFOLDER:
-    os.system("mv {0}/graph.meta {1}/graph.meta".format(INPUTFOLDER, OUTPUTFOLDER))
-os.system("mv {0}/dd_weights.bin {1}/graph.weights".format(INPUTFOLDER, OUTPUTFOLDER))
-os.system("cat {0}/dd_variables/* > {1}/graph.variables".format(INPUTFOLDER, OUTPUTFOLDER))
-os.system("cat {0}/dd_factors/dd_factors*factors.bin > {1}/graph.factors".format(INPUTFOLDER, OUTPUTFOLDER))
-os.system("cat {0}/dd_factors/dd_factors*edges.bin > {1}/graph.edges".format(INPUTFOLDER, OUTPUTFOLDER))
+def parse_numbers(data, dtype, n_values):
+  """Parse n_values whitespace-separated numbers with NumPy's parser, or
+  return None if data has anything else."""
+  with warnings.catch_warnings():
+    # Newer versions of NumPy warn when the parsing stops early.
+    warnings.simplefilter('ignore', DeprecationWarning)
+    values = np.fromstring(data, dtype=dtype, sep=' ')
+  return values if len(values) == n_values else None
 
 
-# clean up folder
-print "Cleaning up files"
-os.system('rm -rf {0}/dd_*'.format(INPUTFOLDER))
+def count_tokens(buf):
+  """Return the number of whitespace-separated tokens in a uint8 array."""
+  space = (buf == 32) | ((buf >= 9) & (buf <= 13))
+  return int(np.count_nonzero(~space[1:] & space[:-1])) + int(len(buf) > 0 and not space[0])
+
+
+def parse_columns(data, n_columns, float_columns=()):
+  """Return the columns of a chunk of rows of n_columns whitespace-separated
+  numbers, as int64 arrays, or float64 arrays for the float_columns."""
+  n_tokens = count_tokens(np.frombuffer(data, np.uint8))
+  if n_tokens % n_columns:
+    raise ValueError('rows must have %d columns' % n_columns)
+  # NumPy stops parsing integers at a '.', which goes unnoticed in the last
+  # value: the integer parser is only used when the floats have no fraction.
+  values = None
+  if not float_columns or not data.translate(None, _INTEGER_CHARACTERS):
+    values = parse_numbers(data, np.int64, n_tokens)
+  if values is not None:
+    values = values.reshape(-1, n_columns)
+    return [values[:, i].astype(np.float64) if i in float_columns else values[:, i]
+      for i in range(n_columns)]
+  values = parse_numbers(data, np.float64, n_tokens)
+  if values is not None:
+    values = values.reshape(-1, n_columns)
+    integer_columns = values[:, [i for i in range(n_columns) if i not in float_columns]]
+    # Integers are only exact as doubles up to 2^53.
+    if (np.abs(integer_columns) < 2 ** 53).all() and (np.floor(integer_columns) == integer_columns).all():
+      return [values[:, i] if i in float_columns else values[:, i].astype(np.int64)
+        for i in range(n_columns)]
+  # Anything NumPy cannot parse is parsed as transform_script would.
+  columns = np.asarray(data.split()).reshape(-1, n_columns)
+  return [parse_floats(columns[:, i]) if i in float_columns else parse_ints(columns[:, i])
+    for i in range(n_columns)]
+
+
+def read_factormeta(input_folder):
+  """Return the (name, function id, positives) of each factor of
+  dd_factormeta."""
+  factors = []
+  path = input_folder + '/dd_factormeta'
+  if not os.path.isfile(path):
+    return factors
+  for l in open(path):
+    (factor_name, function_id, positives) = l.split('\t')
+    positives = positives.strip().replace('true', '1').replace('false', '0').split(' ')
+    factors.append((factor_name, atol(function_id), [atol(p) for p in positives]))
+  return factors
+
+
+def line_chunks(path, chunk_size=CHUNK_SIZE):
+  """Return the (start, end) byte offsets of the chunks of about chunk_size
+  bytes that a file is cut into, each ending at the end of a line. A missing
+  file has no chunks."""
+  if not os.path.isfile(path):
+    return []
+  size = os.path.getsize(path)
+  chunks = []
+  with open(path, 'rb') as f:
+    start = 0
+    while start < size:
+      end = start + chunk_size
+      if end >= size:
+        end = size
+      else:
+        f.seek(end)
+        f.readline()
+        end = min(f.tell(), size)
+      chunks.append((start, end))
+      start = end
+  return chunks
+
+
+def encode_variables(data):
+  """Encode the variables of a chunk of TSV lines: (records, count)."""
+  vids, is_evidence, initial_values, types, cardinalities = parse_columns(data, 5, (2,))
+  records = np.empty(len(vids), VARIABLE)
+  records['vid'] = vids
+  records['is_evidence'] = is_evidence
+  records['initial_value'] = initial_values
+  records['type'] = types
+  records['edge_count'] = -1
+  records['cardinality'] = cardinalities
+  return records.tobytes(), len(records)
+
+
+def encode_weights(data):
+  """Encode the weights of a chunk of TSV lines: (records, count)."""
+  wids, is_fixed, initial_values = parse_columns(data, 3, (2,))
+  records = np.empty(len(wids), WEIGHT)
+  records['wid'] = wids
+  records['is_fixed'] = is_fixed
+  records['initial_value'] = initial_values
+  return records.tobytes(), len(records)
+
+
+def parse_factors(data, n_columns):
+  """Parse a chunk of factor lines with NumPy: return the factor ids, the
+  weight ids, the variable ids and the number of variables in each column of
+  each factor, or None if the chunk is not made of well-formed lines of
+  n_columns integers or arrays of integers."""
+  if not data.endswith('\n'):
+    data += '\n'
+  if data.startswith('\n') or '\n\n' in data or '{}' in data:
+    return None
+  buf = np.frombuffer(data, np.uint8)
+  if '{' not in data and ',' not in data:
+    # No arrays: each line has one variable id per column.
+    n_factors = data.count('\n')
+    if count_tokens(buf) != n_factors * n_columns:
+      return None
+    values = parse_numbers(data, np.int64, n_factors * n_columns)
+    if values is None:
+      return None
+    values = values.reshape(-1, n_columns)
+    column_counts = np.ones((n_factors, n_columns - 2), dtype=np.int64)
+    return values[:, 0], values[:, 1], values[:, 2:].ravel(), column_counts
+  # The end of each field, and the numbers of commas and braces in it
+  ends = np.flatnonzero((buf == 9) | (buf == 10))
+  if len(ends) % n_columns:
+    return None
+  separators = buf[ends].reshape(-1, n_columns)
+  if (separators[:, -1] != 10).any() or (separators[:, :-1] != 9).any():
+    return None
+  commas = np.diff(np.concatenate(([0], np.cumsum(buf == 44)[ends]))).reshape(-1, n_columns)
+  braces = np.diff(np.concatenate(([0], np.cumsum(buf == 123)[ends]))).reshape(-1, n_columns)
+  if (braces > 1).any() or (commas[:, :2] > 0).any() or ((commas > 0) & (braces == 0)).any():
+    return None
+  column_counts = commas[:, 2:] + 1
+  n_factors = len(column_counts)
+  values = parse_numbers(data.translate(_ARRAY_DELIMITERS), np.int64,
+    2 * n_factors + int(column_counts.sum()))
+  if values is None:
+    return None
+  # The index of the factor id of each line in values
+  starts = np.arange(n_factors) * 2
+  starts[1:] += np.cumsum(column_counts.sum(1))[:-1]
+  is_vid = np.ones(len(values), dtype=bool)
+  is_vid[starts] = False
+  is_vid[starts + 1] = False
+  return values[starts], values[starts + 1], values[is_vid], column_counts
+
+
+def encode_factors(data, function_id, positives):
+  """Encode the factors of a chunk of "fid<TAB>wid<TAB>vids..." lines, with
+  one column of variable ids (or array of them) per element of positives:
+  (factor records, edge records, number of factors, number of edges)."""
+  n_columns = len(positives) + 2
+  parsed = parse_factors(data, n_columns)
+  if parsed is not None:
+    fids, wids, vids, column_counts = parsed
+  else:
+    fids = []
+    wids = []
+    vids = []
+    column_counts = []
+    for line in data.split('\n'):
+      if not line:
+        continue
+      fields = line.split('\t')
+      if len(fields) < n_columns:
+        raise ValueError('factor row %r has less than %d columns' % (line, n_columns))
+      fids.append(fields[0])
+      wids.append(fields[1])
+      for field in fields[2:n_columns]:
+        if field.startswith('{'):
+          values = field[1:].split(',')
+          # The array ends at the first value ending with '}'.
+          for i, value in enumerate(values):
+            if value.endswith('}'):
+              values[i:] = [value[:-1]]
+              break
+        else:
+          values = [field]
+        vids.extend(values)
+        column_counts.append(len(values))
+    fids = parse_ints(fids)
+    wids = parse_ints(wids)
+    vids = parse_ints(vids)
+    column_counts = np.array(column_counts, dtype=np.int64).reshape(-1, len(positives))
+  n_factors = len(fids)
+  edge_counts = column_counts.sum(1)
+  factors = np.empty(n_factors, FACTOR)
+  factors['fid'] = fids
+  factors['wid'] = wids
+  factors['function_id'] = function_id
+  factors['n_edges'] = edge_counts
+  edges = np.empty(len(vids), EDGE)
+  edges['vid'] = vids
+  edges['fid'] = np.repeat(fids, edge_counts)
+  # The position of each edge in its factor
+  edges['position'] = np.arange(len(vids)) - np.repeat(
+    np.cumsum(edge_counts) - edge_counts, edge_counts)
+  edges['is_positive'] = np.repeat(np.tile(positives, n_factors), column_counts.ravel())
+  edges['predicate'] = -1 if function_id == 5 else 1
+  return factors.tobytes(), edges.tobytes(), n_factors, len(edges)
+
+
+def encode_data(kind, data, args):
+  """Encode lines of an input file of a kind. Return the records encoded for
+  each of the OUTPUTS of the kind, and the numbers of records and edges."""
+  if kind == 'factor':
+    factors, edges, n_factors, n_edges = encode_factors(data, *args)
+    return (factors, edges), n_factors, n_edges
+  elif kind == 'variable':
+    records, n_records = encode_variables(data)
+    return (records,), n_records, 0
+  elif kind == 'weight':
+    records, n_records = encode_weights(data)
+    return (records,), n_records, 0
+  else:
+    return (), 0, 0
+
+
+def encode_chunk(task):
+  """Encode a chunk of an input file, given as (kind, path, start, end,
+  arguments of the encoder, whether to compute its digest). Return the
+  records encoded for each of the OUTPUTS of the kind, the numbers of records
+  and edges, and the MD5 digest of the chunk (or None). The 'hash' kind only
+  computes the digest."""
+  kind, path, start, end, args, with_digest = task
+  with open(path, 'rb') as f:
+    f.seek(start)
+    data = f.read(end - start)
+  digest = hashlib.md5(data).digest() if with_digest else None
+  try:
+    return encode_data(kind, data, args) + (digest,)
+  except ValueError as e:
+    raise ValueError('%s, bytes %d-%d: %s' % (path, start, end, e))
+
+
+def encode_block(task):
+  """Encode a block of lines read from a stream, given as (kind, name of the
+  stream, offset of the block, block, arguments of the encoder). Return what
+  encode_data does."""
+  kind, name, start, data, args = task
+  try:
+    return encode_data(kind, data, args)
+  except ValueError as e:
+    raise ValueError('%s, bytes %d-%d: %s' % (name, start, start + len(data), e))
+
+
+def input_files(input_folder, tables=()):
+  """Return the (kind, path, arguments of the encoder) of each grounding file
+  of input_folder, and of the variable tables given without a file, in the
+  order of their records in the graph files."""
+  files = []
+  for (factor_name, function_id, positives) in sorted(read_factormeta(input_folder),
+      key=lambda factor: factor[0] + '_out'):
+    files.append(('factor', input_folder + '/dd_factors_' + factor_name + '_out',
+      (function_id, positives)))
+  for f in sorted(set(os.listdir(input_folder)) | set(tables)):
+    if f.startswith('dd_variables_'):
+      files.append(('variable', input_folder + '/' + f, ()))
+  files.append(('weight', input_folder + '/dd_weights', ()))
+  return files
+
+
+def encode_files(pool, processes, files, outputs, chunk_size, with_digest=False):
+  """Encode files with a pool of processes, writing their records to the
+  streams returned by outputs(kind, path), one for each of the OUTPUTS of the
+  kind. Return a dict of the number of records, the number of edges and the
+  content digest (see content_digests) of each file.
+
+  At most 2 * processes chunks are encoded or waiting to be written at a
+  time, so that the encoded records do not pile up in memory when they are
+  written slower than they are encoded.
+  """
+  tasks = []
+  for kind, path, args in files:
+    for (start, end) in line_chunks(path, chunk_size):
+      tasks.append((kind, path, start, end, args, with_digest))
+  results = dict((path, [0, 0, hashlib.md5()]) for kind, path, args in files)
+  pending = collections.deque()
+  last_path = None
+  for i in xrange(len(tasks)):
+    while len(pending) < 2 * processes and i + len(pending) < len(tasks):
+      task = tasks[i + len(pending)]
+      pending.append(pool.apply_async(encode_chunk, (task,)))
+    task = tasks[i]
+    records, n_records, n_edges, digest = pending.popleft().get()
+    if task[1] != last_path:
+      last_path = task[1]
+      print "CHECKING " if task[0] == 'hash' else "BINARIZE ", \
+        os.path.basename(last_path), "..."
+      streams = outputs(task[0], task[1])
+    for stream, data in zip(streams, records):
+      stream.write(data)
+    result = results[task[1]]
+    result[0] += n_records
+    result[1] += n_edges
+    if digest is not None:
+      result[2].update(digest)
+  return dict((path, (n_records, n_edges, digest.hexdigest()))
+    for path, (n_records, n_edges, digest) in results.iteritems())
+
+
+def content_digests(pool, processes, paths, chunk_size):
+  """Return a dict of the MD5 digest of the concatenated MD5 digests of the
+  chunks of each file."""
+  results = encode_files(pool, processes, [('hash', path, ()) for path in paths],
+    lambda kind, path: (), chunk_size, with_digest=True)
+  return dict((path, result[2]) for path, result in results.iteritems())
+
+
+def fingerprint(path, n_samples=16, sample_size=1 << 16):
+  """Return the size, the modification time and the MD5 digest of n_samples
+  evenly spaced blocks of sample_size bytes of a file (of all of it, if it is
+  small)."""
+  if not os.path.isfile(path):
+    return {'size': 0, 'mtime': 0, 'sample': hashlib.md5().hexdigest()}
+  st = os.stat(path)
+  sample = hashlib.md5()
+  with open(path, 'rb') as f:
+    if st.st_size <= n_samples * sample_size:
+      sample.update(f.read())
+    else:
+      for i in range(n_samples):
+        f.seek(i * (st.st_size - sample_size) // (n_samples - 1))
+        sample.update(f.read(sample_size))
+  return {'size': st.st_size, 'mtime': st.st_mtime, 'sample': sample.hexdigest()}
+
+
+def segment_path(output_folder, path, name):
+  """Return the path of the records of the name output of an input file."""
+  return '%s/%s/%s.%s' % (output_folder, SEGMENTS, os.path.basename(path), name)
+
+
+def read_manifest(output_folder):
+  path = output_folder + '/' + MANIFEST
+  if not os.path.isfile(path):
+    return {}
+  with open(path) as f:
+    return json.load(f)
+
+
+def write_manifest(output_folder, manifest):
+  path = output_folder + '/' + MANIFEST
+  with open(path + '.tmp', 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  os.rename(path + '.tmp', path)
+
+
+def convert_incrementally(pool, processes, files, output_folder, chunk_size):
+  """Encode the input files that changed since the last incremental
+  conversion into output_folder, reuse the records of the others, and
+  concatenate them all into the graph files. Return a dict of the numbers of
+  records and edges of each file.
+
+  The records of each input file are kept in output_folder/graph.segments,
+  and output_folder/graph.manifest has the fingerprint of each input file
+  they were encoded from. A file is unchanged if its size, modification time
+  and sample digest are the same; if only its modification time changed (as
+  when the grounding dumps it again), it is unchanged if its content digest
+  is the same.
+  """
+  if not os.path.isdir(output_folder + '/' + SEGMENTS):
+    os.makedirs(output_folder + '/' + SEGMENTS)
+  manifest = read_manifest(output_folder)
+  new_manifest = {}
+  fingerprints = {}
+  to_check = []
+  to_encode = []
+  for kind, path, args in files:
+    name = os.path.basename(path)
+    entry = manifest.get(name)
+    fingerprints[path] = fingerprint(path)
+    if entry is None or entry['encoding'] != json.loads(json.dumps([kind, args, chunk_size])) or \
+        entry['size'] != fingerprints[path]['size'] or entry['sample'] != fingerprints[path]['sample'] or \
+        not all(os.path.isfile(segment_path(output_folder, path, output)) for output in OUTPUTS[kind]):
+      to_encode.append((kind, path, args))
+    elif entry['mtime'] != fingerprints[path]['mtime']:
+      to_check.append((kind, path, args))
+    else:
+      new_manifest[name] = entry
+  digests = content_digests(pool, processes, [path for kind, path, args in to_check], chunk_size)
+  for kind, path, args in to_check:
+    name = os.path.basename(path)
+    if digests[path] == manifest[name]['digest']:
+      new_manifest[name] = dict(manifest[name], mtime=fingerprints[path]['mtime'])
+    else:
+      to_encode.append((kind, path, args))
+  for kind, path, args in files:
+    if os.path.basename(path) in new_manifest:
+      print "REUSING ", os.path.basename(path), "..."
+  to_encode.sort(key=files.index)
+
+  # The records of the files to encode are overwritten: they are out of the
+  # manifest until they are written.
+  write_manifest(output_folder, new_manifest)
+  streams = dict((path, [open(segment_path(output_folder, path, output), 'wb')
+    for output in OUTPUTS[kind]]) for kind, path, args in to_encode)
+  try:
+    results = encode_files(pool, processes, to_encode, lambda kind, path: streams[path],
+      chunk_size, with_digest=True)
+  finally:
+    for outputs in streams.values():
+      for stream in outputs:
+        stream.close()
+  for kind, path, args in to_encode:
+    n_records, n_edges, digest = results[path]
+    new_manifest[os.path.basename(path)] = dict(fingerprints[path],
+      encoding=[kind, args, chunk_size], digest=digest, records=n_records, edges=n_edges)
+  write_manifest(output_folder, new_manifest)
+  for name, entry in manifest.iteritems():
+    if name not in new_manifest:
+      for output in OUTPUTS.get(entry['encoding'][0], ()):
+        if os.path.isfile(segment_path(output_folder, name, output)):
+          os.remove(segment_path(output_folder, name, output))
+
+  print "CONCATENATING FILES..."
+  for output in ('weights', 'variables', 'factors', 'edges'):
+    with open('%s/graph.%s' % (output_folder, output), 'wb') as out:
+      for kind, path, args in files:
+        if output in OUTPUTS[kind]:
+          with open(segment_path(output_folder, path, output), 'rb') as segment:
+            shutil.copyfileobj(segment, out, 1 << 20)
+  return dict((path, (new_manifest[os.path.basename(path)]['records'],
+    new_manifest[os.path.basename(path)]['edges'])) for kind, path, args in files)
+
+
+def convert(input_folder, output_folder, processes=None, chunk_size=CHUNK_SIZE,
+    incremental=False):
+  """Convert the grounding files of input_folder into the binary files and
+  graph.meta of output_folder (incrementally, see convert_incrementally).
+  Return the numbers of weights, variables, factors and edges."""
+  files = input_files(input_folder)
+  if not os.path.isdir(output_folder):
+    os.makedirs(output_folder)
+  processes = processes or multiprocessing.cpu_count()
+  pool = multiprocessing.Pool(processes)
+  try:
+    if incremental:
+      counts = convert_incrementally(pool, processes, files, output_folder, chunk_size)
+    else:
+      graph = dict((output, open('%s/graph.%s' % (output_folder, output), 'wb'))
+        for output in ('weights', 'variables', 'factors', 'edges'))
+      try:
+        counts = encode_files(pool, processes, files,
+          lambda kind, path: [graph[output] for output in OUTPUTS[kind]], chunk_size)
+      finally:
+        for f in graph.values():
+          f.close()
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  totals = dict((kind, [0, 0]) for kind in OUTPUTS)
+  for kind, path, args in files:
+    totals[kind][0] += counts[path][0]
+    totals[kind][1] += counts[path][1]
+  nweights, nvariables = totals['weight'][0], totals['variable'][0]
+  nfactors, nedges = totals['factor']
+  write_meta(output_folder, nweights, nvariables, nfactors, nedges)
+  return nweights, nvariables, nfactors, nedges
+
+
+def stream_chunks(stream, chunk_size=CHUNK_SIZE):
+  """Yield the data read from a stream (e.g. a pipe) in chunks of about
+  chunk_size bytes that end at a line boundary."""
+  rest = ''
+  while True:
+    data = stream.read(chunk_size)
+    if not data:
+      break
+    data = rest + data
+    end = data.rfind('\n') + 1
+    rest = data[end:]
+    if end:
+      yield data[:end]
+  if rest:
+    yield rest
+
+
+def convert_streams(input_folder, output_folder, processes=None, chunk_size=CHUNK_SIZE,
+    stdin_table=None):
+  """Convert the grounding files of input_folder as convert does, but read
+  each of them once from start to end, so that they can be named pipes the
+  grounding writes the tables to (e.g. with COPY ... TO STDOUT). The table
+  named stdin_table is read from the standard input instead. Return the
+  numbers of weights, variables, factors and edges.
+
+  The files are read concurrently, by a thread each, so that the grounding
+  can write the tables in any order. Their chunks are encoded by a pool of
+  processes, with a bounded number of chunks in memory. The records of the
+  first file of each kind are written to the graph files as they are done;
+  those of the others are spooled to temporary files in output_folder, which
+  are appended to the graph files once all the files are read.
+  """
+  files = input_files(input_folder, [stdin_table] if stdin_table else ())
+  if stdin_table and stdin_table not in [os.path.basename(path) for kind, path, args in files]:
+    raise ValueError('%s is not a grounding file of %s: expected dd_weights, a dd_variables_* '
+      'table or the dd_factors_*_out file of a factor of dd_factormeta' % (stdin_table, input_folder))
+  files = [(kind, path, args) for kind, path, args in files
+    if os.path.basename(path) == stdin_table or os.path.exists(path)]
+  if not os.path.isdir(output_folder):
+    os.makedirs(output_folder)
+  processes = processes or multiprocessing.cpu_count()
+  graph = dict((output, open('%s/graph.%s' % (output_folder, output), 'wb'))
+    for output in ('weights', 'variables', 'factors', 'edges'))
+  # The streams the records of each file are written to
+  destinations = {}
+  spools = []
+  for kind, path, args in files:
+    if any(k == kind for k, p, a in files[:files.index((kind, path, args))]):
+      destinations[path] = [tempfile.TemporaryFile(dir=output_folder) for output in OUTPUTS[kind]]
+      spools.append((kind, destinations[path]))
+    else:
+      destinations[path] = [graph[output] for output in OUTPUTS[kind]]
+  counts = {}
+  # Chunks read and not encoded yet, of all the files
+  in_flight = threading.BoundedSemaphore(2 * processes)
+  finished = Queue.Queue()
+
+  def encode_stream(kind, path, args):
+    try:
+      name = os.path.basename(path)
+      stream = sys.stdin if name == stdin_table else open(path, 'rb')
+      print "BINARIZE ", name, "..."
+      streams = destinations[path]
+      pending = collections.deque()
+      # The numbers of records and edges written
+      done = [0, 0]
+
+      def write_next():
+        records, n_records, n_edges = pending.popleft().get()
+        for output, data in zip(streams, records):
+          output.write(data)
+        done[0] += n_records
+        done[1] += n_edges
+
+      start = 0
+      for data in stream_chunks(stream, chunk_size):
+        in_flight.acquire()
+        pending.append(pool.apply_async(encode_block, ((kind, name, start, data, args),),
+          callback=lambda result: in_flight.release()))
+        start += len(data)
+        # The records done are written before reading on, as the stream may
+        # not have more data until another one is read.
+        while pending and (pending[0].ready() or len(pending) >= 2 * processes):
+          write_next()
+      while pending:
+        write_next()
+      if stream is not sys.stdin:
+        stream.close()
+      counts[path] = tuple(done)
+      finished.put(None)
+    except:
+      finished.put(sys.exc_info())
+
+  pool = multiprocessing.Pool(processes)
+  try:
+    for kind, path, args in files:
+      thread = threading.Thread(target=encode_stream, args=(kind, path, args))
+      # A thread waiting for a pipe does not keep the process alive after an
+      # error in another one.
+      thread.daemon = True
+      thread.start()
+    for f in files:
+      # With a timeout, the wait can be interrupted.
+      error = finished.get(True, 1 << 30)
+      if error is not None:
+        raise error[0], error[1], error[2]
+    print "CONCATENATING FILES..."
+    for kind, streams in spools:
+      for output, spool in zip(OUTPUTS[kind], streams):
+        spool.seek(0)
+        shutil.copyfileobj(spool, graph[output], 1 << 20)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    for f in graph.values():
+      f.close()
+    for kind, streams in spools:
+      for spool in streams:
+        spool.close()
+  totals = dict((kind, [0, 0]) for kind in OUTPUTS)
+  for kind, path, args in files:
+    totals[kind][0] += counts[path][0]
+    totals[kind][1] += counts[path][1]
+  nweights, nvariables = totals['weight'][0], totals['variable'][0]
+  nfactors, nedges = totals['factor']
+  write_meta(output_folder, nweights, nvariables, nfactors, nedges)
+  return nweights, nvariables, nfactors, nedges
+
+
+def write_meta(output_folder, nweights, nvariables, nfactors, nedges):
+  with open(output_folder + '/graph.meta', 'w') as meta:
+    meta.write('%d,%d,%d,%d,' % (nweights, nvariables, nfactors, nedges))
+    meta.write('{0}/graph.weights,{0}/graph.variables,{0}/graph.factors,{0}/graph.edges\n'.format(output_folder))
+
+
+def convert_with_format_converter(INPUTFOLDER, transform_script, OUTPUTFOLDER):
+  """Convert the grounding files by splitting them and running
+  transform_script on each chunk."""
+  CHUNKSIZE = '10000000'
+
+  # clean up folder
+  os.system('rm -rf ' + INPUTFOLDER + "/dd_tmp")
+  os.system('mkdir -p ' + INPUTFOLDER + "/dd_tmp")
+  os.system('rm -rf ' + INPUTFOLDER + "/dd_summary")
+
+  if not os.path.isfile(INPUTFOLDER + "/dd_factormeta"):
+    os.system("touch %s/dd_factormeta" %INPUTFOLDER)
+
+  # handle factors
+  for l in open(INPUTFOLDER + "/dd_factormeta"):
+    (factor_name, function_id, positives) = l.split('\t')
+    positives = positives.strip().replace('true', '1').replace('false', '0').split(' ')
+    nvars = '%d' % len(positives)
+
+    print "SPLITTING", factor_name, "..."
+    os.system('split -a 10 -l ' + CHUNKSIZE + ' ' + INPUTFOLDER + '/dd_factors_' + factor_name + '_out ' + INPUTFOLDER + '/dd_tmp/dd_factors_' + factor_name + '_out')
+
+    print "BINARIZE ", factor_name, "..."
+    os.system('ls ' + INPUTFOLDER + '/dd_tmp | egrep "^dd_factors_' + factor_name + '_out"  | xargs -P ' + str(multiprocessing.cpu_count()) + ' -I {} -n 1 sh -c \'' + transform_script + ' factor ' + INPUTFOLDER + '/dd_tmp/{} ' + function_id + ' ' + nvars + ' ' + (' '.join(positives)) + ' \' >>' + INPUTFOLDER + "/dd_summary")
+
+  # handle variables
+  for f in os.listdir(INPUTFOLDER):
+    if f.startswith('dd_variables_'):
+      print "SPLITTING", f, "..."
+      os.system("touch %s/dd_tmp/%s" %(INPUTFOLDER, f))
+      os.system('split -a 10 -l ' + CHUNKSIZE + ' ' + INPUTFOLDER + '/' + f + ' ' + INPUTFOLDER + '/dd_tmp/' + f)
+
+      print "BINARIZE ", f, "..."
+      os.system('ls ' + INPUTFOLDER + '/dd_tmp | egrep "^' + f + '"  | xargs -P ' + str(multiprocessing.cpu_count()) + ' -I {} -n 1 sh -c \'' + transform_script + ' variable ' + INPUTFOLDER + '/dd_tmp/{} \' >>' + INPUTFOLDER + "/dd_summary")
+
+  # handle weights
+  print "BINARIZE ", 'weights', "..."
+  os.system(transform_script + ' weight ' + INPUTFOLDER + '/dd_weights >>' + INPUTFOLDER + "/dd_summary")
+
+  # move files
+  os.system('rm -rf ' + INPUTFOLDER + "/dd_factors")
+  os.system('mkdir -p ' + INPUTFOLDER + "/dd_factors")
+  os.system('mv ' + INPUTFOLDER + '/dd_tmp/dd_factors*.bin ' + INPUTFOLDER + '/dd_factors')
+
+  os.system('rm -rf ' + INPUTFOLDER + "/dd_variables")
+  os.system('mkdir -p ' + INPUTFOLDER + "/dd_variables")
+  os.system('mv ' + INPUTFOLDER + '/dd_tmp/dd_variables*.bin ' + INPUTFOLDER + '/dd_variables')
+
+  # concatenate files
+  print "CONCATENATING FILES..."
+  os.system("mv {0}/dd_weights.bin {1}/graph.weights".format(INPUTFOLDER, OUTPUTFOLDER))
+  os.system("cat {0}/dd_variables/* > {1}/graph.variables".format(INPUTFOLDER, OUTPUTFOLDER))
+  os.system("cat {0}/dd_factors/dd_factors*factors.bin > {1}/graph.factors".format(INPUTFOLDER, OUTPUTFOLDER))
+  os.system("cat {0}/dd_factors/dd_factors*edges.bin > {1}/graph.edges".format(INPUTFOLDER, OUTPUTFOLDER))
+
+  # counting, from the summary line transform_script prints for each file
+  counts = read_summary(INPUTFOLDER + '/dd_summary')
+  for mode, name, size in (('weight', 'weights', 17), ('variable', 'variables', 35),
+      ('factor', 'factors', 26), ('edge', 'edges', 33)):
+    if counts[mode] is None:
+      # Older versions of transform_script print no summary, but the records
+      # have a fixed size.
+      counts[mode] = os.path.getsize('%s/graph.%s' % (OUTPUTFOLDER, name)) // size
+  write_meta(OUTPUTFOLDER, counts['weight'], counts['variable'],
+    counts['factor'], counts['edge'])
+
+
+def read_summary(path):
+  """Return the numbers of variables, weights, factors and edges written by
+  transform_script, by summing its "mode<TAB>input file<TAB>records<TAB>edges"
+  summary lines, as a dict with the keys 'variable', 'weight', 'factor' and
+  'edge'. A count is None if no summary line has it."""
+  counts = dict.fromkeys(('variable', 'weight', 'factor', 'edge'))
+  if os.path.isfile(path):
+    for l in open(path):
+      fields = l.rstrip('\n').split('\t')
+      if len(fields) == 4 and fields[0] in counts:
+        counts[fields[0]] = (counts[fields[0]] or 0) + int(fields[2])
+        if fields[0] == 'factor':
+          counts['edge'] = (counts['edge'] or 0) + int(fields[3])
+  return counts
+
+
+def clean_up(input_folder):
+  """Remove the grounding files, which are not needed anymore."""
+  print "Cleaning up files"
+  for f in os.listdir(input_folder):
+    if f.startswith('dd_'):
+      path = input_folder + '/' + f
+      if os.path.isdir(path):
+        shutil.rmtree(path)
+      else:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Convert grounding files to the binary format of the sampler')
+  parser.add_argument('input_folder')
+  parser.add_argument('transform_script', help='the format converter, used if NumPy is not available')
+  parser.add_argument('output_folder')
+  parser.add_argument('--incremental', action='store_true',
+    default=bool(os.environ.get('DEEPDIVE_INCREMENTAL_BINARIZATION')),
+    help='only encode the input files that changed since the last incremental conversion ' +
+    'into the output folder (also enabled by setting DEEPDIVE_INCREMENTAL_BINARIZATION)')
+  parser.add_argument('--stream', action='store_true',
+    help='read each input file once from start to end, so that they can be named pipes')
+  parser.add_argument('--stdin', metavar='TABLE',
+    help='read the grounding file TABLE (e.g. dd_variables_x) from the standard input; implies --stream')
+  args = parser.parse_args()
+  stream = args.stream or args.stdin is not None
+  if stream and args.incremental:
+    parser.error('--incremental needs to read the input files more than once, not streams')
+  if stream and np is None:
+    parser.error('streaming requires NumPy')
+  if stream:
+    convert_streams(args.input_folder, args.output_folder, stdin_table=args.stdin)
+  elif np is not None:
+    convert(args.input_folder, args.output_folder, incremental=args.incremental)
+  else:
+    print "NumPy is not available, converting with", args.transform_script
+    convert_with_format_converter(args.input_folder, args.transform_script, args.output_folder)
+  clean_up(args.input_folder)